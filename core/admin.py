@@ -1,8 +1,13 @@
 from django.contrib import admin
-from .models import Item, OrderItem, Order, Payment
+from .models import CatalogVersion, Item, OrderItem, Order, Payment, PaymentJob, ArchivedOrder, StockReservation, SalesRollup
 # Register your models here.
 
 admin.site.register(Item)
 admin.site.register(OrderItem)
 admin.site.register(Order)
 admin.site.register(Payment)
+admin.site.register(PaymentJob)
+admin.site.register(ArchivedOrder)
+admin.site.register(StockReservation)
+admin.site.register(CatalogVersion)
+admin.site.register(SalesRollup)
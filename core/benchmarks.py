@@ -0,0 +1,294 @@
+import copy
+import random
+import statistics
+import threading
+import time
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.db import connection
+from django.template.loader import render_to_string
+from django.test import Client, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .catalog import bump_catalog_version, cart_lines, get_catalog, get_categories, get_entry_by_slug
+from .forms import CheckoutForm
+from .models import Item, Order, OrderItem, CATEGORY_CHOICES, LABEL_CHOICES, bulk_create_pks
+from .search import index_items
+
+# Synthetic storefront data and a driver that requests the real views with
+# the Django test client, recording latency and SQL query counts per view.
+# Used by `python manage.py benchmark` and by the query budget tests.
+
+# Maximum SQL queries per request. They must not grow with the catalog or
+# cart size; a view exceeding its budget has most likely grown an N+1.
+QUERY_BUDGETS = {
+    'home': 5,
+    'home-category': 5,
+    'product': 4,
+    # cart changes check that no payment of the cart is in progress
+    'add-to-cart': 8,
+    'remove-single-item-from-cart': 8,
+    'order-summary': 6,
+    'checkout-get': 3,
+    'checkout-post': 6,
+    'payment-get': 4,
+    # the totals are recalculated from the line prices before charging
+    'payment-post': 10,
+}
+
+PASSWORD = 'benchmark'
+
+
+def generate_catalog(items, seed=0):
+    rng = random.Random(seed)
+    categories = [code for code, name in CATEGORY_CHOICES]
+    labels = [code for code, name in LABEL_CHOICES]
+    batch = []
+    for i in range(items):
+        price = round(rng.uniform(5, 500), 2)
+        batch.append(Item(
+            title=f'Produkt {i}',
+            price=price,
+            discount_price=round(price * 0.8, 2) if rng.random() < 0.3 else None,
+            category=rng.choice(categories),
+            label=rng.choice(labels),
+            slug=f'produkt-{i}',
+            description=f'Opis produktu {i}',
+            image=f'produkt-{i}.jpg'))
+    Item.objects.bulk_create(batch)
+    # bulk_create sends no signals
+    index_items(Item.objects.only('title', 'description'))
+    bump_catalog_version()
+    return list(Item.objects.order_by('pk').values_list('pk', flat=True))
+
+
+def generate_order(user, item_pks, lines, rng, ordered):
+    order = Order.objects.create(user=user, ordered=ordered, ordered_date=timezone.now())
+    order_item_pks = bulk_create_pks(
+        [OrderItem(user=user, item_id=pk, ordered=ordered, quantity=rng.randint(1, 3))
+         for pk in rng.sample(item_pks, lines)],
+        OrderItem.objects.filter(user=user).order_by('-pk')[:lines])
+    Order.items.through.objects.bulk_create([
+        Order.items.through(order_id=order.pk, orderitem_id=pk) for pk in order_item_pks])
+    order.recalculate_totals()
+    return order
+
+
+def generate_data(items=1000, users=20, past_orders=5, cart_lines=15, seed=0):
+    """
+    Creates `items` catalog items and `users` users, each with `past_orders`
+    completed orders and an open cart of `cart_lines` lines.
+    """
+    rng = random.Random(seed)
+    item_pks = generate_catalog(items, seed)
+    password = make_password(PASSWORD)
+    User = get_user_model()
+    User.objects.bulk_create([
+        User(username=f'benchmark-{i}', password=password) for i in range(users)])
+    shoppers = list(User.objects.filter(username__startswith='benchmark-'))
+    lines = min(cart_lines, len(item_pks))
+    for user in shoppers:
+        for _ in range(past_orders):
+            generate_order(user, item_pks, lines, rng, ordered=True)
+        generate_order(user, item_pks, lines, rng, ordered=False)
+    return shoppers
+
+
+def scenarios(user):
+    # (name, method, url, data) per view; cart mutations target an item
+    # already in the user's cart so every run does the same work
+    cart_slug = Order.objects.get(user=user, ordered=False).items.first().item.slug
+    some_slug = Item.objects.order_by('-pk').values_list('slug', flat=True).first()
+    return [
+        ('home', 'get', '/', None),
+        ('home-category', 'get', f'/?category={CATEGORY_CHOICES[0][0]}&page=2', None),
+        ('product', 'get', f'/product/{some_slug}/', None),
+        ('add-to-cart', 'get', f'/add-to-cart/{cart_slug}/', None),
+        ('remove-single-item-from-cart', 'get', f'/remove-item-from-cart/{cart_slug}/', None),
+        ('order-summary', 'get', '/order-summary/', None),
+        ('checkout-get', 'get', '/checkout/', None),
+        ('checkout-post', 'post', '/checkout/', {
+            'street_address': 'Długa 1',
+            'apartment_address': '',
+            'country': 'PL',
+            'zip': '89-200',
+            'payment_option': 'S',
+        }),
+        ('payment-get', 'get', '/payment/stripe/', None),
+        ('payment-post', 'post', '/payment/stripe/', {'stripeToken': 'tok_visa'}),
+    ]
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def measure(client, method, url, data, repeat):
+    latencies = []
+    queries = []
+    status = None
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            response = getattr(client, method)(url, data or {})
+            latencies.append((time.perf_counter() - started) * 1000)
+        queries.append(len(captured))
+        status = response.status_code
+    return {
+        'status': status,
+        'runs': repeat,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p90_ms': round(percentile(latencies, 90), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(statistics.mean(latencies), 3),
+        'queries': max(queries),
+    }
+
+
+@override_settings(PAYMENT_BACKEND='fake', PAYMENT_JOBS_IN_PROCESS=False, IMAGE_DERIVATIVES_ASYNC=False)
+def run_benchmark(user, repeat=20, warmup=1):
+    client = Client()
+    client.force_login(user)
+    results = {}
+    for name, method, url, data in scenarios(user):
+        if warmup:
+            measure(client, method, url, data, warmup)
+        result = measure(client, method, url, data, repeat)
+        result['query_budget'] = QUERY_BUDGETS.get(name)
+        results[name] = result
+    return results
+
+
+def template_settings(cached):
+    # TEMPLATES and TEMPLATE_CACHE of the development or the production
+    # template mode (see settings.py)
+    engine = copy.deepcopy(settings.TEMPLATES[0])
+    engine['OPTIONS'].pop('loaders', None)
+    engine['APP_DIRS'] = not cached
+    if cached:
+        engine['OPTIONS']['loaders'] = settings.CACHED_TEMPLATE_LOADERS
+    return {'TEMPLATES': [engine], 'TEMPLATE_CACHE': cached}
+
+
+def render_scenarios(user):
+    # (template, context) as the views render them, with the item fragments
+    # (cached separately, see render_cached_fragment) rendered up front
+    order = Order.objects.get(user=user, ordered=False)
+    order_items = cart_lines(order.items.values_list('item_id', 'quantity'))
+    entries = get_catalog().items[:8]
+    entry = get_entry_by_slug(Item.objects.order_by('-pk').values_list('slug', flat=True).first())
+    return [
+        ('base.html', {}),
+        ('home.html', {'object_list': entries, 'categories': get_categories(),
+                       'item_cards': render_to_string('item_cards.html', {'object_list': entries})}),
+        ('product.html', {'object': entry,
+                          'product_html': render_to_string('product_detail.html', {'object': entry})}),
+        ('order_summary.html', {'order_items': order_items, 'order_total': order.get_total()}),
+        ('checkout.html', {'form': CheckoutForm()}),
+    ]
+
+
+def measure_render(template_name, context, request, repeat):
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        render_to_string(template_name, context, request)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return {
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(statistics.mean(latencies), 3),
+    }
+
+
+def run_render_benchmark(user, repeat=50, warmup=1):
+    """
+    Render time of each template in the development template mode (loaders
+    reading and compiling templates on every render) and in TEMPLATE_CACHE
+    mode (cached loaders and cached chrome), as
+    {template: {'development': {...}, 'production': {...}, 'speedup': x}}.
+    Views and their queries are left out on purpose.
+    """
+    request = RequestFactory().get('/')
+    request.user = user
+    results = {}
+    for mode, cached in (('development', False), ('production', True)):
+        cache.clear()
+        with override_settings(**template_settings(cached)):
+            for template_name, context in render_scenarios(user):
+                if warmup:
+                    measure_render(template_name, context, request, warmup)
+                results.setdefault(template_name, {})[mode] = \
+                    measure_render(template_name, context, request, repeat)
+    for result in results.values():
+        result['speedup'] = round(result['development']['p50_ms'] / max(result['production']['p50_ms'], 0.001), 2)
+    return results
+
+
+def run_load(base_url, paths, concurrency=10, duration=10, timeout=30):
+    """
+    Requests `paths` of a running server round robin from `concurrency`
+    keep-alive connections for `duration` seconds, e.g. to compare the WSGI
+    and ASGI servers on the same hardware. The views are sync under both, so
+    this measures the servers, not async views.
+    """
+    url = urlsplit(base_url)
+    connection_class = HTTPSConnection if url.scheme == 'https' else HTTPConnection
+    prefix = url.path.rstrip('/')
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(n):
+        connection = connection_class(url.netloc, timeout=timeout)
+        local_latencies = []
+        local_statuses = {}
+        while time.monotonic() < deadline:
+            path = paths[n % len(paths)]
+            n += 1
+            started = time.perf_counter()
+            try:
+                connection.request('GET', prefix + path)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, HTTPException):
+                status = 'error'
+                connection.close()
+                connection = connection_class(url.netloc, timeout=timeout)
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+            if status != 'error' and status < 400:
+                local_latencies.append((time.perf_counter() - started) * 1000)
+        connection.close()
+        with lock:
+            latencies.extend(local_latencies)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    return {
+        'url': base_url,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': sum(statuses.values()) - len(latencies),
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99), 3) if latencies else None,
+    }
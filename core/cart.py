@@ -0,0 +1,251 @@
+import secrets
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .catalog import cart_lines
+from .models import Item, Order, OrderItem, PaymentJob, bulk_create_pks
+from .stock import release, reserve
+
+# Cart badge count per user. The count is cached under a version that the
+# cart views drop on every change: a reader that queried the count before a
+# change committed stores it under the dropped version, where nobody reads
+# it, instead of caching the stale count for CART_ITEM_COUNT_TIMEOUT.
+CART_ITEM_COUNT_VERSION_KEY = 'cart-item-count-version:{}'
+CART_ITEM_COUNT_KEY = 'cart-item-count:{}:{}'
+CART_ITEM_COUNT_TIMEOUT = 60 * 60 * 24
+
+
+def get_cart_item_count(user):
+    if not user.is_authenticated:
+        return 0
+    version_key = CART_ITEM_COUNT_VERSION_KEY.format(user.pk)
+    version = cache.get(version_key)
+    if version is None:
+        # a new version is never one a dropped version had
+        cache.add(version_key, time.time_ns(), CART_ITEM_COUNT_TIMEOUT)
+        version = cache.get(version_key)
+    key = CART_ITEM_COUNT_KEY.format(user.pk, version)
+    count = cache.get(key)
+    if count is None:
+        count = Order.objects.filter(user=user, ordered=False) \
+            .values_list('item_count', flat=True).first() or 0
+        if version is not None:
+            cache.set(key, count, CART_ITEM_COUNT_TIMEOUT)
+    return count
+
+
+def invalidate_cart_item_count(user):
+    # Dropped once the cart change is committed, a rolled back transaction
+    # keeps the cached count. The next read starts a new version.
+    key = CART_ITEM_COUNT_VERSION_KEY.format(user.pk)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+def lock_cart(user):
+    # Serializes cart changes of one user, so concurrent requests can't both
+    # create an open order or the same order line. Must run inside a transaction.
+    # The add_to_cart fast path increments lines without it, so a change that
+    # writes back or undoes a quantity it read must read the line with
+    # select_for_update().
+    get_user_model().objects.select_for_update().only('pk').get(pk=user.pk)
+
+
+class PaymentInProgress(Exception):
+    pass
+
+
+def check_no_payment_in_progress(user):
+    # The cart can't change while its payment job is pending or running, or
+    # the job would charge for other lines than the order gets. Call inside
+    # the cart change's transaction, after updating the open order's row:
+    # enqueue_payment locks that row, so either the job already exists and
+    # the change is rolled back, or the job is created after the change.
+    if PaymentJob.objects.filter(order__user=user, order__ordered=False, status__in=['P', 'R']).exists():
+        raise PaymentInProgress
+
+
+# Carts of anonymous shoppers live in the cache under a random id kept in a
+# cookie, so browsing and adding to cart causes no database writes. They are
+# merged into the user's open Order on login (see signals.py).
+GUEST_CART_COOKIE = 'guest_cart'
+GUEST_CART_KEY = 'guest-cart:{}'
+GUEST_CART_TIMEOUT = 60 * 60 * 24 * 14
+
+
+class GuestCart:
+    def __init__(self, cart_id=None, lines=None):
+        self.cart_id = cart_id
+        self.lines = lines or {}  # item pk -> quantity
+        self.is_new = cart_id is None
+
+    @classmethod
+    def from_request(cls, request):
+        cart_id = request.COOKIES.get(GUEST_CART_COOKIE)
+        if not cart_id:
+            return cls()
+        return cls(cart_id, cache.get(GUEST_CART_KEY.format(cart_id)))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __contains__(self, item_pk):
+        return item_pk in self.lines
+
+    def add(self, item_pk):
+        self.lines[item_pk] = self.lines.get(item_pk, 0) + 1
+
+    def remove(self, item_pk):
+        self.lines.pop(item_pk, None)
+
+    def remove_single(self, item_pk):
+        if self.lines.get(item_pk, 0) > 1:
+            self.lines[item_pk] -= 1
+        else:
+            self.remove(item_pk)
+
+    def save(self, response):
+        if self.cart_id is None:
+            self.cart_id = secrets.token_urlsafe(16)
+        cache.set(GUEST_CART_KEY.format(self.cart_id), self.lines, GUEST_CART_TIMEOUT)
+        if self.is_new:
+            response.set_cookie(GUEST_CART_COOKIE, self.cart_id, max_age=GUEST_CART_TIMEOUT,
+                                httponly=True, samesite='Lax')
+
+    def clear(self):
+        if self.cart_id is not None:
+            cache.delete(GUEST_CART_KEY.format(self.cart_id))
+        self.lines = {}
+
+    def order_items(self):
+        # CartLines for order_summary.html, priced from the catalog snapshot
+        return cart_lines(self.lines.items())
+
+
+def merge_guest_cart(request, user):
+    # Raises PaymentInProgress, keeping the guest cart, during a payment
+    cart = GuestCart.from_request(request)
+    if not cart.lines:
+        return
+    with transaction.atomic():
+        lock_cart(user)
+        order = Order.objects.filter(user=user, ordered=False).first()
+        if order is None:
+            order = Order.objects.create(user=user, ordered_date=timezone.now())
+        item_pks = [pk for pk in Item.objects.filter(pk__in=cart.lines.keys()).values_list('pk', flat=True)]
+
+        # open lines of these items, including ones removed from the cart earlier
+        existing = {line.item_id: line for line in
+                    OrderItem.objects.select_for_update().filter(user=user, ordered=False, item_id__in=item_pks)}
+        in_order = set(order.items.filter(item_id__in=item_pks).values_list('item_id', flat=True))
+        for pk, line in existing.items():
+            line.quantity = (line.quantity if pk in in_order else 0) + cart.lines[pk]
+        OrderItem.objects.bulk_update(existing.values(), ['quantity'])
+        new_pks = [pk for pk in item_pks if pk not in existing]
+        created = bulk_create_pks(
+            [OrderItem(user=user, item_id=pk, ordered=False, quantity=cart.lines[pk]) for pk in new_pks],
+            OrderItem.objects.filter(user=user, ordered=False, item_id__in=new_pks))
+
+        to_link = [line.pk for pk, line in existing.items() if pk not in in_order] + created
+        Order.items.through.objects.bulk_create([
+            Order.items.through(order_id=order.pk, orderitem_id=pk) for pk in to_link])
+        order.recalculate_totals()
+        invalidate_cart_item_count(user)
+        check_no_payment_in_progress(user)
+    cart.clear()
+
+
+class OutOfStock(Exception):
+    def __init__(self, items):
+        super().__init__(', '.join(item.title for item in items))
+        self.items = items
+
+
+# Units of one item per cart line the cart API accepts
+MAX_LINE_QUANTITY = 999
+
+
+def valid_change(change):
+    # {'quantity': n} with 0 <= n <= MAX_LINE_QUANTITY, or {'delta': n} with
+    # |n| <= MAX_LINE_QUANTITY
+    values = [change.get(key) for key in ('quantity', 'delta')]
+    if sum(type(value) is int for value in values) != 1:
+        return False
+    quantity, delta = values
+    if quantity is not None:
+        return 0 <= quantity <= MAX_LINE_QUANTITY
+    return -MAX_LINE_QUANTITY <= delta <= MAX_LINE_QUANTITY
+
+
+def new_quantity(current, change):
+    # A change sets {'quantity': n} or adds {'delta': n}, never below zero or
+    # above MAX_LINE_QUANTITY
+    if 'quantity' in change:
+        return change['quantity']
+    return min(max(0, current + change['delta']), MAX_LINE_QUANTITY)
+
+
+def apply_cart_changes(user, changes):
+    """
+    Applies [(item, change), ...] to the user's open order in one transaction
+    and returns the order. Raises OutOfStock, changing nothing, when the
+    stock doesn't cover the new quantities, and PaymentInProgress while the
+    order is being paid.
+    """
+    with transaction.atomic():
+        lock_cart(user)
+        order = Order.objects.filter(user=user, ordered=False).first()
+        if order is None:
+            order = Order.objects.create(user=user, ordered_date=timezone.now())
+        # Locked: increments in the add_to_cart fast path don't take lock_cart
+        lines = {line.item_id: line for line in order.items.select_for_update()}
+        missing = []
+        # Item order, so concurrent batches lock the item rows in the same order
+        for item, change in sorted(changes, key=lambda pair: pair[0].pk):
+            line = lines.get(item.pk)
+            current = line.quantity if line else 0
+            quantity = new_quantity(current, change)
+            if quantity > current and not reserve(user, item, quantity - current):
+                missing.append(item)
+                continue
+            if quantity < current:
+                release(user, item, current - quantity)
+            if quantity == current:
+                continue
+            if line is None:
+                # may reuse an orphaned line cleanup_carts has not deleted yet
+                line, created = OrderItem.objects.update_or_create(
+                    item=item, user=user, ordered=False, defaults={'quantity': quantity})
+                order.items.add(line)
+                lines[item.pk] = line
+            elif quantity == 0:
+                OrderItem.objects.filter(pk=line.pk).delete()
+                del lines[item.pk]
+            else:
+                OrderItem.objects.filter(pk=line.pk).update(quantity=quantity)
+                line.quantity = quantity
+        if missing:
+            raise OutOfStock(missing)
+        order.recalculate_totals()
+        invalidate_cart_item_count(user)
+        check_no_payment_in_progress(user)
+    return order
+
+
+def apply_guest_cart_changes(cart, changes):
+    # Guest carts hold no stock, only what is left can be added
+    missing = []
+    for item, change in changes:
+        current = cart.lines.get(item.pk, 0)
+        quantity = new_quantity(current, change)
+        if quantity > current and item.stock is not None and quantity > item.stock:
+            missing.append(item)
+        elif quantity:
+            cart.lines[item.pk] = quantity
+        else:
+            cart.remove(item.pk)
+    if missing:
+        raise OutOfStock(missing)
@@ -0,0 +1,221 @@
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import F
+from django.shortcuts import reverse
+
+from .models import CatalogVersion, Item, CATEGORY_CHOICES, LABEL_CHOICES
+
+# Every worker keeps the whole catalog in memory as an immutable snapshot of
+# tuples, with the URLs, display labels and effective price precomputed, so
+# catalog pages and cart pricing don't query Item rows. Item changes bump the
+# CatalogVersion row; a worker compares it with its snapshot at most every
+# CATALOG_SNAPSHOT_MAX_AGE seconds, which bounds how stale any node can be.
+# Stock is left out on purpose, it changes with every cart click.
+class CatalogEntry(NamedTuple):
+    id: int
+    title: str
+    price: float
+    discount_price: Optional[float]
+    effective_price: float
+    category: str
+    label: str
+    slug: str
+    description: Optional[str]
+    image: str  # storage name, '' without an image
+    has_derivatives: bool
+    get_absolute_url: str
+    get_add_to_cart_url: str
+    get_remove_from_cart_url: str
+    get_remove_single_item_from_cart_url: str
+    get_category_display: str
+    get_label_display: str
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __str__(self):
+        return self.title
+
+    def get_unit_discount(self):
+        return self.price - self.effective_price
+
+
+class CartLine(NamedTuple):
+    # OrderItem pricing for a catalog entry, see cart_lines()
+    item: CatalogEntry
+    quantity: int
+
+    def get_total_item_price(self):
+        return self.quantity * self.item.price
+
+    def get_total_discount_item_price(self):
+        return self.quantity * self.item.effective_price
+
+    def get_amount_saved(self):
+        return self.get_total_item_price() - self.get_total_discount_item_price()
+
+    def get_final_price(self):
+        return self.get_total_discount_item_price()
+
+
+class CatalogSnapshot:
+    __slots__ = ('version', 'items', 'by_pk', 'by_slug', 'by_category', '_filtered', '_keys')
+
+    def __init__(self, version, items):
+        self.version = version
+        self.items = tuple(items)
+        self.by_pk = {entry.id: entry for entry in self.items}
+        self.by_slug = {}
+        by_category = {}
+        for entry in self.items:
+            # the oldest item owns a repeated slug
+            self.by_slug.setdefault(entry.slug, entry)
+            by_category.setdefault(entry.category, []).append(entry)
+        self.by_category = {code: tuple(entries) for code, entries in by_category.items()}
+        # built on first use, the snapshot never changes
+        self._filtered = {}
+        self._keys = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def filter(self, category=None, label=None):
+        entries = self._filtered.get((category, label))
+        if entries is None:
+            entries = self.by_category.get(category, ()) if category else self.items
+            if label:
+                entries = tuple(entry for entry in entries if entry.label == label)
+            self._filtered[category, label] = entries
+        return entries
+
+    def keys(self, field, category=None, label=None):
+        # The `field` values of filter(category, label), for bisecting
+        keys = self._keys.get((field, category, label))
+        if keys is None:
+            keys = [getattr(entry, field) for entry in self.filter(category, label)]
+            self._keys[field, category, label] = keys
+        return keys
+
+
+_snapshot = None
+_checked = 0.0
+_lock = threading.Lock()
+_CATEGORY_DISPLAY = dict(CATEGORY_CHOICES)
+_LABEL_DISPLAY = dict(LABEL_CHOICES)
+
+
+def _url_formats():
+    # reverse() once per URL name with a placeholder, slugs need no quoting
+    return {
+        name: reverse(f'core:{name}', kwargs={'slug': 'SLUG'}).replace('SLUG', '{}')
+        for name in ('product', 'add-to-cart', 'remove-from-cart', 'remove-single-item-from-cart')
+    }
+
+
+def catalog_entry(item, urls=None):
+    urls = urls or _url_formats()
+    return CatalogEntry(
+        id=item.pk,
+        title=item.title,
+        price=item.price,
+        discount_price=item.discount_price,
+        effective_price=item.discount_price or item.price,
+        category=item.category,
+        label=item.label,
+        slug=item.slug,
+        description=item.description,
+        image=item.image.name if item.image else '',
+        has_derivatives=item.has_derivatives,
+        get_absolute_url=urls['product'].format(item.slug),
+        get_add_to_cart_url=urls['add-to-cart'].format(item.slug),
+        get_remove_from_cart_url=urls['remove-from-cart'].format(item.slug),
+        get_remove_single_item_from_cart_url=urls['remove-single-item-from-cart'].format(item.slug),
+        get_category_display=_CATEGORY_DISPLAY.get(item.category, item.category),
+        get_label_display=_LABEL_DISPLAY.get(item.label, item.label),
+    )
+
+
+def get_catalog_version():
+    # Read from the primary like the snapshot itself, a lagging replica
+    # would pair an old catalog with the new version
+    version = CatalogVersion.objects.using(DEFAULT_DB_ALIAS).filter(pk=1) \
+        .values_list('version', flat=True).first()
+    return version or 0
+
+
+def load_catalog(version):
+    urls = _url_formats()
+    items = Item.objects.using(DEFAULT_DB_ALIAS).order_by('pk').defer('stock').iterator()
+    return CatalogSnapshot(version, (catalog_entry(item, urls) for item in items))
+
+
+def get_catalog():
+    global _snapshot, _checked
+    max_age = getattr(settings, 'CATALOG_SNAPSHOT_MAX_AGE', 2)
+    snapshot = _snapshot
+    if snapshot is not None and time.monotonic() - _checked < max_age:
+        return snapshot
+    with _lock:
+        if _snapshot is not None and time.monotonic() - _checked < max_age:
+            return _snapshot
+        version = get_catalog_version()
+        if _snapshot is None or _snapshot.version != version:
+            _snapshot = load_catalog(version)
+        _checked = time.monotonic()
+        return _snapshot
+
+
+def bump_catalog_version():
+    # Call in the transaction changing the items, so the new version is
+    # never seen before the data it stands for. This worker reloads on its
+    # next read, the others within CATALOG_SNAPSHOT_MAX_AGE.
+    global _snapshot
+    if not CatalogVersion.objects.filter(pk=1).update(version=F('version') + 1):
+        _, created = CatalogVersion.objects.get_or_create(pk=1, defaults={'version': 1})
+        if not created:
+            CatalogVersion.objects.filter(pk=1).update(version=F('version') + 1)
+    _snapshot = None
+
+
+def get_category_counts():
+    catalog = get_catalog()
+    return {code: len(catalog.by_category.get(code, ())) for code, name in CATEGORY_CHOICES}
+
+
+def get_categories():
+    # [(code, name, item count), ...] in CATEGORY_CHOICES order
+    counts = get_category_counts()
+    return [(code, name, counts.get(code, 0)) for code, name in CATEGORY_CHOICES]
+
+
+def get_entries(pks):
+    # {pk: entry}; items newer than the snapshot are read from the database
+    catalog = get_catalog()
+    entries = {pk: catalog.by_pk[pk] for pk in pks if pk in catalog.by_pk}
+    missing = set(pks) - set(entries)
+    if missing:
+        urls = _url_formats()
+        for item in Item.objects.filter(pk__in=missing):
+            entries[item.pk] = catalog_entry(item, urls)
+    return entries
+
+
+def get_entry_by_slug(slug):
+    entry = get_catalog().by_slug.get(slug)
+    if entry is None:
+        item = Item.objects.filter(slug=slug).order_by('pk').first()
+        if item is not None:
+            entry = catalog_entry(item)
+    return entry
+
+
+def cart_lines(quantities):
+    # [CartLine, ...] for (item pk, quantity) pairs, in their order
+    quantities = list(quantities)
+    entries = get_entries([pk for pk, quantity in quantities])
+    return [CartLine(entries[pk], quantity) for pk, quantity in quantities if pk in entries]
@@ -0,0 +1,11 @@
+from .cart import GuestCart, get_cart_item_count
+
+
+def cart(request):
+    if request.user.is_authenticated:
+        count = get_cart_item_count(request.user)
+    else:
+        count = len(GuestCart.from_request(request))
+    return {
+        'cart_item_count': count
+    }
@@ -0,0 +1,81 @@
+import threading
+import time
+import weakref
+
+from django.conf import settings
+from django.db import connections
+
+from . import metrics
+
+# Persistent database connections (CONN_MAX_AGE > 0) are kept by every worker
+# thread between requests, so the per-process pool is one connection per
+# thread and alias, at most DB_POOL_SIZE of them are kept per alias (the
+# others are closed at the end of their request). Django 3.0 has no
+# CONN_HEALTH_CHECKS, so a reused connection is checked here at the start of
+# a request and replaced when the server has dropped it, instead of failing
+# the request's first query. Only connections idle for longer than
+# CONN_HEALTH_CHECK_IDLE seconds, or that saw an error, are checked: the
+# check is a round trip.
+
+_wrappers = weakref.WeakSet()
+_last_used = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def connection_opened(connection):
+    with _lock:
+        _wrappers.add(connection)
+    metrics.DB_CONNECTIONS_OPENED.labels(connection.alias).inc()
+    update_open_connections()
+
+
+def needs_check(connection):
+    if not connection.settings_dict.get('CONN_HEALTH_CHECKS'):
+        return False
+    idle = time.monotonic() - _last_used.get(connection, 0)
+    return connection.errors_occurred or idle > connection.settings_dict.get('CONN_HEALTH_CHECK_IDLE', 0)
+
+
+def check_connections():
+    for connection in connections.all():
+        if connection.connection is None:
+            continue
+        if needs_check(connection) and not connection.is_usable():
+            metrics.DB_HEALTH_CHECK_FAILURES.labels(connection.alias).inc()
+            # Reconnects lazily on the next query
+            connection.close()
+        else:
+            metrics.DB_CONNECTIONS_REUSED.labels(connection.alias).inc()
+    update_open_connections()
+
+
+def release_connections():
+    # At the end of a request: keeps this thread's connections for the next
+    # one, unless the alias already has more than DB_POOL_SIZE open
+    pool_size = getattr(settings, 'DB_POOL_SIZE', None)
+    counts = open_connections()
+    for connection in connections.all():
+        if connection.connection is None:
+            continue
+        if pool_size is not None and counts.get(connection.alias, 0) > pool_size:
+            connection.close()
+            counts[connection.alias] -= 1
+        else:
+            _last_used[connection] = time.monotonic()
+    update_open_connections()
+
+
+def open_connections():
+    with _lock:
+        wrappers = list(_wrappers)
+    counts = {}
+    for connection in wrappers:
+        if connection.connection is not None:
+            counts[connection.alias] = counts.get(connection.alias, 0) + 1
+    return counts
+
+
+def update_open_connections():
+    counts = open_connections()
+    for alias in connections:
+        metrics.DB_CONNECTIONS_OPEN.labels(alias).set(counts.get(alias, 0))
@@ -0,0 +1,74 @@
+from django.db.models import Count, Sum
+
+from .models import LINE_SUBTOTAL, LINE_TOTAL
+
+# Merges duplicate open carts so the one-open-cart constraints of migration
+# 0006 can be added. Takes an app registry (django.apps.apps or a migration's
+# historical one) and only uses plain model fields, so both can run it.
+
+
+def dedupe_open_carts(apps):
+    Order = apps.get_model('core', 'Order')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    PaymentJob = apps.get_model('core', 'PaymentJob')
+    Link = Order.items.through
+    users = set()
+
+    # Lines of paid orders used to stay ordered=False and look like cart lines
+    fixed_lines = OrderItem.objects.filter(ordered=False, order__ordered=True).update(ordered=True)
+
+    merged_orders = 0
+    duplicate_orders = Order.objects.filter(ordered=False).values('user_id') \
+        .annotate(open_orders=Count('pk')).filter(open_orders__gt=1)
+    for user_id in duplicate_orders.values_list('user_id', flat=True):
+        keep, *duplicates = Order.objects.filter(user_id=user_id, ordered=False).order_by('pk')
+        duplicate_pks = [order.pk for order in duplicates]
+        linked = set(Link.objects.filter(order_id=keep.pk).values_list('orderitem_id', flat=True))
+        moved = set(Link.objects.filter(order_id__in=duplicate_pks).values_list('orderitem_id', flat=True))
+        Link.objects.bulk_create([Link(order_id=keep.pk, orderitem_id=pk) for pk in moved - linked])
+        PaymentJob.objects.filter(order_id__in=duplicate_pks).update(order_id=keep.pk)
+        if keep.billing_address_id is None:
+            keep.billing_address_id = next(
+                (order.billing_address_id for order in duplicates if order.billing_address_id), None)
+            keep.save(update_fields=['billing_address'])
+        Order.objects.filter(pk__in=duplicate_pks).delete()
+        merged_orders += len(duplicates)
+        users.add(user_id)
+
+    merged_lines = 0
+    duplicate_lines = OrderItem.objects.filter(ordered=False).values('user_id', 'item_id') \
+        .annotate(open_lines=Count('pk')).filter(open_lines__gt=1)
+    for group in duplicate_lines.values('user_id', 'item_id'):
+        lines = list(OrderItem.objects.filter(ordered=False, **group).order_by('pk'))
+        keep, duplicates = lines[0], lines[1:]
+        links = list(Link.objects.filter(orderitem_id__in=[line.pk for line in lines]))
+        linked_pks = {link.orderitem_id for link in links}
+        # Lines removed from the cart (unlinked) don't count
+        quantity = sum(line.quantity for line in lines if line.pk in linked_pks)
+        if quantity:
+            keep.quantity = quantity
+            keep.save(update_fields=['quantity'])
+        Link.objects.filter(pk__in=[link.pk for link in links]).delete()
+        Link.objects.bulk_create([
+            Link(order_id=order_id, orderitem_id=keep.pk) for order_id in {link.order_id for link in links}])
+        OrderItem.objects.filter(pk__in=[line.pk for line in duplicates]).delete()
+        merged_lines += len(duplicates)
+        users.add(group['user_id'])
+
+    orders = Order.objects.filter(user_id__in=users, ordered=False).annotate(
+        calculated_subtotal=Sum(LINE_SUBTOTAL),
+        calculated_total=Sum(LINE_TOTAL),
+        calculated_item_count=Count('items'))
+    for order in orders:
+        order.subtotal = order.calculated_subtotal or 0
+        order.total = order.calculated_total or 0
+        order.discount = order.subtotal - order.total
+        order.item_count = order.calculated_item_count
+        order.save(update_fields=['subtotal', 'discount', 'total', 'item_count'])
+
+    return {
+        'fixed_lines': fixed_lines,
+        'merged_orders': merged_orders,
+        'merged_lines': merged_lines,
+        'users': users,
+    }
@@ -2,12 +2,23 @@ from django import forms
 from django_countries.fields import CountryField
 from django_countries.widgets import CountrySelectWidget
 
+from .fragments import render_cached_html
+
 PAYMENT_CHOICES = (
     ('S', 'Stripe'),
     ('P', 'Paypal')
 )
 
 
+class CachedCountrySelectWidget(CountrySelectWidget):
+    # ~250 translated, sorted <option>s, the same for everyone choosing the
+    # same country; cached in TEMPLATE_CACHE mode (see core/fragments.py)
+    def render(self, name, value, attrs=None, renderer=None):
+        return render_cached_html(
+            'country-select', [name, value, attrs, self.attrs],
+            lambda: super(CachedCountrySelectWidget, self).render(name, value, attrs, renderer))
+
+
 class CheckoutForm(forms.Form):
     street_address = forms.CharField(widget=forms.TextInput(attrs={
         'placeholder': '1234 Main Street',
@@ -17,7 +28,7 @@ class CheckoutForm(forms.Form):
         'placeholder': '1235 Main Street',
         'class': 'form-control'
     }))
-    country = CountryField(blank_label='(select country)').formfield(widget=CountrySelectWidget(attrs={
+    country = CountryField(blank_label='(select country)').formfield(widget=CachedCountrySelectWidget(attrs={
         'class': 'custom-select d-block w-100'
     }))
     zip = forms.CharField(widget=forms.TextInput(attrs={
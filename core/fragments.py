@@ -0,0 +1,119 @@
+import functools
+import hashlib
+import os
+import threading
+import uuid
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
+
+from . import metrics
+
+# Rendered catalog fragments (product cards, product details) are cached under
+# keys built from a version token of every Item they show. Saving or deleting
+# an Item gives it a new token (see signals.py), so exactly the fragments that
+# display it stop being used. Fragments never contain per-user content: the
+# navbar, messages and cart badge are rendered around them on every request.
+ITEM_VERSION_KEY = 'catalog:item-version:{}'
+FRAGMENT_TIMEOUT = 60 * 60 * 24
+
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def _new_version():
+    return uuid.uuid4().hex[:12]
+
+
+def get_item_versions(pks):
+    keys = {pk: ITEM_VERSION_KEY.format(pk) for pk in pks}
+    found = cache.get_many(keys.values())
+    versions = {}
+    missing = {}
+    for pk, key in keys.items():
+        if key in found:
+            versions[pk] = found[key]
+        else:
+            # an evicted token must never come back as an old value, so a
+            # missing one is replaced with a fresh token
+            versions[pk] = missing[key] = _new_version()
+    if missing:
+        cache.set_many(missing, None)
+    return versions
+
+
+def bump_item_version(pk):
+    cache.set(ITEM_VERSION_KEY.format(pk), _new_version(), None)
+
+
+def bump_item_versions(pks):
+    cache.set_many({ITEM_VERSION_KEY.format(pk): _new_version() for pk in pks}, None)
+
+
+def fragment_key(name, items):
+    versions = get_item_versions([item.pk for item in items])
+    parts = [f'{pk}.{version}' for pk, version in versions.items()]
+    # Catalog snapshot entries are keyed by their content as well, so a worker
+    # whose snapshot is still stale can't store old content under a new version
+    parts += [repr(tuple(item)) for item in items if isinstance(item, tuple)]
+    digest = hashlib.md5(','.join(parts).encode()).hexdigest()
+    return f'fragment:{name}:{get_language()}:{digest}'
+
+
+def _count(outcome):
+    with _stats_lock:
+        _stats[outcome] += 1
+
+
+def get_fragment_cache_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _get_or_render(key, render):
+    html = cache.get(key)
+    if html is None:
+        _count('misses')
+        metrics.record_cache('miss')
+        html = render()
+        cache.set(key, html, FRAGMENT_TIMEOUT)
+    else:
+        _count('hits')
+        metrics.record_cache('hit')
+    return mark_safe(html)
+
+
+def render_cached_fragment(name, template_name, items, context, request=None):
+    return _get_or_render(fragment_key(name, items),
+                          lambda: render_to_string(template_name, context, request))
+
+
+# Page chrome (navbar, footer, scripts) and the checkout country select only
+# change with a deploy, so in TEMPLATE_CACHE mode they are cached under a
+# version of the template files and the static bundle URLs they link to.
+@functools.lru_cache(maxsize=None)
+def template_version():
+    digest = hashlib.md5()
+    for engine in settings.TEMPLATES:
+        for directory in engine.get('DIRS', []):
+            for root, dirs, files in os.walk(directory):
+                dirs.sort()
+                for name in sorted(files):
+                    with open(os.path.join(root, name), 'rb') as f:
+                        digest.update(f.read())
+    for name in sorted(getattr(settings, 'STATIC_BUNDLES', {})):
+        digest.update(staticfiles_storage.url(name).encode())
+    return digest.hexdigest()[:12]
+
+
+def render_cached_html(name, vary_on, render):
+    # render() output cached per language and `vary_on` values, which must
+    # cover everything per-user or per-request the fragment shows
+    if not getattr(settings, 'TEMPLATE_CACHE', False):
+        return mark_safe(render())
+    digest = hashlib.md5(repr(list(vary_on)).encode()).hexdigest()
+    return _get_or_render(f'fragment:{name}:{template_version()}:{get_language()}:{digest}', render)
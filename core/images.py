@@ -0,0 +1,145 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from PIL import Image, ImageOps
+
+# Resized copies of Item.image, rendered by the responsive_image template tag.
+# Widths are in CSS pixels, every variant is also stored at 2x. They are
+# generated in worker processes; Item.derivatives_for is set by this process
+# once they exist, until then the original image is shown.
+VARIANTS = {
+    'card': 300,
+    'detail': 600,
+}
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+DERIVATIVES_DIR = 'derivatives'
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def derivative_name(name, variant, density, ext):
+    stem = os.path.splitext(name)[0]
+    suffix = variant if density == 1 else f'{variant}-{density}x'
+    return f'{DERIVATIVES_DIR}/{stem}-{suffix}.{ext}'
+
+
+def derivative_names(name):
+    return [derivative_name(name, variant, density, ext)
+            for variant in VARIANTS for density in (1, 2) for ext in FORMATS]
+
+
+def _encode(image, ext):
+    image_format, options = FORMATS[ext]
+    if image_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    buffer = BytesIO()
+    image.save(buffer, image_format, **options)
+    return ContentFile(buffer.getvalue())
+
+
+def generate_derivatives(name, force=False):
+    # Runs in a worker process; returns the number of files written
+    wanted = [n for n in derivative_names(name) if force or not default_storage.exists(n)]
+    if not wanted:
+        return 0
+    with default_storage.open(name) as f:
+        original = ImageOps.exif_transpose(Image.open(f))
+        original.load()
+    if original.mode not in ('RGB', 'RGBA'):
+        original = original.convert('RGBA' if 'transparency' in original.info else 'RGB')
+
+    written = 0
+    for variant, width in VARIANTS.items():
+        for density in (1, 2):
+            resized = None
+            for ext in FORMATS:
+                target = derivative_name(name, variant, density, ext)
+                if target not in wanted:
+                    continue
+                if resized is None:
+                    # thumbnail() keeps the aspect ratio and never upscales
+                    resized = original.copy()
+                    resized.thumbnail((width * density, width * density * 4), Image.LANCZOS)
+                if default_storage.exists(target):
+                    default_storage.delete(target)
+                default_storage.save(target, _encode(resized, ext))
+                written += 1
+    return written
+
+
+def mark_derivatives_ready(name):
+    # Imported here: spawned workers import this module before django.setup()
+    from .catalog import bump_catalog_version
+    from .fragments import bump_item_versions
+    from .models import Item
+
+    with transaction.atomic():
+        pks = list(Item.objects.filter(image=name).exclude(derivatives_for=name).values_list('pk', flat=True))
+        if pks:
+            Item.objects.filter(pk__in=pks).update(derivatives_for=name)
+            # update() sends no signals
+            bump_catalog_version()
+    bump_item_versions(pks)
+
+
+def _generate_now(name):
+    try:
+        generate_derivatives(name)
+    except Exception:
+        logger.exception('Could not generate derivatives of %s', name)
+        return
+    mark_derivatives_ready(name)
+
+
+def _derivatives_done(name, future):
+    # Called in a thread of this process when a worker has finished
+    try:
+        future.result()
+    except Exception:
+        logger.exception('Could not generate derivatives of %s', name)
+        return
+    try:
+        mark_derivatives_ready(name)
+    finally:
+        connections.close_all()
+
+
+def init_worker():
+    # Only needed where workers are spawned instead of forked
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=getattr(settings, 'IMAGE_DERIVATIVE_WORKERS', 2),
+            initializer=init_worker)
+    return _executor
+
+
+def schedule_derivatives(name):
+    # Generates the derivatives after the transaction that saved the image
+    # commits, in the process pool unless IMAGE_DERIVATIVES_ASYNC is off
+    if getattr(settings, 'IMAGE_DERIVATIVES_ASYNC', True):
+        def submit():
+            future = get_executor().submit(generate_derivatives, name)
+            future.add_done_callback(partial(_derivatives_done, name))
+        transaction.on_commit(submit)
+    else:
+        transaction.on_commit(lambda: _generate_now(name))
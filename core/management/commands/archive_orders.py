@@ -0,0 +1,63 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from core.models import ArchivedOrder, ArchivedOrderItem, Order, OrderItem
+
+ARCHIVED_FIELDS = ['user_id', 'start_date', 'ordered_date', 'billing_address_id', 'payment_id',
+                   'subtotal', 'discount', 'total', 'item_count']
+
+
+class Command(BaseCommand):
+    help = ('Moves completed orders older than --days into the archive tables, in batches. '
+            'Every batch is its own transaction, so an interrupted run can simply be restarted.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=180,
+                            help='Archive orders completed more than this many days ago')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Orders moved per transaction')
+        parser.add_argument('--limit', type=int,
+                            help='Stop after archiving this many orders')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches, to spare the database')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        orders = Order.objects.filter(ordered=True, ordered_date__lt=cutoff).order_by('pk')
+        archived = 0
+        while options['limit'] is None or archived < options['limit']:
+            size = options['batch_size']
+            if options['limit'] is not None:
+                size = min(size, options['limit'] - archived)
+            pks = list(orders.values_list('pk', flat=True)[:size])
+            if not pks:
+                break
+            archived += self.archive(pks)
+            self.stdout.write(f'Archived {archived} orders')
+            time.sleep(options['sleep'])
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} orders completed before {cutoff:%Y-%m-%d}'))
+
+    def archive(self, pks):
+        with transaction.atomic():
+            orders = list(Order.objects.select_for_update().filter(pk__in=pks, ordered=True))
+            links = list(Order.items.through.objects.filter(order_id__in=pks)
+                         .values_list('order_id', 'orderitem_id'))
+            order_items = OrderItem.objects.in_bulk([pk for _, pk in links])
+
+            ArchivedOrder.objects.bulk_create([
+                ArchivedOrder(id=order.pk, **{field: getattr(order, field) for field in ARCHIVED_FIELDS})
+                for order in orders])
+            ArchivedOrderItem.objects.bulk_create([
+                ArchivedOrderItem(order_id=order_id, item_id=order_items[pk].item_id,
+                                  quantity=order_items[pk].quantity, price=order_items[pk].price,
+                                  discount_price=order_items[pk].discount_price)
+                for order_id, pk in links])
+
+            # Also deletes the join rows and the orders' payment jobs
+            Order.objects.filter(pk__in=[order.pk for order in orders]).delete()
+            OrderItem.objects.filter(pk__in=order_items, order__isnull=True).delete()
+        return len(orders)
@@ -0,0 +1,66 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from core.benchmarks import generate_data, run_benchmark, run_render_benchmark
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the storefront views against a throwaway test database '
+            'filled with synthetic data and prints (or saves) the results as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=1000)
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--past-orders', type=int, default=5,
+                            help='Completed orders per user')
+        parser.add_argument('--cart-lines', type=int, default=15,
+                            help='Lines in every open cart')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Requests per view')
+        parser.add_argument('--templates', action='store_true',
+                            help='Also time rendering each template in the development '
+                                 'and the production (TEMPLATE_CACHE) template mode')
+        parser.add_argument('--output', help='Write the JSON results to this file')
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            started = time.monotonic()
+            users = generate_data(
+                items=options['items'],
+                users=options['users'],
+                past_orders=options['past_orders'],
+                cart_lines=options['cart_lines'])
+            self.stderr.write(f'Generated data in {time.monotonic() - started:.1f}s')
+            results = {
+                'scale': {k: options[k] for k in ('items', 'users', 'past_orders', 'cart_lines')},
+                'repeat': options['repeat'],
+                'views': run_benchmark(users[0], repeat=options['repeat']),
+            }
+            if options['templates']:
+                results['templates'] = run_render_benchmark(users[0], repeat=options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        for name, result in results['views'].items():
+            over = result['query_budget'] is not None and result['queries'] > result['query_budget']
+            line = (f"{name:32} p50 {result['p50_ms']:8.2f}ms  p99 {result['p99_ms']:8.2f}ms  "
+                    f"queries {result['queries']}/{result['query_budget']}")
+            self.stderr.write(self.style.ERROR(line) if over else line)
+        for name, result in results.get('templates', {}).items():
+            self.stderr.write(f"{name:32} p50 {result['development']['p50_ms']:8.2f}ms -> "
+                              f"{result['production']['p50_ms']:8.2f}ms  x{result['speedup']}")
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,43 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+
+from django.core.management.base import BaseCommand
+
+from core.images import generate_derivatives, init_worker, mark_derivatives_ready
+from core.models import Item
+
+
+class Command(BaseCommand):
+    help = 'Generates the resized WebP/JPEG variants of all item images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of worker processes (default: CPU count)')
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate variants that already exist')
+
+    def handle(self, *args, **options):
+        names = Item.objects.exclude(image='').exclude(image__isnull=True) \
+            .order_by().values_list('image', flat=True).distinct()
+        names = list(names)
+        started = time.monotonic()
+        written = failed = 0
+        generate = partial(generate_derivatives, force=options['force'])
+
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=init_worker) as pool:
+            futures = {pool.submit(generate, name): name for name in names}
+            for future in as_completed(futures):
+                try:
+                    written += future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'{futures[future]}: {e}')
+                else:
+                    # templates switch from the original to the variants
+                    mark_derivatives_ready(futures[future])
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed {len(names)} images ({failed} failed), '
+            f'wrote {written} files in {elapsed:.1f}s'))
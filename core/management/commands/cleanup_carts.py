@@ -0,0 +1,109 @@
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+
+from core.cart import invalidate_cart_item_count
+from core.models import Order, OrderItem
+from core.stock import release_order
+
+
+def average_row_bytes(table):
+    # Table plus index size per row, 0 when the backend can't tell
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT pg_total_relation_size(oid) / GREATEST(reltuples, 1) FROM pg_class WHERE oid = %s::regclass",
+                [table])
+            return cursor.fetchone()[0] or 0
+        if connection.vendor == 'sqlite':
+            try:
+                # dbstat is a compile-time option of SQLite
+                cursor.execute(
+                    "SELECT SUM(pgsize) FROM dbstat WHERE name IN "
+                    "(SELECT name FROM sqlite_master WHERE tbl_name = %s)", [table])
+            except DatabaseError:
+                return 0
+            size = cursor.fetchone()[0] or 0
+            cursor.execute(f'SELECT COUNT(*) FROM {connection.ops.quote_name(table)}')
+            return size / max(cursor.fetchone()[0], 1)
+    return 0
+
+
+class Command(BaseCommand):
+    help = ('Deletes open carts idle for more than --days (returning their reserved stock) and '
+            'order items no order refers to. Works in small transactions that skip rows in use, '
+            'so it can run while the shop serves traffic.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=getattr(settings, 'CART_TTL_DAYS', 30),
+                            help='Expire open carts not changed for this many days (default: CART_TTL_DAYS)')
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Carts or order items deleted per transaction')
+        parser.add_argument('--sleep', type=float, default=0.1,
+                            help='Seconds to pause between batches, to spare the database')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        # Reclaimed bytes are estimated from the average row size (with indexes)
+        # measured before deleting anything. The space is reused by new rows,
+        # the files only shrink after VACUUM.
+        row_bytes = {}
+        for model in (Order, Order.items.through, OrderItem):
+            row_bytes[model._meta.label] = average_row_bytes(model._meta.db_table)
+
+        deleted = Counter()
+        carts = self.run_batches(self.expire_carts, cutoff, deleted, options)
+        orphans = self.run_batches(self.delete_orphans, None, deleted, options)
+
+        reclaimed = sum(count * row_bytes.get(label, 0) for label, count in deleted.items())
+        for label, count in sorted(deleted.items()):
+            self.stdout.write(f'{label}: {count} rows')
+        self.stdout.write(self.style.SUCCESS(
+            f'Expired {carts} carts idle since {cutoff:%Y-%m-%d %H:%M}, deleted {orphans} orphaned order items: '
+            f'{sum(deleted.values())} rows, about {reclaimed:,.0f} bytes reclaimed'))
+
+    def run_batches(self, delete_batch, cutoff, deleted, options):
+        total = 0
+        while True:
+            count, rows = delete_batch(cutoff, options['batch_size'])
+            if not count:
+                return total
+            total += count
+            deleted.update(rows)
+            time.sleep(options['sleep'])
+
+    def expire_carts(self, cutoff, size):
+        with transaction.atomic():
+            # Carts being paid for are left alone, locked ones skipped
+            orders = list(Order.objects.select_for_update(skip_locked=True, of=('self',))
+                          .select_related('user')
+                          .filter(ordered=False, updated__lt=cutoff)
+                          .exclude(payment_jobs__status__in=['P', 'R'])
+                          .order_by('pk')[:size])
+            if not orders:
+                return 0, {}
+            line_pks = list(Order.items.through.objects.filter(order__in=orders)
+                            .values_list('orderitem_id', flat=True))
+            for order in orders:
+                release_order(order)
+                invalidate_cart_item_count(order.user)
+            _, rows = Order.objects.filter(pk__in=[order.pk for order in orders]).delete()
+            rows = Counter(rows)
+            rows.update(OrderItem.objects.filter(pk__in=line_pks).delete()[1])
+        return len(orders), rows
+
+    def delete_orphans(self, cutoff, size):
+        # Lines no order refers to, e.g. left by removing items from carts.
+        # Locking them keeps a cart view from reusing a line deleted here.
+        with transaction.atomic():
+            pks = list(OrderItem.objects.select_for_update(skip_locked=True, of=('self',))
+                       .filter(order__isnull=True).order_by('pk').values_list('pk', flat=True)[:size])
+            if not pks:
+                return 0, {}
+            _, rows = OrderItem.objects.filter(pk__in=pks, order__isnull=True).delete()
+        return rows.get(OrderItem._meta.label, 0), rows
@@ -0,0 +1,20 @@
+from django.apps import apps
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.cart import CART_ITEM_COUNT_VERSION_KEY
+from core.dedupe import dedupe_open_carts
+
+
+class Command(BaseCommand):
+    help = ('Merges duplicate open orders of a user and duplicate open lines of an item. '
+            'Migration 0006 does the same before adding the one-open-cart constraints.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            result = dedupe_open_carts(apps)
+        cache.delete_many([CART_ITEM_COUNT_VERSION_KEY.format(pk) for pk in result['users']])
+        self.stdout.write(self.style.SUCCESS(
+            f"Merged {result['merged_orders']} open orders and {result['merged_lines']} order lines "
+            f"of {len(result['users'])} users, marked {result['fixed_lines']} paid lines as ordered"))
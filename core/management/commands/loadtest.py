@@ -0,0 +1,41 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from core.benchmarks import run_load
+
+
+class Command(BaseCommand):
+    help = ('Measures the throughput of running servers under concurrent connections, '
+            'e.g. the WSGI and the ASGI deployment on the same hardware (both run the '
+            'same sync views). Run it from another machine, or it competes with the '
+            'servers for CPU.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', nargs='+',
+                            help='Base URLs of the servers, e.g. http://127.0.0.1:8000')
+        parser.add_argument('--path', action='append', dest='paths',
+                            help='Path to request, repeatable (default: /)')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50, 100],
+                            help='Numbers of concurrent connections to try')
+        parser.add_argument('--duration', type=float, default=10,
+                            help='Seconds per URL and concurrency')
+        parser.add_argument('--output', help='Write the JSON results to this file')
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or ['/']
+        results = []
+        for concurrency in options['concurrency']:
+            for url in options['url']:
+                result = run_load(url, paths, concurrency, options['duration'])
+                results.append(result)
+                line = (f"{url:32} c={concurrency:<4} {result['rps']:8.1f} req/s  "
+                        f"p50 {result['p50_ms']}ms  p99 {result['p99_ms']}ms  errors {result['errors']}")
+                self.stderr.write(self.style.ERROR(line) if result['errors'] else line)
+
+        output = json.dumps({'paths': paths, 'results': results}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
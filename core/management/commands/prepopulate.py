@@ -0,0 +1,217 @@
+import csv
+import json
+import sys
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.validators import validate_slug
+from django.db import transaction
+from django.db.models import Sum
+
+from core.catalog import bump_catalog_version
+from core.fragments import bump_item_versions
+from core.models import Item, Order, StockReservation, CATEGORY_CHOICES, LABEL_CHOICES, bulk_create_pks
+from core.search import index_items
+
+FIELDS = ['title', 'price', 'discount_price', 'category', 'label', 'description', 'image']
+
+
+def read_csv(f):
+    # csv.reader line numbers count physical lines, like the JSONL reader
+    reader = csv.DictReader(f)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def read_jsonl(f):
+    for line_num, line in enumerate(f, 1):
+        if line.strip():
+            try:
+                yield line_num, json.loads(line)
+            except ValueError as e:
+                yield line_num, e
+
+
+def parse_price(value, required):
+    if value in (None, ''):
+        if required:
+            raise ValidationError('price is required')
+        return None
+    try:
+        price = float(value)
+    except (TypeError, ValueError):
+        raise ValidationError(f'invalid price {value!r}')
+    if price < 0:
+        raise ValidationError(f'negative price {value!r}')
+    return price
+
+
+def parse_stock(value):
+    # Empty means the stock is not tracked
+    if value in (None, ''):
+        return None
+    try:
+        stock = int(value)
+    except (TypeError, ValueError):
+        raise ValidationError(f'invalid stock {value!r}')
+    if stock < 0:
+        raise ValidationError(f'negative stock {value!r}')
+    return stock
+
+
+def parse_text(row, field):
+    value = row.get(field)
+    if value is not None and not isinstance(value, str):
+        raise ValidationError(f'{field} must be a string, not {value!r}')
+    return value
+
+
+def clean_row(row):
+    if isinstance(row, Exception):
+        raise ValidationError(f'invalid JSON: {row}')
+    if not isinstance(row, dict):
+        raise ValidationError(f'expected an object, got {row!r}')
+    slug = (parse_text(row, 'slug') or '').strip()
+    validate_slug(slug)
+    title = (parse_text(row, 'title') or '').strip()
+    if not title or len(title) > 100:
+        raise ValidationError('title is required (max 100 characters)')
+    category = parse_text(row, 'category')
+    if category not in dict(CATEGORY_CHOICES):
+        raise ValidationError(f'unknown category {category!r}')
+    label = parse_text(row, 'label')
+    if label not in dict(LABEL_CHOICES):
+        raise ValidationError(f'unknown label {label!r}')
+    values = {
+        'title': title,
+        'price': parse_price(row.get('price'), required=True),
+        'discount_price': parse_price(row.get('discount_price'), required=False),
+        'category': category,
+        'label': label,
+        'description': parse_text(row, 'description') or None,
+        'image': parse_text(row, 'image') or None,
+    }
+    # Files without a stock column leave the stock of existing items alone
+    if 'stock' in row:
+        values['stock'] = parse_stock(row['stock'])
+    return slug, values
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Command(BaseCommand):
+    help = 'Streams a CSV or JSONL catalog file into Item rows, upserting on slug'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=getattr(settings, 'CATALOG_IMPORT_FILE', None),
+                            help='CSV or JSONL file, "-" for stdin (default: settings.CATALOG_IMPORT_FILE)')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='File format (default: from the file extension)')
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help='Rows per bulk_create/bulk_update batch')
+        parser.add_argument('--strict', action='store_true',
+                            help='Abort on the first invalid row instead of skipping it')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not path:
+            raise CommandError('No catalog file given and CATALOG_IMPORT_FILE is not set')
+        file_format = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+
+        if path == '-':
+            self.run(sys.stdin, file_format, options)
+        else:
+            with open(path, newline='', encoding='utf-8') as f:
+                self.run(f, file_format, options)
+
+    def run(self, f, file_format, options):
+        rows = read_jsonl(f) if file_format == 'jsonl' else read_csv(f)
+        started = time.monotonic()
+        self.created = self.updated = self.invalid = 0
+
+        for batch in batches(self.valid_rows(rows, options['strict']), options['batch_size']):
+            self.upsert(batch)
+            processed = self.created + self.updated
+            self.stdout.write(f'{processed} rows, {processed / (time.monotonic() - started):.0f} rows/s')
+
+        elapsed = time.monotonic() - started
+        processed = self.created + self.updated
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {self.created}, updated {self.updated}, skipped {self.invalid} invalid rows '
+            f'in {elapsed:.1f}s ({processed / elapsed if elapsed else processed:.0f} rows/s)'))
+
+    def valid_rows(self, rows, strict):
+        for line_num, row in rows:
+            try:
+                yield clean_row(row)
+            except ValidationError as e:
+                message = f'Line {line_num}: {"; ".join(e.messages)}'
+                if strict:
+                    raise CommandError(message)
+                self.invalid += 1
+                self.stderr.write(message)
+
+    def upsert(self, batch):
+        # The last row wins when a slug repeats within the batch
+        rows = dict(batch)
+        existing = {}
+        prices = {}
+        for slug, pk, price, discount_price in Item.objects.filter(slug__in=rows.keys()) \
+                .values_list('slug', 'pk', 'price', 'discount_price'):
+            existing[slug] = pk
+            prices[pk] = (price, discount_price)
+        to_create = []
+        to_update = []
+        to_update_stock = []
+        for slug, values in rows.items():
+            if slug not in existing:
+                to_create.append(Item(slug=slug, **values))
+            elif 'stock' in values:
+                to_update_stock.append(Item(pk=existing[slug], slug=slug, **values))
+            else:
+                to_update.append(Item(pk=existing[slug], slug=slug, **values))
+
+        with transaction.atomic():
+            created = bulk_create_pks(to_create, Item.objects.filter(slug__in=[item.slug for item in to_create]))
+            Item.objects.bulk_update(to_update, FIELDS)
+            self.subtract_reserved(to_update_stock)
+            Item.objects.bulk_update(to_update_stock, FIELDS + ['stock'])
+            Order.reprice_open_orders([
+                item.pk for item in to_update + to_update_stock
+                if prices[item.pk] != (item.price, item.discount_price)])
+            index_items(to_update + to_update_stock +
+                        list(Item.objects.filter(pk__in=created).only('title', 'description')))
+            bump_catalog_version()
+        to_update += to_update_stock
+        # bulk operations send no signals, so invalidate the cached fragments here
+        bump_item_versions([item.pk for item in to_update])
+        self.created += len(to_create)
+        self.updated += len(to_update)
+
+    def subtract_reserved(self, items):
+        # The stock column counts the units on hand, Item.stock the ones no
+        # cart holds (see core/stock.py). The item rows stay locked until the
+        # import commits, so reservations taken meanwhile wait and then
+        # decrement the imported stock.
+        items = [item for item in items if item.stock is not None]
+        if not items:
+            return
+        list(Item.objects.select_for_update().filter(pk__in=[item.pk for item in items]).values_list('pk'))
+        reserved = dict(StockReservation.objects.filter(item__in=[item.pk for item in items], quantity__gt=0)
+                        .values('item').annotate(reserved=Sum('quantity')).values_list('item', 'reserved'))
+        for item in items:
+            held = reserved.get(item.pk, 0)
+            if held > item.stock:
+                self.stderr.write(f'{item.slug}: stock {item.stock} is less than the {held} units '
+                                  f'reserved in carts, setting it to 0')
+            item.stock = max(item.stock - held, 0)
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.payments import run_pending
+
+
+class Command(BaseCommand):
+    help = 'Runs pending Stripe charges (payment jobs) outside the web workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Process the pending jobs and exit')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to sleep when the queue is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = run_pending()
+            if processed:
+                self.stdout.write(f'Processed {processed} payment jobs')
+            if options['once']:
+                break
+            time.sleep(options['interval'])
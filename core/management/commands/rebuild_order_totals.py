@@ -0,0 +1,66 @@
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.cart import CART_ITEM_COUNT_VERSION_KEY
+from core.models import Order
+
+TOTAL_FIELDS = ['subtotal', 'discount', 'total', 'item_count']
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds (or verifies) the stored subtotal/discount/total/item_count of orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help='Only report orders with stale totals, do not write')
+        parser.add_argument('--open-only', action='store_true',
+                            help='Only process open carts (ordered=False)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of orders written per UPDATE batch')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.all()
+        if options['open_only']:
+            orders = orders.filter(ordered=False)
+        orders = Order.with_calculated_totals(orders).order_by('pk')
+
+        checked = 0
+        stale = 0
+        batch = []
+        for order in orders.iterator():
+            checked += 1
+            subtotal = order.calculated_subtotal or 0
+            total = order.calculated_total or 0
+            expected = {
+                'subtotal': subtotal,
+                'discount': subtotal - total,
+                'total': total,
+                'item_count': order.calculated_item_count,
+            }
+            if any(round(getattr(order, f) - v, 2) != 0 for f, v in expected.items()):
+                if options['verify']:
+                    self.stdout.write(
+                        f'Order {order.pk}: stored total {order.total}, expected {total}')
+                stale += 1
+                for field, value in expected.items():
+                    setattr(order, field, value)
+                if not options['verify']:
+                    batch.append(order)
+            if len(batch) >= options['batch_size']:
+                self.save_batch(batch)
+                batch = []
+
+        if batch:
+            self.save_batch(batch)
+
+        if options['verify']:
+            style = self.style.WARNING if stale else self.style.SUCCESS
+            self.stdout.write(style(f'{stale} of {checked} orders have stale totals'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt totals of {stale} of {checked} orders'))
+
+    def save_batch(self, orders):
+        with transaction.atomic():
+            Order.objects.bulk_update(orders, TOTAL_FIELDS)
+        cache.delete_many([CART_ITEM_COUNT_VERSION_KEY.format(order.user_id) for order in orders])
@@ -0,0 +1,36 @@
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from core.models import Item
+from core.search import get_backend, index_items
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the product search index from the Item table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help='Items indexed per batch')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help='Database to rebuild the index in')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        connection = connections[using]
+        backend = get_backend(connection)
+        items = Item.objects.using(using).only('title', 'description').order_by('pk').iterator()
+        indexed = 0
+        # Rebuilt in one transaction, searches never see a half built index
+        with transaction.atomic(using=using):
+            with connection.cursor() as cursor:
+                backend.drop(cursor)
+                backend.create(cursor)
+            while True:
+                batch = list(islice(items, options['batch_size']))
+                if not batch:
+                    break
+                index_items(batch, using=using)
+                indexed += len(batch)
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} items'))
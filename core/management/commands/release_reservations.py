@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from core.stock import release_expired
+
+
+class Command(BaseCommand):
+    help = 'Returns the stock of expired (abandoned) cart reservations, e.g. from cron every minute'
+
+    def handle(self, *args, **options):
+        released = release_expired()
+        self.stdout.write(f'Released {released} reserved units')
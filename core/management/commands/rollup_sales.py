@@ -0,0 +1,31 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from core.reports import SETTLE_TIME, rollup_batch
+
+
+class Command(BaseCommand):
+    help = ('Adds new Payments to the daily SalesRollup rows. Every batch commits with its '
+            'checkpoint, so the command can run from cron and be interrupted at any time.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Payments rolled up per transaction')
+        parser.add_argument('--settle-minutes', type=float, default=SETTLE_TIME.total_seconds() / 60,
+                            help='Leave payments younger than this for the next run')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches, to spare the database')
+
+    def handle(self, *args, **options):
+        settle_time = timedelta(minutes=options['settle_minutes'])
+        processed = 0
+        while True:
+            rolled_up = rollup_batch(options['batch_size'], settle_time)
+            if not rolled_up:
+                break
+            processed += rolled_up
+            self.stdout.write(f'Rolled up {processed} payments')
+            time.sleep(options['sleep'])
+        self.stdout.write(self.style.SUCCESS(f'Rolled up {processed} new payments'))
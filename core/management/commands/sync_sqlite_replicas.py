@@ -0,0 +1,31 @@
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = 'Copies the SQLite primary database into the local read replicas (SQLITE_REPLICAS)'
+
+    def handle(self, *args, **options):
+        primary = connections['default'].settings_dict
+        if primary['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError('Only SQLite replicas are synced by this command')
+        replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+        if not replicas:
+            raise CommandError('No replicas configured, set SQLITE_REPLICAS')
+
+        source = sqlite3.connect(primary['NAME'])
+        try:
+            for alias in replicas:
+                # The backup API copies a consistent snapshot even while the
+                # development server writes to the primary
+                target = sqlite3.connect(connections[alias].settings_dict['NAME'])
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+                self.stdout.write(f'Synced {alias}')
+        finally:
+            source.close()
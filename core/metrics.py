@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+
+from django.template.base import Template
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess
+)
+
+# Per-view request metrics, collected by core.middleware.MetricsMiddleware and
+# served in the Prometheus text format by the core:metrics view. With several
+# worker processes, point the prometheus_multiproc_dir environment variable at
+# a shared, empty directory so every process's samples are aggregated.
+
+LATENCY = Histogram(
+    'storefront_request_latency_seconds', 'Request latency', ['view', 'method'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+REQUESTS = Counter(
+    'storefront_requests_total', 'Requests by status code', ['view', 'status'])
+DB_QUERIES = Histogram(
+    'storefront_request_db_queries', 'SQL queries per request', ['view'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100))
+DB_TIME = Histogram(
+    'storefront_request_db_seconds', 'Time spent in SQL per request', ['view'],
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 5))
+TEMPLATE_TIME = Histogram(
+    'storefront_request_template_seconds', 'Template render time per request', ['view'],
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1))
+CACHE = Counter(
+    'storefront_cache_total', 'Fragment cache lookups', ['view', 'outcome'])
+
+# Database connection pool, see core.db
+DB_CONNECTIONS_OPEN = Gauge(
+    'storefront_db_connections_open', 'Open persistent database connections', ['alias'],
+    multiprocess_mode='livesum')
+DB_CONNECTIONS_OPENED = Counter(
+    'storefront_db_connections_opened_total', 'New database connections', ['alias'])
+DB_CONNECTIONS_REUSED = Counter(
+    'storefront_db_connections_reused_total', 'Requests served by a reused connection', ['alias'])
+DB_HEALTH_CHECK_FAILURES = Counter(
+    'storefront_db_health_check_failures_total', 'Reused connections found broken', ['alias'])
+
+_local = threading.local()
+
+
+class RequestStats:
+    def __init__(self):
+        self.query_count = 0
+        self.queries = []  # (sql, seconds), the first QueryRecorder.max_recorded
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.cache = {'hit': 0, 'miss': 0}
+
+
+def start_request():
+    _local.stats = RequestStats()
+    return _local.stats
+
+
+def end_request():
+    _local.stats = None
+
+
+def current_stats():
+    return getattr(_local, 'stats', None)
+
+
+def record_cache(outcome):
+    stats = current_stats()
+    if stats is not None:
+        stats.cache[outcome] += 1
+
+
+class QueryRecorder:
+    # connection.execute_wrapper() callable; every query is counted, only
+    # the SQL of the first max_recorded is kept for the slow request log
+    max_recorded = 200
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            stats = current_stats()
+            if stats is not None:
+                elapsed = time.perf_counter() - started
+                stats.db_time += elapsed
+                stats.query_count += 1
+                if len(stats.queries) < self.max_recorded:
+                    stats.queries.append((sql, elapsed))
+
+
+_original_render = Template.render
+
+
+def _timed_render(self, context):
+    stats = current_stats()
+    if stats is None:
+        return _original_render(self, context)
+    # only the outermost template is timed, includes render inside it
+    stats.template_depth += 1
+    started = time.perf_counter()
+    try:
+        return _original_render(self, context)
+    finally:
+        stats.template_depth -= 1
+        if stats.template_depth == 0:
+            stats.template_time += time.perf_counter() - started
+
+
+def instrument_templates():
+    Template.render = _timed_render
+
+
+def observe(view, method, status, latency, stats):
+    LATENCY.labels(view, method).observe(latency)
+    REQUESTS.labels(view, str(status)).inc()
+    DB_QUERIES.labels(view).observe(stats.query_count)
+    DB_TIME.labels(view).observe(stats.db_time)
+    TEMPLATE_TIME.labels(view).observe(stats.template_time)
+    for outcome, count in stats.cache.items():
+        if count:
+            CACHE.labels(view, outcome).inc(count)
+
+
+def render_metrics():
+    if os.environ.get('prometheus_multiproc_dir'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
@@ -0,0 +1,48 @@
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from . import metrics
+
+slow_request_logger = logging.getLogger('core.slow_requests')
+
+
+class MetricsMiddleware:
+    """
+    Records latency, SQL query count and time, template render time and
+    fragment cache hits per resolved URL name (core:home, core:payment, ...),
+    and logs the SQL of requests slower than SLOW_REQUEST_THRESHOLD_MS.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_threshold = getattr(settings, 'SLOW_REQUEST_THRESHOLD_MS', 500) / 1000
+        metrics.instrument_templates()
+
+    def __call__(self, request):
+        stats = metrics.start_request()
+        recorder = metrics.QueryRecorder()
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(recorder))
+                response = self.get_response(request)
+            latency = time.perf_counter() - started
+            view = request.resolver_match.view_name if request.resolver_match else 'unresolved'
+            metrics.observe(view, request.method, response.status_code, latency, stats)
+            if latency >= self.slow_threshold:
+                self.log_slow_request(request, view, latency, stats)
+        finally:
+            metrics.end_request()
+        return response
+
+    def log_slow_request(self, request, view, latency, stats):
+        queries = '\n'.join(f'  {seconds * 1000:.1f}ms {sql}' for sql, seconds in stats.queries)
+        slow_request_logger.warning(
+            'Slow request %s %s (%s): %.0fms, %d queries in %.0fms, templates %.0fms\n%s',
+            request.method, request.path, view, latency * 1000, stats.query_count,
+            stats.db_time * 1000, stats.template_time * 1000, queries)
@@ -0,0 +1,32 @@
+# Generated by Django 3.0.7 on 2026-10-18 18:22
+
+from django.db import migrations, models
+
+
+def dedupe_open_carts(apps, schema_editor):
+    # Existing duplicates would make adding the constraints fail
+    from core.dedupe import dedupe_open_carts
+    dedupe_open_carts(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_archived_orders'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_open_carts, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(ordered=True), fields=['ordered_date'], name='order_completed_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(ordered=False), fields=('user',), name='one_open_order_per_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=models.UniqueConstraint(condition=models.Q(ordered=False), fields=('user', 'item'), name='one_open_order_item_per_user_item'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # Raw SQL per backend, see core/search.py
+    from core.search import get_backend, index_items
+    Item = apps.get_model('core', 'Item')
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        get_backend(connection).create(cursor)
+    index_items(Item.objects.using(connection.alias).only('title', 'description').iterator(),
+                using=connection.alias)
+
+
+def drop_search_index(apps, schema_editor):
+    from core.search import get_backend
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        get_backend(connection).drop(cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_catalog_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-18 18:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_order_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='derivatives_for',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+    ]
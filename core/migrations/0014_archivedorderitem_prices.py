@@ -0,0 +1,23 @@
+# Generated by Django 3.0.7 on 2026-10-18 19:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_orderitem_prices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedorderitem',
+            name='discount_price',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='archivedorderitem',
+            name='price',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
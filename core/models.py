@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models import Case, Count, ExpressionWrapper, F, Q, Sum, When
+from django.db.models.functions import Now
 from django.conf import settings
 from django.shortcuts import reverse
 from django_countries.fields import CountryField
@@ -16,6 +18,17 @@ LABEL_CHOICES = (
 )
 
 
+def bulk_create_pks(objs, created):
+    # bulk_create()s `objs` and returns their primary keys. Not every backend
+    # returns them from the INSERT, then they are read back from the
+    # `created` queryset, which must select exactly the new rows.
+    if not objs:
+        return []
+    type(objs[0]).objects.bulk_create(objs)
+    if all(obj.pk is not None for obj in objs):
+        return [obj.pk for obj in objs]
+    return list(created.values_list('pk', flat=True))
+
 
 # Displayed in list of items
 class Item(models.Model):
@@ -27,6 +40,18 @@ class Item(models.Model):
     slug = models.SlugField()
     description = models.TextField(blank=True, null=True)
     image = models.ImageField(blank=True, null=True)
+    # Image the resized variants were generated for (see core/images.py),
+    # the original is shown until they exist
+    derivatives_for = models.CharField(max_length=100, blank=True, default='')
+    # Units available to add to carts (not reserved), empty when not tracked
+    stock = models.PositiveIntegerField(blank=True, null=True)
+
+    class Meta:
+        # Category/label filters on the home page, paginated in id order
+        indexes = [
+            models.Index(fields=['category', 'id'], name='item_category_idx'),
+            models.Index(fields=['label', 'id'], name='item_label_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -46,6 +71,42 @@ class Item(models.Model):
             'slug': self.slug
         })
 
+    def get_unit_discount(self):
+        if self.discount_price:
+            return self.price - self.discount_price
+        return 0
+
+    @property
+    def has_derivatives(self):
+        return bool(self.image) and self.derivatives_for == self.image.name
+
+
+# Single row counting catalog changes, workers reload their in-memory
+# catalog snapshot when it moves (see core/catalog.py)
+class CatalogVersion(models.Model):
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return str(self.version)
+
+
+# Units of an item held for a user's open cart, see core/stock.py
+class StockReservation(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    quantity = models.IntegerField(default=0)
+    expires = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'item'], name='one_stock_reservation_per_user_item'),
+        ]
+        indexes = [
+            models.Index(fields=['expires'], condition=Q(quantity__gt=0), name='reservation_expires_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} of {self.item.title}"
 
 
 # Links Item and Order
@@ -54,6 +115,17 @@ class OrderItem(models.Model):
     ordered = models.BooleanField(default=False)
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.IntegerField(default=1)
+    # The item's prices the order is charged at, copied by the payment
+    # worker before charging (see core/payments.py); empty in carts
+    price = models.FloatField(blank=True, null=True)
+    discount_price = models.FloatField(blank=True, null=True)
+
+    class Meta:
+        constraints = [
+            # Also the index of the cart's (user, item, ordered=False) lookups
+            models.UniqueConstraint(fields=['user', 'item'], condition=Q(ordered=False),
+                                    name='one_open_order_item_per_user_item'),
+        ]
 
     def __str__(self):
         return f"{self.quantity} of {self.item.title}"
@@ -72,6 +144,18 @@ class OrderItem(models.Model):
             return self.get_total_discount_item_price()
         return self.get_total_item_price()
 
+# Price expressions used to recompute Order totals in SQL, relative to Order
+LINE_SUBTOTAL = ExpressionWrapper(
+    F('items__quantity') * F('items__item__price'),
+    output_field=models.FloatField())
+LINE_TOTAL = ExpressionWrapper(
+    F('items__quantity') * Case(
+        When(Q(items__item__discount_price__isnull=True) | Q(items__item__discount_price=0),
+             then=F('items__item__price')),
+        default=F('items__item__discount_price')),
+    output_field=models.FloatField())
+
+
 # You can link all OrderItems to Order
 # It's a shoping code
 class Order(models.Model):
@@ -82,15 +166,93 @@ class Order(models.Model):
     ordered = models.BooleanField(default=False)
     billing_address = models.ForeignKey('BillingAddress', on_delete=models.SET_NULL, blank=True, null=True)
     payment = models.ForeignKey('Payment', on_delete=models.SET_NULL, blank=True, null=True)
+    # Stored cart totals, kept in sync by the cart views (see update_totals)
+    subtotal = models.FloatField(default=0)
+    discount = models.FloatField(default=0)
+    total = models.FloatField(default=0)
+    item_count = models.IntegerField(default=0)
+    # Last change of the cart, abandoned carts expire (see cleanup_carts)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            # Also the index of the open cart lookup (user, ordered=False)
+            models.UniqueConstraint(fields=['user'], condition=Q(ordered=False),
+                                    name='one_open_order_per_user'),
+        ]
+        indexes = [
+            # Completed orders by date, for archiving and reports
+            models.Index(fields=['ordered_date'], condition=Q(ordered=True), name='order_completed_idx'),
+            # Idle open carts, for cleanup_carts
+            models.Index(fields=['updated'], condition=Q(ordered=False), name='order_open_updated_idx'),
+        ]
 
     def __str__(self):
         return self.user.username
 
     def get_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_final_price()
-        return total
+        return round(self.total, 2)
+
+    def get_amount_saved(self):
+        return round(self.discount, 2)
+
+    @staticmethod
+    def totals_delta(item, quantity=0, lines=0):
+        # UPDATE arguments applying a change of `quantity` units of `item`
+        # and `lines` order lines to the stored totals
+        unit_discount = item.get_unit_discount()
+        return {
+            'subtotal': F('subtotal') + quantity * item.price,
+            'discount': F('discount') + quantity * unit_discount,
+            'total': F('total') + quantity * (item.price - unit_discount),
+            'item_count': F('item_count') + lines,
+            'updated': Now(),
+        }
+
+    def update_totals(self, item, quantity=0, lines=0):
+        # Call inside the transaction that changes the order items
+        Order.objects.filter(pk=self.pk).update(**Order.totals_delta(item, quantity, lines))
+        self.refresh_from_db(fields=['subtotal', 'discount', 'total', 'item_count'])
+
+    @staticmethod
+    def with_calculated_totals(queryset):
+        # Annotates orders with totals computed from their items (one query)
+        return queryset.annotate(
+            calculated_subtotal=Sum(LINE_SUBTOTAL),
+            calculated_total=Sum(LINE_TOTAL),
+            calculated_item_count=Count('items')
+        )
+
+    def recalculate_totals(self, commit=True):
+        calculated = Order.with_calculated_totals(Order.objects.filter(pk=self.pk)).get()
+        self.subtotal = calculated.calculated_subtotal or 0
+        self.total = calculated.calculated_total or 0
+        self.discount = self.subtotal - self.total
+        self.item_count = calculated.calculated_item_count
+        if commit:
+            self.save(update_fields=['subtotal', 'discount', 'total', 'item_count', 'updated'])
+
+    @staticmethod
+    def reprice_open_orders(item_pks, batch_size=500):
+        # The cart views add and subtract the current price of an item, so
+        # open carts holding it must be recomputed when its price changes.
+        # Returns how many were.
+        holding = Order.objects.filter(ordered=False, items__item__in=item_pks).values('pk')
+        orders = Order.with_calculated_totals(Order.objects.filter(pk__in=holding)).order_by('pk')
+        batch = []
+        repriced = 0
+        for order in orders.iterator():
+            order.subtotal = order.calculated_subtotal or 0
+            order.total = order.calculated_total or 0
+            order.discount = order.subtotal - order.total
+            order.item_count = order.calculated_item_count
+            batch.append(order)
+            if len(batch) >= batch_size:
+                Order.objects.bulk_update(batch, ['subtotal', 'discount', 'total', 'item_count'])
+                repriced += len(batch)
+                batch = []
+        Order.objects.bulk_update(batch, ['subtotal', 'discount', 'total', 'item_count'])
+        return repriced + len(batch)
 
 class BillingAddress(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -111,3 +273,110 @@ class Payment(models.Model):
 
     def __str__(self):
         return self.user.username
+
+
+PAYMENT_JOB_STATUS_CHOICES = (
+    ('P', 'pending'),
+    ('R', 'processing'),
+    ('S', 'succeeded'),
+    ('F', 'failed')
+)
+
+
+# A charge waiting for (or done by) the payment worker, see core/payments.py
+class PaymentJob(models.Model):
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='payment_jobs')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    token = models.CharField(max_length=100)
+    amount = models.IntegerField()  # in grosze, as sent to Stripe
+    idempotency_key = models.CharField(max_length=64, unique=True)
+    status = models.CharField(choices=PAYMENT_JOB_STATUS_CHOICES, max_length=1, default='P')
+    attempts = models.IntegerField(default=0)
+    error = models.CharField(max_length=255, blank=True)
+    payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'updated'], name='paymentjob_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.idempotency_key} ({self.get_status_display()})"
+
+    def is_finished(self):
+        return self.status in ('S', 'F')
+
+
+# Completed orders moved out of the live Order/OrderItem tables by
+# `python manage.py archive_orders`, keeping their original Order id
+class ArchivedOrder(models.Model):
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='archived_orders')
+    start_date = models.DateTimeField()
+    ordered_date = models.DateTimeField()
+    billing_address = models.ForeignKey('BillingAddress', on_delete=models.SET_NULL, blank=True, null=True)
+    payment = models.ForeignKey('Payment', on_delete=models.SET_NULL, blank=True, null=True)
+    subtotal = models.FloatField(default=0)
+    discount = models.FloatField(default=0)
+    total = models.FloatField(default=0)
+    item_count = models.IntegerField(default=0)
+    archived = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'ordered_date'], name='archivedorder_user_idx'),
+        ]
+
+    def __str__(self):
+        return self.user.username
+
+    def get_total(self):
+        return round(self.total, 2)
+
+
+class ArchivedOrderItem(models.Model):
+    order = models.ForeignKey(ArchivedOrder, on_delete=models.CASCADE, related_name='items')
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    quantity = models.IntegerField(default=1)
+    # OrderItem.price and discount_price, empty for orders paid before they existed
+    price = models.FloatField(blank=True, null=True)
+    discount_price = models.FloatField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.quantity} of {self.item.title}"
+
+
+# Daily sales per item, added up incrementally from new Payments by
+# `python manage.py rollup_sales` (see core/reports.py). The category is
+# copied in, so per-category reports read only this table.
+class SalesRollup(models.Model):
+    day = models.DateField()
+    item = models.ForeignKey(Item, on_delete=models.SET_NULL, blank=True, null=True)
+    category = models.CharField(choices=CATEGORY_CHOICES, max_length=2)
+    orders = models.IntegerField(default=0)
+    units = models.IntegerField(default=0)
+    revenue = models.FloatField(default=0)
+    discount = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'item'], name='one_sales_rollup_per_day_item'),
+        ]
+        indexes = [
+            models.Index(fields=['category', 'day'], name='salesrollup_category_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.day}: {self.units} of {self.item_id}"
+
+
+# How far an incremental job got, e.g. the last Payment rolled up
+class ReportCheckpoint(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.last_id}"
@@ -0,0 +1,117 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as DecodeError
+from bisect import bisect_left, bisect_right
+
+from django.conf import settings
+from django.http import Http404
+from django.utils.translation import gettext as _
+
+
+def encode_cursor(direction, value):
+    return urlsafe_b64encode(f'{direction}:{value}'.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        direction, value = urlsafe_b64decode(padded.encode()).decode().split(':', 1)
+        if direction not in ('n', 'p'):
+            raise ValueError
+        return direction, int(value)
+    except (DecodeError, UnicodeDecodeError, ValueError):
+        raise Http404(_('Invalid cursor.'))
+
+
+class KeysetPage:
+    # Quacks like django.core.paginator.Page where the templates need it,
+    # plus the opaque cursors of the neighbouring pages
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginationMixin:
+    """
+    Opt-in keyset (cursor) pagination for ListViews. Pages are read with
+    `WHERE key > last_key ORDER BY key LIMIT n`, so deep pages cost the same
+    as the first one and no COUNT(*) is issued. `keyset_field` must be unique
+    and indexed (together with any filter columns). In-memory lists ordered
+    by `keyset_field` (the catalog snapshot) are paginated the same way.
+    """
+    keyset_pagination = None  # None follows settings.KEYSET_PAGINATION
+    keyset_field = 'id'
+    cursor_kwarg = 'cursor'
+
+    def get_keyset_pagination(self):
+        if self.keyset_pagination is None:
+            return getattr(settings, 'KEYSET_PAGINATION', False)
+        return self.keyset_pagination
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.get_keyset_pagination():
+            return super().paginate_queryset(queryset, page_size)
+
+        field = self.keyset_field
+        cursor = self.request.GET.get(self.cursor_kwarg)
+        direction, value = decode_cursor(cursor) if cursor else ('n', None)
+
+        if direction == 'n':
+            rows = self.keyset_rows(queryset, value, page_size + 1)
+            has_more = len(rows) > page_size
+            rows = rows[:page_size]
+            has_next, has_previous = has_more, value is not None
+        else:
+            rows = self.keyset_rows(queryset, value, page_size + 1, backwards=True)
+            has_more = len(rows) > page_size
+            rows = rows[:page_size][::-1]
+            has_next, has_previous = True, has_more
+
+        page = KeysetPage(
+            rows,
+            next_cursor=encode_cursor('n', getattr(rows[-1], field)) if rows and has_next else None,
+            previous_cursor=encode_cursor('p', getattr(rows[0], field)) if rows and has_previous else None,
+        )
+        return (None, page, rows, page.has_other_pages())
+
+    def keyset_rows(self, queryset, value, limit, backwards=False):
+        # Up to `limit` rows after `value` (before it, nearest first, when
+        # going backwards)
+        field = self.keyset_field
+        if isinstance(queryset, (list, tuple)):
+            keys = self.keyset_keys(queryset)
+            if backwards:
+                end = bisect_left(keys, value)
+                return queryset[max(0, end - limit):end][::-1]
+            start = 0 if value is None else bisect_right(keys, value)
+            return list(queryset[start:start + limit])
+        if backwards:
+            return list(queryset.filter(**{f'{field}__lt': value}).order_by(f'-{field}')[:limit])
+        if value is not None:
+            queryset = queryset.filter(**{f'{field}__gt': value})
+        return list(queryset.order_by(field)[:limit])
+
+    def keyset_keys(self, rows):
+        # The `keyset_field` values of an in-memory list; views paginating a
+        # cached list should return keys cached along with it
+        return [getattr(row, self.keyset_field) for row in rows]
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['keyset_pagination'] = self.get_keyset_pagination()
+        return context
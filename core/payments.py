@@ -0,0 +1,261 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import stripe
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+
+from .cart import invalidate_cart_item_count
+from .models import Item, Order, OrderItem, Payment, PaymentJob
+from .stock import confirm_order, release_order
+
+# Stripe charges run outside the request thread: PaymentView only stores a
+# PaymentJob and the client polls its status page. Jobs are executed by a
+# small thread pool in the web process (PAYMENT_JOBS_IN_PROCESS) and/or by
+# `python manage.py process_payments` workers. Every job charges with its own
+# idempotency key, so re-running a job that died mid-charge can't charge twice.
+# The cart can't change while its job is pending or running (see
+# core.cart.check_no_payment_in_progress). Before charging, the worker copies
+# the item prices onto the order lines and checks they still add up to the
+# job's amount, so a price change in between fails the job instead of
+# charging a stale amount.
+STALE_JOB_AFTER = timedelta(minutes=2)
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 1
+
+logger = logging.getLogger(__name__)
+_executor = None
+
+
+class StripeBackend:
+    def charge(self, amount, token, idempotency_key, description):
+        stripe.api_key = settings.STRIPE_SECRET_KEY
+        return stripe.Charge.create(
+            amount=amount,
+            currency='pln',
+            source=token,
+            description=description,
+            idempotency_key=idempotency_key
+        )
+
+
+class FakeStripeBackend:
+    """
+    Offline stand-in for Stripe, for development and load tests. Honours
+    idempotency keys like Stripe does and declines the `tok_chargeDeclined`
+    test token. PAYMENT_FAKE_LATENCY (seconds) simulates a slow API.
+    """
+    _charges = {}
+    _lock = threading.Lock()
+
+    def charge(self, amount, token, idempotency_key, description):
+        time.sleep(getattr(settings, 'PAYMENT_FAKE_LATENCY', 0))
+        if token == 'tok_chargeDeclined':
+            raise stripe.error.CardError('Your card was declined.', None, 'card_declined',
+                                         json_body={'error': {'message': 'Twoja karta została odrzucona.'}})
+        with self._lock:
+            if idempotency_key not in self._charges:
+                self._charges[idempotency_key] = {
+                    'id': f'ch_fake_{uuid.uuid4().hex[:20]}',
+                    'amount': amount,
+                    'source': token,
+                }
+            return self._charges[idempotency_key]
+
+    @classmethod
+    def charge_count(cls):
+        return len(cls._charges)
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._charges.clear()
+
+
+def get_backend():
+    if getattr(settings, 'PAYMENT_BACKEND', 'stripe') == 'fake':
+        return FakeStripeBackend()
+    return StripeBackend()
+
+
+def enqueue_payment(order, token):
+    # Returns the order's active (or already successful) job instead of
+    # creating a second one, so a double submit can't charge twice
+    with transaction.atomic():
+        order = Order.objects.select_for_update().get(pk=order.pk)
+        # Charge what the lines cost now, not the running totals of the cart views
+        order.recalculate_totals()
+        amount = int(round(order.get_total() * 100))
+        job = order.payment_jobs.exclude(status='F').first()
+        if job is not None:
+            # A job for an outdated amount (a price changed) is replaced, but
+            # only if it was never tried: a tried one may have charged already
+            # and is checked by the worker instead
+            if job.amount == amount or not PaymentJob.objects \
+                    .filter(pk=job.pk, status='P', attempts=0) \
+                    .update(status='F', error=CART_CHANGED_MESSAGE):
+                return job
+        attempt = order.payment_jobs.count() + 1
+        job = PaymentJob.objects.create(
+            order=order,
+            user=order.user,
+            token=token or '',
+            amount=amount,
+            idempotency_key=f'order-{order.pk}-{attempt}'
+        )
+        if getattr(settings, 'PAYMENT_JOBS_IN_PROCESS', True):
+            transaction.on_commit(lambda: get_executor().submit(run_job, job.pk))
+    return job
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'PAYMENT_WORKER_THREADS', 2),
+            thread_name_prefix='payments')
+    return _executor
+
+
+def claim_job(pk=None):
+    # Marks one runnable job as processing: a pending one, or one whose
+    # worker died while processing it
+    stale = timezone.now() - STALE_JOB_AFTER
+    with transaction.atomic():
+        jobs = PaymentJob.objects.select_for_update(skip_locked=True) \
+            .filter(Q(status='P') | Q(status='R', updated__lt=stale)) \
+            .order_by('pk')
+        if pk is not None:
+            jobs = jobs.filter(pk=pk)
+        job = jobs.first()
+        if job is None:
+            return None
+        job.status = 'R'
+        job.attempts += 1
+        job.save(update_fields=['status', 'attempts', 'updated'])
+    return job
+
+
+CART_CHANGED_MESSAGE = "Ceny w koszyku zmieniły się. Sprawdź zamówienie i spróbuj jeszcze raz"
+
+
+class CartChanged(Exception):
+    pass
+
+
+def charge_error_message(e):
+    if isinstance(e, CartChanged):
+        return CART_CHANGED_MESSAGE
+    if isinstance(e, stripe.error.CardError):
+        return f"{(e.json_body or {}).get('error', {}).get('message')}"
+    if isinstance(e, stripe.error.RateLimitError):
+        return "Osiągnięto limit zamówień"
+    if isinstance(e, stripe.error.InvalidRequestError):
+        return "Nieprawidłowe dane"
+    if isinstance(e, stripe.error.AuthenticationError):
+        return "Błąd podczas uwierzytelniania"
+    if isinstance(e, stripe.error.APIConnectionError):
+        return "Błąd połączenia z siecią"
+    if isinstance(e, stripe.error.StripeError):
+        return "Coś poszło nie tak. Spróbuj jeszcze raz"
+    return "Niespodziewany błąd. Proszę skontaktuj się z administratorem"
+
+
+def fix_line_prices(job):
+    # Copies the item prices onto the order lines that have none yet and
+    # returns the amount in grosze they add up to. A retried job keeps the
+    # prices of its first attempt, which may have charged already.
+    with transaction.atomic():
+        order = Order.objects.select_for_update().get(pk=job.order_id)
+        item = Item.objects.filter(pk=OuterRef('item_id'))
+        OrderItem.objects.filter(order=order, price__isnull=True).update(
+            price=Subquery(item.values('price')[:1]),
+            discount_price=Subquery(item.values('discount_price')[:1]))
+        total = sum(quantity * (discount_price or price) for quantity, price, discount_price
+                    in order.items.values_list('quantity', 'price', 'discount_price'))
+    return int(round(round(total, 2) * 100))
+
+
+def process_job(job):
+    if fix_line_prices(job) != job.amount:
+        return fail_job(job, CartChanged())
+    try:
+        charge = get_backend().charge(
+            amount=job.amount,
+            token=job.token,
+            idempotency_key=job.idempotency_key,
+            description=f"Order {job.order_id}"
+        )
+    except (stripe.error.RateLimitError, stripe.error.APIConnectionError) as e:
+        if job.attempts < MAX_ATTEMPTS:
+            # Transient, retried with the same idempotency key
+            logger.warning('Payment job %s will be retried: %s', job.pk, e)
+            job.status = 'P'
+            job.save(update_fields=['status', 'updated'])
+            return job
+        return fail_job(job, e)
+    except Exception as e:
+        if not isinstance(e, stripe.error.StripeError):
+            logger.exception('Payment job %s failed', job.pk)
+        return fail_job(job, e)
+
+    with transaction.atomic():
+        order = Order.objects.select_for_update().get(pk=job.order_id)
+        payment, created = Payment.objects.get_or_create(
+            stripe_charge_id=charge['id'],
+            defaults={'user': job.user, 'amount': job.amount / 100}
+        )
+        order.ordered = True
+        order.ordered_date = timezone.now()
+        order.payment = payment
+        order.save()
+        order.items.update(ordered=True)
+        confirm_order(order)
+        job.status = 'S'
+        job.payment = payment
+        job.save(update_fields=['status', 'payment', 'updated'])
+        invalidate_cart_item_count(job.user)
+    return job
+
+
+def fail_job(job, error):
+    with transaction.atomic():
+        job.status = 'F'
+        job.error = charge_error_message(error)[:255]
+        job.save(update_fields=['status', 'error', 'updated'])
+        # Back to stock until the next attempt reserves them again
+        release_order(job.order)
+        # The next job charges the prices of its own time
+        OrderItem.objects.filter(order=job.order_id).update(price=None, discount_price=None)
+    return job
+
+
+def run_job(pk):
+    # Entry point of the in-process executor threads
+    try:
+        job = claim_job(pk)
+        while job is not None:
+            job = process_job(job)
+            if job.status != 'P':
+                break
+            time.sleep(RETRY_DELAY * job.attempts)
+            job = claim_job(pk)
+    finally:
+        connections.close_all()
+
+
+def run_pending(limit=None):
+    processed = 0
+    while limit is None or processed < limit:
+        job = claim_job()
+        if job is None:
+            break
+        process_job(job)
+        processed += 1
+    return processed
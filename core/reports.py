@@ -0,0 +1,200 @@
+import csv
+import json
+from datetime import date, datetime, timedelta
+
+from django.db import transaction
+from django.db.models import Case, F, Q, Sum, When
+from django.utils import timezone
+
+from .models import ArchivedOrderItem, Order, Payment, ReportCheckpoint, SalesRollup
+
+# Sales rollups: every Payment is added to the SalesRollup rows of its day
+# exactly once, in the transaction that moves the 'sales-rollup' checkpoint
+# past it, so an interrupted run just continues where it stopped. Orders
+# moved to the archive tables are included. Lines are priced at the prices
+# the payment worker pinned on them before charging. Lines paid before those
+# existed fall back to their item's current price, scaled so that each
+# order's lines add up to the amount actually paid.
+ROLLUP_CHECKPOINT = 'sales-rollup'
+# Payments are picked in pk order. A payment whose transaction commits after
+# a newer one would be skipped, so the newest ones are left for the next run.
+SETTLE_TIME = timedelta(minutes=5)
+
+
+def paid_lines(payment_pks):
+    # (payment pk, order pk, item pk, category, quantity, price, discount price)
+    # of the orders paid by `payment_pks`, live and archived. Lines without
+    # pinned prices get their item's.
+    fields = ['item__category', 'item__price', 'item__discount_price', 'price', 'discount_price']
+    live = Order.items.through.objects.filter(order__payment_id__in=payment_pks).values_list(
+        'order__payment_id', 'order_id', 'orderitem__item_id',
+        *[f'orderitem__{field}' for field in fields], 'orderitem__quantity')
+    archived = ArchivedOrderItem.objects.filter(order__payment_id__in=payment_pks).values_list(
+        'order__payment_id', 'order_id', 'item_id', *fields, 'quantity')
+    for rows in (live, archived):
+        for payment_pk, order_pk, item_pk, category, item_price, item_discount_price, price, discount_price, \
+                quantity in rows:
+            if price is None:
+                price, discount_price = item_price, item_discount_price
+            yield payment_pk, order_pk, item_pk, category, quantity, price, discount_price
+
+
+def rollup_payments(payments):
+    # {(day, item pk): row} of the new SalesRollup values for `payments`
+    days = {payment.pk: timezone.localdate(payment.timestamp) for payment in payments}
+    amounts = {payment.pk: payment.amount for payment in payments}
+    lines = {}
+    for line in paid_lines(list(days)):
+        lines.setdefault(line[0], []).append(line)
+    deltas = {}
+    orders = {}
+    for payment_pk, payment_lines in lines.items():
+        total = sum(quantity * (discount_price or price) for *_, quantity, price, discount_price in payment_lines)
+        # Lines priced at today's prices don't add up to what was paid
+        scale = amounts[payment_pk] / total if total and round(total, 2) != round(amounts[payment_pk], 2) else 1
+        for _, order_pk, item_pk, category, quantity, price, discount_price in payment_lines:
+            key = (days[payment_pk], item_pk)
+            row = deltas.setdefault(key, {'category': category, 'units': 0, 'revenue': 0, 'discount': 0})
+            paid = quantity * (discount_price or price) * scale
+            row['units'] += quantity
+            row['revenue'] += paid
+            row['discount'] += quantity * price - paid
+            orders.setdefault(key, set()).add(order_pk)
+    for key, row in deltas.items():
+        row['orders'] = len(orders[key])
+    return deltas
+
+
+def rollup_batch(batch_size, settle_time=SETTLE_TIME):
+    # Rolls up the next batch of payments, returns how many there were
+    with transaction.atomic():
+        checkpoint, _ = ReportCheckpoint.objects.get_or_create(name=ROLLUP_CHECKPOINT)
+        # Serializes concurrent runs
+        checkpoint = ReportCheckpoint.objects.select_for_update().get(pk=checkpoint.pk)
+        payments = list(Payment.objects.filter(pk__gt=checkpoint.last_id,
+                                               timestamp__lt=timezone.now() - settle_time)
+                        .order_by('pk').only('pk', 'timestamp', 'amount')[:batch_size])
+        if not payments:
+            return 0
+        deltas = rollup_payments(payments)
+
+        existing = {}
+        days = {day for day, item_pk in deltas}
+        item_pks = {item_pk for day, item_pk in deltas}
+        for rollup in SalesRollup.objects.filter(day__in=days, item_id__in=item_pks):
+            existing[(rollup.day, rollup.item_id)] = rollup
+        to_create = []
+        to_update = []
+        for (day, item_pk), row in deltas.items():
+            rollup = existing.get((day, item_pk))
+            if rollup is None:
+                to_create.append(SalesRollup(day=day, item_id=item_pk, **row))
+                continue
+            for field in ('orders', 'units', 'revenue', 'discount'):
+                setattr(rollup, field, getattr(rollup, field) + row[field])
+            to_update.append(rollup)
+        SalesRollup.objects.bulk_create(to_create)
+        SalesRollup.objects.bulk_update(to_update, ['orders', 'units', 'revenue', 'discount'])
+
+        checkpoint.last_id = payments[-1].pk
+        checkpoint.save(update_fields=['last_id', 'updated'])
+    return len(payments)
+
+
+# Export rows, as (header, row iterator). The querysets are streamed with
+# iterator(), a server-side cursor on Postgres, so memory use doesn't grow
+# with the number of rows.
+EXPORT_CHUNK_SIZE = 2000
+
+
+def _in_period(queryset, field, start, end):
+    # [start, end) dates, datetime fields count from local midnight
+    for lookup, day in (('gte', start), ('lt', end)):
+        if day is not None:
+            if field != 'day':
+                day = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+            queryset = queryset.filter(**{f'{field}__{lookup}': day})
+    return queryset
+
+
+def item_report(start=None, end=None):
+    rows = _in_period(SalesRollup.objects.all(), 'day', start, end).order_by('day', 'item_id').values_list(
+        'day', 'item_id', 'item__slug', 'category', 'orders', 'units', 'revenue', 'discount')
+    header = ['day', 'item_id', 'slug', 'category', 'orders', 'units', 'revenue', 'discount']
+    return header, rows.iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def category_report(start=None, end=None):
+    rows = _in_period(SalesRollup.objects.all(), 'day', start, end).order_by('day', 'category') \
+        .values('day', 'category') \
+        .annotate(units=Sum('units'), revenue=Sum('revenue'), discount=Sum('discount')) \
+        .values_list('day', 'category', 'units', 'revenue', 'discount')
+    header = ['day', 'category', 'units', 'revenue', 'discount']
+    return header, rows.iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def _charged_prices(prefix=''):
+    # The line's pinned prices, or its item's current ones for lines paid
+    # before they were pinned
+    unpinned = Q(**{f'{prefix}price__isnull': True})
+    return [
+        Case(When(unpinned, then=F(f'{prefix}item__price')), default=F(f'{prefix}price')),
+        Case(When(unpinned, then=F(f'{prefix}item__discount_price')), default=F(f'{prefix}discount_price')),
+    ]
+
+
+def line_report(start=None, end=None):
+    # Every paid order line, for ad-hoc analysis outside the database. Lines
+    # paid before the prices were pinned show their item's current prices.
+    header = ['paid', 'payment_id', 'order_id', 'item_id', 'slug', 'category', 'quantity',
+              'price', 'discount_price', 'archived']
+    live = _in_period(Order.items.through.objects.filter(order__payment__isnull=False),
+                      'order__payment__timestamp', start, end) \
+        .order_by('order__payment_id', 'pk').values_list(
+            'order__payment__timestamp', 'order__payment_id', 'order_id', 'orderitem__item_id',
+            'orderitem__item__slug', 'orderitem__item__category', 'orderitem__quantity',
+            *_charged_prices('orderitem__'))
+    archived = _in_period(ArchivedOrderItem.objects.filter(order__payment__isnull=False),
+                          'order__payment__timestamp', start, end) \
+        .order_by('order__payment_id', 'pk').values_list(
+            'order__payment__timestamp', 'order__payment_id', 'order_id', 'item_id',
+            'item__slug', 'item__category', 'quantity', *_charged_prices())
+
+    def rows():
+        for row in archived.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+            yield row + (True,)
+        for row in live.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+            yield row + (False,)
+
+    return header, rows()
+
+
+REPORTS = {
+    'items': item_report,
+    'categories': category_report,
+    'lines': line_report,
+}
+
+
+def _plain(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def write_csv(stream, header, rows):
+    writer = csv.writer(stream)
+    writer.writerow(header)
+    count = 0
+    for row in rows:
+        writer.writerow([_plain(value) for value in row])
+        count += 1
+    return count
+
+
+def write_jsonl(stream, header, rows):
+    count = 0
+    for row in rows:
+        stream.write(json.dumps(dict(zip(header, map(_plain, row))), ensure_ascii=False) + '\n')
+        count += 1
+    return count
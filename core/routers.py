@@ -0,0 +1,107 @@
+import logging
+import random
+import threading
+import time
+from contextlib import ContextDecorator
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+# Sends reads of the catalog models to a read replica while a catalog view
+# runs (see replica_reads), everything else to the primary. Once a request
+# writes anything, or while it is inside a transaction on the primary, its
+# reads stay on the primary so it always sees its own writes. Replicas lagging
+# more than REPLICA_MAX_LAG seconds (or unreachable) are skipped until the
+# next lag check; with no usable replica reads fall back to the primary.
+
+logger = logging.getLogger(__name__)
+_state = threading.local()
+_lag = {}  # alias -> (checked at, lag in seconds)
+_lag_lock = threading.Lock()
+
+LAG_SQL = (
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+class replica_reads(ContextDecorator):
+    def __enter__(self):
+        self.previous = getattr(_state, 'reads', None)
+        _state.reads = {'replica': True, 'alias': None}
+
+    def __exit__(self, *exc):
+        _state.reads = self.previous
+
+
+class ReplicaReadMixin:
+    def dispatch(self, request, *args, **kwargs):
+        with replica_reads():
+            response = super().dispatch(request, *args, **kwargs)
+            # TemplateResponses are rendered after the view returns
+            if hasattr(response, 'render'):
+                response.render()
+        return response
+
+
+def pin_to_primary():
+    reads = getattr(_state, 'reads', None)
+    if reads is not None:
+        reads['replica'] = False
+
+
+def replica_lag(alias):
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        # Local SQLite copies made by sync_sqlite_replicas, no lag to measure
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(LAG_SQL)
+        return float(cursor.fetchone()[0])
+
+
+def current_lag(alias):
+    now = time.monotonic()
+    checked, lag = _lag.get(alias, (None, None))
+    if checked is None or now - checked > getattr(settings, 'REPLICA_LAG_CHECK_INTERVAL', 5):
+        try:
+            lag = replica_lag(alias)
+        except DatabaseError:
+            logger.warning('Replica %s is unavailable', alias, exc_info=True)
+            lag = float('inf')
+        with _lag_lock:
+            _lag[alias] = (now, lag)
+    return lag
+
+
+def choose_replica():
+    max_lag = getattr(settings, 'REPLICA_MAX_LAG', 5)
+    replicas = [alias for alias in getattr(settings, 'DATABASE_REPLICAS', [])
+                if current_lag(alias) <= max_lag]
+    return random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        reads = getattr(_state, 'reads', None)
+        if reads is None or not reads['replica']:
+            return DEFAULT_DB_ALIAS
+        if model._meta.label_lower not in getattr(settings, 'REPLICA_MODELS', []):
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        # One replica per request, so its reads are consistent with each other
+        if reads['alias'] is None:
+            reads['alias'] = choose_replica()
+        return reads['alias']
+
+    def db_for_write(self, model, **hints):
+        pin_to_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in getattr(settings, 'DATABASE_REPLICAS', [])
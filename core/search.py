@@ -0,0 +1,145 @@
+import re
+import unicodedata
+
+from django.db import NotSupportedError, connections, router
+
+from .models import Item
+
+# Full-text index of Item.title and Item.description in the core_item_search
+# table: an FTS5 table on SQLite, a tsvector column with a GIN index on
+# Postgres. Both store the text normalized here (lower case, Polish letters
+# folded to ASCII) and are queried with prefixes of the normalized, lightly
+# stemmed query words, so "złote skarbonki" finds "Złota skarbonka" and
+# "skar" works for typeahead. Kept in sync by the Item signals and by
+# prepopulate; `python manage.py rebuild_search_index` rebuilds it.
+TITLE_WEIGHT = 10.0
+MAX_QUERY_WORDS = 8
+
+# ł doesn't decompose into l and a combining mark like the other Polish letters
+_FOLD = str.maketrans('łŁ', 'lL')
+_WORD = re.compile(r'[^\W_]+')
+# Common Polish inflection endings (after folding), longest first
+_SUFFIXES = sorted([
+    'ami', 'ach', 'ych', 'ich', 'ymi', 'imi', 'ego', 'emu', 'owi', 'owa', 'owe', 'owy',
+    'om', 'ow', 'ie', 'ia', 'iu', 'em', 'ej', 'a', 'e', 'i', 'o', 'u', 'y',
+], key=len, reverse=True)
+_MIN_STEM = 3
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', (text or '').translate(_FOLD))
+    return ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+
+
+def words(text):
+    return _WORD.findall(normalize(text))
+
+
+def stem(word):
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= _MIN_STEM:
+            return word[:-len(suffix)]
+    return word
+
+
+def query_prefixes(query):
+    return [stem(word) for word in words(query)][:MAX_QUERY_WORDS]
+
+
+class SqliteSearch:
+    def create(self, cursor):
+        cursor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS core_item_search "
+            "USING fts5(title, description, tokenize='unicode61')")
+
+    def drop(self, cursor):
+        cursor.execute("DROP TABLE IF EXISTS core_item_search")
+
+    def index(self, cursor, rows):
+        self.remove(cursor, [pk for pk, title, description in rows])
+        cursor.executemany(
+            "INSERT INTO core_item_search (rowid, title, description) VALUES (%s, %s, %s)", rows)
+
+    def remove(self, cursor, pks):
+        cursor.executemany("DELETE FROM core_item_search WHERE rowid = %s", [(pk,) for pk in pks])
+
+    def search(self, cursor, prefixes, limit):
+        # bm25() is lower for better matches
+        cursor.execute(
+            "SELECT rowid FROM core_item_search WHERE core_item_search MATCH %s "
+            "ORDER BY bm25(core_item_search, %s, 1.0), rowid LIMIT %s",
+            [' '.join(f'{prefix}*' for prefix in prefixes), TITLE_WEIGHT, limit])
+        return [pk for pk, in cursor.fetchall()]
+
+
+class PostgresSearch:
+    # The 'simple' configuration only lower-cases, normalize() does the rest
+    document = "setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B')"
+
+    def create(self, cursor):
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS core_item_search "
+            "(item_id integer PRIMARY KEY, document tsvector NOT NULL)")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS core_item_search_document_idx "
+            "ON core_item_search USING GIN (document)")
+
+    def drop(self, cursor):
+        cursor.execute("DROP TABLE IF EXISTS core_item_search")
+
+    def index(self, cursor, rows):
+        cursor.executemany(
+            f"INSERT INTO core_item_search (item_id, document) VALUES (%s, {self.document}) "
+            "ON CONFLICT (item_id) DO UPDATE SET document = EXCLUDED.document", rows)
+
+    def remove(self, cursor, pks):
+        cursor.execute("DELETE FROM core_item_search WHERE item_id = ANY(%s)", [list(pks)])
+
+    def search(self, cursor, prefixes, limit):
+        # Weights of ts_rank_cd for D, C, B (description) and A (title)
+        cursor.execute(
+            "SELECT item_id FROM core_item_search, to_tsquery('simple', %s) query "
+            "WHERE document @@ query "
+            "ORDER BY ts_rank_cd(%s::float4[], document, query) DESC, item_id LIMIT %s",
+            [' & '.join(f'{prefix}:*' for prefix in prefixes),
+             [0.0, 0.0, 1.0 / TITLE_WEIGHT, 1.0], limit])
+        return [pk for pk, in cursor.fetchall()]
+
+
+BACKENDS = {
+    'sqlite': SqliteSearch(),
+    'postgresql': PostgresSearch(),
+}
+
+
+def get_backend(connection):
+    try:
+        return BACKENDS[connection.vendor]
+    except KeyError:
+        raise NotSupportedError(f'Product search is not available on {connection.vendor}')
+
+
+def index_items(items, using=None):
+    # (Re)indexes Item instances, or any objects with pk, title and description
+    connection = connections[using or router.db_for_write(Item)]
+    rows = [(item.pk, normalize(item.title), normalize(item.description)) for item in items]
+    if rows:
+        with connection.cursor() as cursor:
+            get_backend(connection).index(cursor, rows)
+
+
+def remove_items(pks, using=None):
+    connection = connections[using or router.db_for_write(Item)]
+    if pks:
+        with connection.cursor() as cursor:
+            get_backend(connection).remove(cursor, pks)
+
+
+def search_items(query, limit=48):
+    # Item pks matching every word of `query` as a prefix, best first
+    prefixes = query_prefixes(query)
+    if not prefixes:
+        return []
+    connection = connections[router.db_for_read(Item)]
+    with connection.cursor() as cursor:
+        return get_backend(connection).search(cursor, prefixes, limit)
@@ -0,0 +1,67 @@
+from django.contrib.auth.signals import user_logged_in
+from django.core.signals import request_finished, request_started
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cart import PaymentInProgress, merge_guest_cart
+from .catalog import bump_catalog_version
+from .db import check_connections, connection_opened, release_connections
+from .fragments import bump_item_version
+from .images import schedule_derivatives
+from .models import Item, Order
+from .search import index_items, remove_items
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def item_changed(sender, instance, **kwargs):
+    bump_item_version(instance.pk)
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=Item)
+def item_saved(sender, instance, using, created, **kwargs):
+    index_items([instance], using=using)
+    if not created:
+        # its price may have changed, see Order.reprice_open_orders
+        Order.reprice_open_orders([instance.pk])
+
+
+@receiver(post_delete, sender=Item)
+def item_deleted(sender, instance, using, **kwargs):
+    remove_items([instance.pk], using=using)
+
+
+@receiver(post_save, sender=Item)
+def item_image_saved(sender, instance, **kwargs):
+    # Only for a new image, not on every edit of the item
+    if instance.image and instance.derivatives_for != instance.image.name:
+        schedule_derivatives(instance.image.name)
+
+
+@receiver(user_logged_in)
+def guest_cart_login(sender, request, user, **kwargs):
+    if request is not None:
+        try:
+            merge_guest_cart(request, user)
+        except PaymentInProgress:
+            # merged on a later login
+            pass
+
+
+@receiver(connection_created)
+def db_connection_created(sender, connection, **kwargs):
+    connection_opened(connection)
+
+
+@receiver(request_started)
+def db_request_started(sender, **kwargs):
+    # Runs after Django's close_old_connections has dropped expired connections
+    check_connections()
+
+
+@receiver(request_finished)
+def db_request_finished(sender, **kwargs):
+    # Runs after Django's close_old_connections has dropped expired connections
+    release_connections()
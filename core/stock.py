@@ -0,0 +1,106 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Item, StockReservation
+
+# Item.stock counts the units nobody holds. Adding to a cart moves units from
+# Item.stock into the user's StockReservation with single conditional UPDATEs
+# (never read-then-write), so concurrent buyers of one item can't oversell it:
+# the database re-checks `stock >= n` on the locked row. Reservations expire
+# after STOCK_RESERVATION_MINUTES (release_expired, run by the
+# `release_reservations` command); checkout tops them up again.
+#
+# Lock order everywhere is reservation row, then item row, and the cart views
+# reserve last, after their own cart rows, so buyers never deadlock.
+
+
+def reservation_expiry():
+    return timezone.now() + timedelta(minutes=getattr(settings, 'STOCK_RESERVATION_MINUTES', 15))
+
+
+def reserve(user, item, quantity=1):
+    # Returns False, changing nothing, when fewer than `quantity` units are left
+    if item.stock is None:
+        return True
+    with transaction.atomic():
+        expires = reservation_expiry()
+        updated = StockReservation.objects.filter(user=user, item=item) \
+            .update(quantity=F('quantity') + quantity, expires=expires)
+        if not updated:
+            try:
+                with transaction.atomic():
+                    StockReservation.objects.create(user=user, item=item, quantity=quantity, expires=expires)
+            except IntegrityError:
+                # created by a concurrent request of the same user
+                StockReservation.objects.filter(user=user, item=item) \
+                    .update(quantity=F('quantity') + quantity, expires=expires)
+        if Item.objects.filter(pk=item.pk, stock__gte=quantity).update(stock=F('stock') - quantity):
+            return True
+        transaction.set_rollback(True)
+        return False
+
+
+def release(user, item, quantity):
+    # Gives back up to `quantity` reserved units, returns how many
+    if item.stock is None:
+        return 0
+    while True:
+        reservation = StockReservation.objects.filter(user=user, item=item, quantity__gt=0).first()
+        if reservation is None:
+            return 0
+        released = min(quantity, reservation.quantity)
+        with transaction.atomic():
+            # Only if nobody (e.g. release_expired) changed it since we read it
+            if StockReservation.objects.filter(pk=reservation.pk, quantity=reservation.quantity) \
+                    .update(quantity=F('quantity') - released):
+                Item.objects.filter(pk=item.pk, stock__isnull=False).update(stock=F('stock') + released)
+                return released
+
+
+def reserve_order(order):
+    # Tops up the reservations of the order's lines, e.g. of a merged guest
+    # cart or after they expired, and holds them for the payment. Returns the
+    # items that are short of stock.
+    lines = list(order.items.select_related('item').filter(item__stock__isnull=False))
+    if not lines:
+        return []
+    reserved = dict(StockReservation.objects.filter(user=order.user, item__in=[line.item_id for line in lines])
+                    .values_list('item_id', 'quantity'))
+    missing = []
+    for line in lines:
+        shortfall = line.quantity - reserved.get(line.item_id, 0)
+        if shortfall > 0 and not reserve(order.user, line.item, shortfall):
+            missing.append(line.item)
+        elif shortfall < 0:
+            release(order.user, line.item, -shortfall)
+    StockReservation.objects.filter(user=order.user, item__in=[line.item_id for line in lines]) \
+        .update(expires=reservation_expiry())
+    return missing
+
+
+def confirm_order(order):
+    # The order is paid: its reserved units are sold and stay out of stock
+    StockReservation.objects.filter(user=order.user, item__in=order.items.values('item_id')).delete()
+
+
+def release_order(order):
+    for line in order.items.select_related('item').filter(item__stock__isnull=False):
+        release(order.user, line.item, line.quantity)
+
+
+def release_expired(now=None):
+    now = now or timezone.now()
+    released = 0
+    expired = StockReservation.objects.filter(quantity__gt=0, expires__lt=now).order_by('expires')
+    for reservation in list(expired):
+        with transaction.atomic():
+            if StockReservation.objects.filter(pk=reservation.pk, quantity=reservation.quantity,
+                                               expires__lt=now).update(quantity=0):
+                Item.objects.filter(pk=reservation.item_id, stock__isnull=False) \
+                    .update(stock=F('stock') + reservation.quantity)
+                released += reservation.quantity
+    return released
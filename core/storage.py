@@ -0,0 +1,133 @@
+import gzip
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import (
+    HashedFilesMixin, ManifestFilesMixin, ManifestStaticFilesStorage, StaticFilesStorage
+)
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from storages.backends.azure_storage import AzureStorage
+except ImportError:
+    # django-storages is only installed for the Azure deployment
+    AzureStorage = None
+
+# collectstatic builds the STATIC_BUNDLES (one CSS and one JS file instead of
+# a request per library), then content-hashes the files (manifest storages)
+# and writes .gz and, with the brotli package, .br variants of text assets
+# next to them (not on Azure, see AzureManifestStorage). Hashed names never
+# change content, so they are served with an immutable, far-future
+# Cache-Control (core.views.static_file, or AZURE_CACHE_CONTROL on Azure);
+# the unhashed names get none.
+# In development core.finders.BundleFinder serves the bundles without
+# collectstatic.
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.map', '.txt', '.html', '.xml', '.ttf', '.eot')
+
+
+def join_bundle(name, parts):
+    # JS files may lack a trailing semicolon
+    separator = b';\n' if name.endswith('.js') else b'\n'
+    return separator.join(part.rstrip() for part in parts) + b'\n'
+
+
+class BundleMixin:
+    def post_process(self, paths, dry_run=False, **options):
+        bundles = getattr(settings, 'STATIC_BUNDLES', {})
+        if not dry_run:
+            for name, sources in bundles.items():
+                self.build_bundle(name, sources, paths)
+                paths[name] = (self, name)
+        parent = getattr(super(), 'post_process', None)
+        if parent is not None:
+            yield from parent(paths, dry_run, **options)
+        else:
+            for name in bundles:
+                yield name, name, not dry_run
+
+    def build_bundle(self, name, sources, paths):
+        parts = []
+        for source in sources:
+            storage, path = paths[source]
+            with storage.open(path) as f:
+                parts.append(f.read())
+        if self.exists(name):
+            self.delete(name)
+        self._save(name, ContentFile(join_bundle(name, parts)))
+
+
+class CompressMixin:
+    def post_process(self, paths, dry_run=False, **options):
+        parent = getattr(super(), 'post_process', None)
+        if parent is not None:
+            yield from parent(paths, dry_run, **options)
+        if dry_run:
+            return
+        # the final versions of the hashed files, or the collected ones
+        names = set(self.hashed_files.values()) if isinstance(self, ManifestFilesMixin) else set(paths)
+        for name in sorted(names):
+            if name.endswith(COMPRESSIBLE):
+                self.compress(name)
+
+    def compress(self, name):
+        with self.open(name) as f:
+            content = f.read()
+        variants = [('.gz', gzip.compress(content, 9, mtime=0))]
+        if brotli is not None:
+            variants.append(('.br', brotli.compress(content)))
+        for suffix, compressed in variants:
+            if len(compressed) < len(content):
+                if self.exists(name + suffix):
+                    self.delete(name + suffix)
+                self._save(name + suffix, ContentFile(compressed))
+
+
+class CompressedStaticFilesStorage(CompressMixin, BundleMixin, StaticFilesStorage):
+    pass
+
+
+class CompressedManifestStaticFilesStorage(CompressMixin, BundleMixin, ManifestStaticFilesStorage):
+    def url(self, name, force=False):
+        # Before the first collectstatic (e.g. in tests) there is no manifest,
+        # link the unhashed names like with DEBUG on
+        if not self.hashed_files:
+            return super(HashedFilesMixin, self).url(name)
+        return super().url(name, force)
+
+
+if AzureStorage is not None:
+    # Without the .gz/.br variants: a blob container can't pick one by the
+    # client's Accept-Encoding, let the CDN in front of it compress
+    class AzureManifestStorage(BundleMixin, ManifestFilesMixin, AzureStorage):
+        def url(self, name, force=True):
+            # Hashed even with DEBUG on (azure.py), only those blobs are immutable
+            return super().url(name, force)
+
+        def _save(self, name, content):
+            # AZURE_CACHE_CONTROL only for hashed names: collectstatic also
+            # uploads the unhashed files, which change on every deploy
+            cache_control = self.cache_control
+            if not HASHED_NAME.search(name):
+                self.cache_control = None
+            try:
+                return super()._save(name, content)
+            finally:
+                self.cache_control = cache_control
+
+
+def compressed_variant(path, accept_encoding):
+    # (encoding, file name) of the best pre-compressed variant of a file in
+    # STATIC_ROOT the client accepts, or (None, path)
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in accept_encoding and os.path.isfile(os.path.join(settings.STATIC_ROOT, path + suffix)):
+            return encoding, path + suffix
+    return None, path
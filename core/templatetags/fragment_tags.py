@@ -0,0 +1,31 @@
+from django import template
+
+from core.fragments import render_cached_html
+
+register = template.Library()
+
+
+class CachedFragmentNode(template.Node):
+    def __init__(self, nodelist, name, vary_on):
+        self.nodelist = nodelist
+        self.name = name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        vary_on = [var.resolve(context) for var in self.vary_on]
+        return render_cached_html(self.name.resolve(context), vary_on,
+                                  lambda: self.nodelist.render(context))
+
+
+@register.tag
+def cachedfragment(parser, token):
+    # {% cachedfragment "name" [vary_on ...] %}...{% endcachedfragment %},
+    # see render_cached_html; never put per-user content inside without
+    # listing what it depends on
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' tag requires a fragment name")
+    nodelist = parser.parse(('endcachedfragment',))
+    parser.delete_first_token()
+    return CachedFragmentNode(nodelist, parser.compile_filter(bits[1]),
+                              [parser.compile_filter(bit) for bit in bits[2:]])
@@ -0,0 +1,39 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html
+
+from core.images import VARIANTS, derivative_name
+
+register = template.Library()
+
+
+@register.simple_tag
+def responsive_image(image, variant, css_class='', alt='', ready=False):
+    # <picture> with WebP and JPEG derivatives of `image` at 1x and 2x once
+    # they are `ready` (Item.has_derivatives), the original image until then
+    if not image:
+        return ''
+    # an ImageField file or a storage name (catalog snapshot entries)
+    name = getattr(image, 'name', image)
+    if variant not in VARIANTS:
+        raise template.TemplateSyntaxError(f'Unknown image variant: {variant}')
+    if not ready:
+        return format_html('<img src="{}" class="{}" alt="{}" loading="lazy">',
+                           default_storage.url(name), css_class, alt)
+
+    def srcset(ext):
+        return ', '.join(
+            f'{default_storage.url(derivative_name(name, variant, density, ext))} {density}x'
+            for density in (1, 2))
+
+    # The original is the fallback of browsers without srcset support
+    return format_html(
+        '<picture>'
+        '<source type="image/webp" srcset="{}">'
+        '<img src="{}" srcset="{}" class="{}" alt="{}" loading="lazy">'
+        '</picture>',
+        srcset('webp'),
+        default_storage.url(name),
+        srcset('jpg'),
+        css_class,
+        alt)
@@ -1,3 +1,1233 @@
-from django.test import TestCase
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.staticfiles import finders
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models import F, QuerySet
+from django.test import (
+    Client, LiveServerTestCase, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+)
+from django.template import Context, Template
+from django.template.loader import render_to_string
+from django.utils import timezone, translation
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from prometheus_client import REGISTRY
+
+from . import metrics
+from .benchmarks import QUERY_BUDGETS, generate_data, run_benchmark, run_load, run_render_benchmark
+from .cart import CART_ITEM_COUNT_VERSION_KEY, get_cart_item_count
+from .catalog import get_catalog
+from .db import check_connections, release_connections
+from .finders import BundleFinder
+from .forms import CheckoutForm
+from .fragments import get_fragment_cache_stats
+from .images import generate_derivatives, mark_derivatives_ready
+from .models import (
+    ArchivedOrder, CatalogVersion, Item, Order, OrderItem, Payment, PaymentJob, SalesRollup, StockReservation
+)
+from .payments import CART_CHANGED_MESSAGE, FakeStripeBackend, claim_job, process_job, run_pending
+from .routers import ReplicaRouter, replica_reads
+from .search import search_items
+from .stock import release_expired
+from .views import static_file
+
+
+def create_item(slug, price=10, discount_price=None, category='GP', label='P', image=True):
+    return Item.objects.create(
+        title=slug.title(),
+        price=price,
+        discount_price=discount_price,
+        category=category,
+        label=label,
+        slug=slug,
+        image=f'{slug}.jpg' if image else None)
+
+
+class HomeViewTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        create_item('pawn')
+        create_item('helmet', category='KP', label='D')
+        create_item('piggy', category='S')
+
+    def test_category_filter(self):
+        response = self.client.get('/?category=KP')
+        self.assertEqual([i.slug for i in response.context['object_list']], ['helmet'])
+
+    def test_label_filter_and_unknown_values(self):
+        response = self.client.get('/?label=D&category=XX')
+        self.assertEqual([i.slug for i in response.context['object_list']], ['helmet'])
+
+    def test_category_counts_are_cached_and_invalidated(self):
+        self.client.get('/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/')
+        self.assertFalse(any('GROUP BY' in q['sql'] for q in queries))
+        self.assertIn(('S', 'Skarbonki', 1), response.context['categories'])
+
+        create_item('golden-piggy', category='S')
+        response = self.client.get('/')
+        self.assertIn(('S', 'Skarbonki', 2), response.context['categories'])
+
+
+class CatalogSnapshotTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.pawn = create_item('pawn', price=20, discount_price=15)
+        create_item('helmet', category='KP')
+
+    def test_catalog_pages_and_cart_read_no_items(self):
+        self.client.force_login(self.user)
+        self.client.get('/add-to-cart/pawn/')
+        get_catalog()
+        for url in ['/', '/?category=KP', '/product/pawn/', '/order-summary/', '/api/cart/']:
+            with self.subTest(url=url), CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse([q['sql'] for q in queries if 'core_item' in q['sql']])
+        self.assertEqual(response.json()['total'], 15)
+        self.assertEqual(self.client.get('/product/unknown/').status_code, 404)
+
+    def test_other_workers_changes_show_up_after_max_age(self):
+        self.client.get('/product/pawn/')
+        # as done by another process: no signals reach this one
+        Item.objects.filter(pk=self.pawn.pk).update(discount_price=12)
+        CatalogVersion.objects.update(version=F('version') + 1)
+        with override_settings(CATALOG_SNAPSHOT_MAX_AGE=60):
+            self.assertEqual(get_catalog().by_slug['pawn'].effective_price, 15)
+        with override_settings(CATALOG_SNAPSHOT_MAX_AGE=0):
+            self.assertEqual(get_catalog().by_slug['pawn'].effective_price, 12)
+            self.assertContains(self.client.get('/product/pawn/'), '12.0zł')
+
+
+# counts only the item fragments, not the cached chrome
+@override_settings(TEMPLATE_CACHE=False)
+class FragmentCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.pawn = create_item('pawn')
+        self.helmet = create_item('helmet')
+
+    def test_product_fragment_is_versioned_per_item(self):
+        stats = get_fragment_cache_stats()
+        self.client.get('/product/pawn/')
+        self.client.get('/product/helmet/')
+        response = self.client.get('/product/pawn/')
+        after = get_fragment_cache_stats()
+        self.assertEqual(after['misses'] - stats['misses'], 2)
+        self.assertEqual(after['hits'] - stats['hits'], 1)
+        # the cached fragment is served
+        self.assertContains(response, 'Pawn')
+
+        self.pawn.title = 'Golden pawn'
+        self.pawn.save()
+        self.assertContains(self.client.get('/product/pawn/'), 'Golden pawn')
+        self.client.get('/product/helmet/')
+        self.assertEqual(get_fragment_cache_stats()['hits'] - after['hits'], 1)
+
+    def test_listing_fragment_has_no_user_content(self):
+        user = get_user_model().objects.create_user('shopper', password='secret')
+        self.client.force_login(user)
+        self.client.get('/add-to-cart/pawn/')
+        self.assertContains(self.client.get('/'), 'Wyloguj')
+        self.client.logout()
+        response = self.client.get('/')
+        self.assertContains(response, 'Zaloguj')
+        self.assertNotContains(response, 'Wyloguj')
+        self.helmet.delete()
+        self.assertNotContains(self.client.get('/'), 'Helmet')
+
+
+
+@override_settings(TEMPLATE_CACHE=True)
+class TemplateCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        create_item('pawn')
+
+    def test_chrome_is_cached_per_login_state_and_language(self):
+        self.client.get('/')
+        stats = get_fragment_cache_stats()
+        self.client.get('/')
+        # item cards, navbar (two parts), footer, scripts
+        self.assertEqual(get_fragment_cache_stats()['hits'] - stats['hits'], 5)
+
+        self.client.force_login(self.user)
+        response = self.client.get('/')
+        self.assertContains(response, 'Wyloguj')
+        self.assertNotContains(response, 'Zaloguj')
+        stats = get_fragment_cache_stats()
+        with translation.override('pl'):
+            render_to_string('footer.html')
+        self.assertEqual(get_fragment_cache_stats()['misses'] - stats['misses'], 1)
+
+    def test_cart_badge_stays_dynamic(self):
+        # a guest cart, the badge of logged in users is invalidated on commit
+        self.assertContains(self.client.get('/'), 'id="cart-item-count"> 0 <')
+        self.client.get('/add-to-cart/pawn/')
+        self.assertContains(self.client.get('/'), 'id="cart-item-count"> 1 <')
+
+    def test_country_select_is_cached_per_value(self):
+        empty = str(CheckoutForm()['country'])
+        stats = get_fragment_cache_stats()
+        self.assertEqual(str(CheckoutForm()['country']), empty)
+        self.assertEqual(get_fragment_cache_stats()['hits'] - stats['hits'], 1)
+        self.assertIn('value="PL" selected', str(CheckoutForm(initial={'country': 'PL'})['country']))
+
+
+class ImageDerivativesTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_generates_variants_and_srcset(self):
+        buffer = BytesIO()
+        Image.new('RGB', (2000, 1000), 'red').save(buffer, 'PNG')
+        name = default_storage.save('pawn.png', ContentFile(buffer.getvalue()))
+
+        self.assertEqual(generate_derivatives(name), 8)
+        self.assertEqual(generate_derivatives(name), 0)
+        with default_storage.open('derivatives/pawn-card-2x.webp') as f:
+            self.assertEqual(Image.open(f).size, (600, 300))
+
+    def test_original_is_shown_until_derivatives_exist(self):
+        buffer = BytesIO()
+        Image.new('RGB', (2000, 1000), 'red').save(buffer, 'PNG')
+        name = default_storage.save('pawn.png', ContentFile(buffer.getvalue()))
+        item = create_item('pawn', image=False)
+        Item.objects.filter(pk=item.pk).update(image=name)
+        tag = Template("{% load image_template_tags %}"
+                       "{% responsive_image item.image 'card' 'card-img-top' ready=item.has_derivatives %}")
+
+        item.refresh_from_db()
+        html = tag.render(Context({'item': item}))
+        self.assertIn('<img src="/media/pawn.png"', html)
+        self.assertNotIn('derivatives', html)
+
+        generate_derivatives(name)
+        mark_derivatives_ready(name)
+        item.refresh_from_db()
+        html = tag.render(Context({'item': item}))
+        self.assertIn('srcset="/media/derivatives/pawn-card.webp 1x, /media/derivatives/pawn-card-2x.webp 2x"', html)
+        self.assertIn('<img src="/media/pawn.png" srcset="/media/derivatives/pawn-card.jpg 1x', html)
+        self.assertTrue(get_catalog().by_pk[item.pk].has_derivatives)
+
+    def test_derivatives_are_scheduled_for_new_images_only(self):
+        with mock.patch('core.signals.schedule_derivatives') as schedule:
+            item = create_item('pawn')
+            schedule.assert_called_once_with('pawn.jpg')
+            Item.objects.filter(pk=item.pk).update(derivatives_for='pawn.jpg')
+            item.refresh_from_db()
+            item.price = 20
+            item.save()
+            schedule.assert_called_once()
+            item.image = 'rook.jpg'
+            item.save()
+            schedule.assert_called_with('rook.jpg')
+
+
+class StaticPipelineTest(SimpleTestCase):
+    def setUp(self):
+        source = tempfile.mkdtemp()
+        static_root = tempfile.mkdtemp()
+        for directory in (source, static_root):
+            self.addCleanup(shutil.rmtree, directory)
+        os.makedirs(os.path.join(source, 'js'))
+        for name in ('a', 'b'):
+            with open(os.path.join(source, 'js', f'{name}.js'), 'w') as f:
+                f.write(f'var {name} = "{name * 500}"\n')
+        override = override_settings(
+            STATICFILES_DIRS=[source], STATIC_ROOT=static_root,
+            STATICFILES_STORAGE='core.storage.CompressedManifestStaticFilesStorage',
+            STATIC_BUNDLES={'js/bundle.js': ['js/a.js', 'js/b.js']})
+        override.enable()
+        self.addCleanup(override.disable)
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+    def test_bundles_hashes_and_compresses(self):
+        url = Template("{% load static %}{% static 'js/bundle.js' %}").render(Context())
+        self.assertRegex(url, r'^/static/js/bundle\.[0-9a-f]{12}\.js$')
+        path = url[len('/static/'):]
+
+        request = RequestFactory().get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        response = static_file(request, path)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('javascript', response['Content-Type'])
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        content = gzip.decompress(b''.join(response.streaming_content)).decode()
+        self.assertTrue(content.startswith('var a') and 'var b' in content)
+
+        response = static_file(RequestFactory().get(url), path)
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_unhashed_urls_without_manifest(self):
+        with override_settings(STATIC_ROOT=tempfile.mkdtemp()):
+            self.addCleanup(shutil.rmtree, settings.STATIC_ROOT)
+            url = Template("{% load static %}{% static 'js/bundle.js' %}").render(Context())
+        self.assertEqual(url, '/static/js/bundle.js')
+
+    def test_runserver_finds_bundles(self):
+        with override_settings(BUNDLE_BUILD_DIR=os.path.join(settings.STATIC_ROOT, 'build')):
+            path = finders.find('js/bundle.js')
+            with open(path) as f:
+                self.assertTrue(f.read().startswith('var a'))
+            with open(finders.find('js/b.js'), 'a') as f:
+                f.write('var c = 1\n')
+            os.utime(finders.find('js/b.js'), (os.path.getmtime(path) + 1,) * 2)
+            with open(finders.find('js/bundle.js')) as f:
+                self.assertIn('var c', f.read())
+        # collectstatic builds them itself
+        self.assertFalse(list(BundleFinder().list([])))
+
+
+class PrepopulateTest(TestCase):
+    def test_upserts_on_slug_and_skips_invalid_rows(self):
+        create_item('pawn', price=5)
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('slug,title,price,discount_price,category,label\n'
+                    'pawn,Pawn,10,8,GP,S\n'
+                    'helmet,Helmet,20,,KP,D\n'
+                    'piggy,Piggy,abc,,S,P\n')
+        self.addCleanup(os.remove, f.name)
+        out, err = StringIO(), StringIO()
+        call_command('prepopulate', f.name, batch_size=1, stdout=out, stderr=err)
+        self.assertIn('Created 1, updated 1, skipped 1', out.getvalue())
+        self.assertIn('Line 4: invalid price', err.getvalue())
+        self.assertEqual(Item.objects.get(slug='pawn').discount_price, 8)
+        self.assertEqual(Item.objects.get(slug='helmet').category, 'KP')
+        self.assertEqual(search_items('helm'), [Item.objects.get(slug='helmet').pk])
+
+
+    def test_jsonl_rows_of_the_wrong_type_are_rejected(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as f:
+            f.write('[1, 2]\n'
+                    '"x"\n'
+                    '{"slug": 5, "title": "Pawn", "price": 10, "category": "GP", "label": "S"}\n'
+                    '{"slug": "pawn", "title": ["Pawn"], "price": 10, "category": "GP", "label": "S"}\n'
+                    '{"slug": "pawn", "title": "Pawn", "price": 10, "category": ["GP"], "label": "S"}\n'
+                    '{"slug": "rook", "title": "Rook", "price": 10, "category": "GP", "label": "S"}\n')
+        self.addCleanup(os.remove, f.name)
+        out, err = StringIO(), StringIO()
+        call_command('prepopulate', f.name, stdout=out, stderr=err)
+        self.assertIn('Created 1, updated 0, skipped 5', out.getvalue())
+        self.assertIn('Line 1: expected an object', err.getvalue())
+        self.assertIn('Line 4: title must be a string', err.getvalue())
+
+    def test_imported_stock_keeps_reservations(self):
+        user = get_user_model().objects.create_user('shopper')
+        other = get_user_model().objects.create_user('other')
+        pawn, rook = create_item('pawn'), create_item('rook')
+        expires = timezone.now() + timedelta(minutes=15)
+        StockReservation.objects.create(user=user, item=pawn, quantity=3, expires=expires)
+        StockReservation.objects.create(user=other, item=pawn, quantity=0, expires=expires)
+        StockReservation.objects.create(user=user, item=rook, quantity=5, expires=expires)
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('slug,title,price,discount_price,category,label,stock\n'
+                    'pawn,Pawn,10,,GP,S,10\n'
+                    'rook,Rook,10,,GP,S,2\n')
+        self.addCleanup(os.remove, f.name)
+        err = StringIO()
+        call_command('prepopulate', f.name, stdout=StringIO(), stderr=err)
+        self.assertEqual(Item.objects.get(pk=pawn.pk).stock, 7)
+        self.assertEqual(Item.objects.get(pk=rook.pk).stock, 0)
+        self.assertIn('rook: stock 2 is less than the 5 units reserved', err.getvalue())
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.piggy = Item.objects.create(title='Złota skarbonka', price=30, category='S', label='P',
+                                         slug='zlota-skarbonka', description='Świnka z ceramiki')
+        self.game = Item.objects.create(title='Gra planszowa Szachy', price=80, category='GP', label='S',
+                                        slug='szachy', description='Drewniane figury, idealne obok skarbonki')
+
+    def test_polish_words_and_prefixes(self):
+        self.assertEqual(search_items('złote skarbonki'), [self.piggy.pk])
+        self.assertEqual(search_items('ZLOTA'), [self.piggy.pk])
+        self.assertEqual(search_items('swinka'), [self.piggy.pk])
+        self.assertEqual(search_items('planszowych'), [self.game.pk])
+        self.assertEqual(search_items('sza'), [self.game.pk])
+        self.assertEqual(search_items('  ,. '), [])
+
+    def test_title_matches_rank_first(self):
+        self.assertEqual(search_items('skarbonka'), [self.piggy.pk, self.game.pk])
+
+    def test_index_follows_item_changes(self):
+        self.game.title = 'Gra planszowa Warcaby'
+        self.game.save()
+        self.assertEqual(search_items('szachy'), [])
+        self.assertEqual(search_items('warcab'), [self.game.pk])
+        self.piggy.delete()
+        self.assertEqual(search_items('skarbonka'), [self.game.pk])
+
+    def test_search_page_and_suggestions(self):
+        response = self.client.get('/search/', {'q': 'skarb'})
+        self.assertEqual([i.slug for i in response.context['object_list']], ['zlota-skarbonka', 'szachy'])
+        self.assertContains(response, 'value="skarb"')
+        self.assertContains(self.client.get('/search/', {'q': 'rower'}), 'Brak produktów')
+        results = self.client.get('/api/search/', {'q': 'szach'}).json()['results']
+        self.assertEqual(results, [{'title': 'Gra planszowa Szachy', 'url': '/product/szachy/', 'price': 80}])
+
+
+class CartApiTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.pawn = create_item('pawn', price=20, discount_price=15)
+        self.rook = create_item('rook', price=30)
+        Item.objects.filter(pk=self.rook.pk).update(stock=3)
+
+    def post(self, *changes):
+        return self.client.post('/api/cart/', json.dumps({'changes': list(changes)}),
+                                content_type='application/json')
+
+    def test_batch_changes(self):
+        self.client.force_login(self.user)
+        response = self.post({'slug': 'pawn', 'quantity': 4}, {'slug': 'rook', 'delta': 2},
+                             {'slug': 'pawn', 'delta': -1})
+        self.assertEqual(response.status_code, 200)
+        cart = response.json()
+        self.assertEqual({line['slug']: line['quantity'] for line in cart['lines']}, {'pawn': 3, 'rook': 2})
+        self.assertEqual((cart['total'], cart['cart_item_count']), (105, 2))
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual((order.total, order.item_count), (105, 2))
+        self.assertEqual(Item.objects.get(pk=self.rook.pk).stock, 1)
+
+        cart = self.post({'slug': 'pawn', 'quantity': 0}).json()
+        self.assertEqual([line['slug'] for line in cart['lines']], ['rook'])
+        self.assertEqual(self.client.get('/api/cart/').json(), cart)
+
+    def test_out_of_stock_changes_nothing(self):
+        self.client.force_login(self.user)
+        response = self.post({'slug': 'pawn', 'quantity': 1}, {'slug': 'rook', 'quantity': 4})
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(OrderItem.objects.exists())
+        self.assertEqual(Item.objects.get(pk=self.rook.pk).stock, 3)
+
+    def test_invalid_changes(self):
+        self.client.force_login(self.user)
+        for changes in ([], [{'slug': 'pawn'}], [{'slug': 'pawn', 'quantity': 1, 'delta': 1}],
+                        [{'slug': 'queen', 'quantity': 1}], [{'slug': 'pawn', 'quantity': True}]):
+            self.assertEqual(self.post(*changes).status_code, 400, changes)
+
+    def test_out_of_range_quantities(self):
+        for user in (None, self.user):
+            if user:
+                self.client.force_login(user)
+            for change in ({'quantity': 99999999999999999999}, {'quantity': 1000}, {'quantity': -1},
+                           {'delta': 1000}, {'delta': -1000}):
+                self.assertEqual(self.post(dict(change, slug='pawn')).status_code, 400, change)
+            self.post({'slug': 'pawn', 'quantity': 999})
+            cart = self.post({'slug': 'pawn', 'delta': 999}).json()
+            self.assertEqual(cart['lines'][0]['quantity'], 999)
+        self.assertEqual(OrderItem.objects.get().quantity, 999)
+
+    def test_guest_cart(self):
+        cart = self.post({'slug': 'pawn', 'delta': 2}, {'slug': 'rook', 'quantity': 1}).json()
+        self.assertEqual((cart['total'], cart['cart_item_count']), (60, 2))
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.post({'slug': 'rook', 'quantity': 5}).status_code, 409)
+        self.assertEqual(self.client.get('/api/cart/').json()['total'], 60)
+
+
+@override_settings(PAYMENT_BACKEND='fake', PAYMENT_JOBS_IN_PROCESS=False)
+class StockTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.client.force_login(self.user)
+        self.item = create_item('pawn', price=20)
+        Item.objects.filter(pk=self.item.pk).update(stock=2)
+
+    def stock(self):
+        return Item.objects.get(pk=self.item.pk).stock
+
+    def reserved(self):
+        return StockReservation.objects.get(user=self.user, item=self.item).quantity
+
+    def test_cart_reserves_and_releases(self):
+        self.client.get('/add-to-cart/pawn/')
+        self.client.get('/add-to-cart/pawn/')
+        self.assertEqual((self.stock(), self.reserved()), (0, 2))
+        response = self.client.get('/add-to-cart/pawn/')
+        self.assertRedirects(response, '/product/pawn/', fetch_redirect_response=False)
+        self.assertEqual(OrderItem.objects.get().quantity, 2)
+
+        self.client.get('/remove-item-from-cart/pawn/')
+        self.assertEqual((self.stock(), self.reserved()), (1, 1))
+        self.client.get('/remove-from-cart/pawn/')
+        self.assertEqual((self.stock(), self.reserved()), (2, 0))
+
+    def test_expired_reservations_are_topped_up_at_payment(self):
+        self.client.get('/add-to-cart/pawn/')
+        self.client.get('/add-to-cart/pawn/')
+        self.assertEqual(release_expired(timezone.now() + timedelta(hours=1)), 2)
+        self.assertEqual((self.stock(), self.reserved()), (2, 0))
+
+        response = self.client.post('/payment/stripe/', {'stripeToken': 'tok_visa'})
+        job = PaymentJob.objects.get()
+        self.assertRedirects(response, f'/payment/status/{job.pk}/', fetch_redirect_response=False)
+        self.assertEqual((self.stock(), self.reserved()), (0, 2))
+        run_pending()
+        self.assertEqual(self.stock(), 0)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_payment_refused_when_short_of_stock(self):
+        self.client.get('/add-to-cart/pawn/')
+        OrderItem.objects.update(quantity=3)
+        response = self.client.post('/payment/stripe/', {'stripeToken': 'tok_visa'})
+        self.assertRedirects(response, '/order-summary/', fetch_redirect_response=False)
+        self.assertFalse(PaymentJob.objects.exists())
+
+    def test_declined_payment_releases_stock(self):
+        self.client.get('/add-to-cart/pawn/')
+        self.client.post('/payment/stripe/', {'stripeToken': 'tok_chargeDeclined'})
+        run_pending()
+        self.assertEqual((self.stock(), self.reserved()), (2, 0))
+
+
+class ArchiveOrdersTest(TestCase):
+    def create_order(self, user, ordered, days_ago, payment=None):
+        order = Order.objects.create(user=user, ordered=ordered, payment=payment,
+                                     ordered_date=timezone.now() - timedelta(days=days_ago))
+        for item in (self.pawn, self.rook):
+            order.items.add(OrderItem.objects.create(user=user, item=item, ordered=ordered, quantity=2))
+        order.recalculate_totals()
+        return order
+
+    def test_moves_old_completed_orders(self):
+        user = get_user_model().objects.create_user('shopper')
+        self.pawn = create_item('pawn', price=20, discount_price=15)
+        self.rook = create_item('rook', price=30)
+        payment = Payment.objects.create(stripe_charge_id='ch_1', user=user, amount=90)
+        old = self.create_order(user, True, 400, payment)
+        recent = self.create_order(user, True, 10)
+        cart = self.create_order(user, False, 400)
+
+        call_command('archive_orders', days=180, batch_size=1, stdout=StringIO())
+
+        self.assertEqual(set(Order.objects.values_list('pk', flat=True)), {recent.pk, cart.pk})
+        self.assertEqual(OrderItem.objects.count(), 4)
+        archived = ArchivedOrder.objects.get()
+        self.assertEqual((archived.pk, archived.payment, archived.total, archived.item_count),
+                         (old.pk, payment, 90, 2))
+        self.assertEqual(dict(archived.items.values_list('item__slug', 'quantity')), {'pawn': 2, 'rook': 2})
+        self.assertEqual(list(user.archived_orders.all()), [archived])
+
+
+class SalesReportTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('shopper')
+        self.pawn = create_item('pawn', price=20, discount_price=15, category='GP', image=False)
+        self.rook = create_item('rook', price=30, category='KP', image=False)
+
+    def pay(self, days_ago, pinned=True, **quantities):
+        # Charged at the current prices, pinned on the lines unless paid
+        # before the lines had prices
+        payment = Payment.objects.create(stripe_charge_id='ch', user=self.user, amount=0)
+        paid = timezone.now() - timedelta(days=days_ago)
+        order = Order.objects.create(user=self.user, ordered=True, ordered_date=paid, payment=payment)
+        amount = 0
+        for slug, quantity in quantities.items():
+            item = Item.objects.get(slug=slug)
+            amount += quantity * (item.discount_price or item.price)
+            prices = {'price': item.price, 'discount_price': item.discount_price} if pinned else {}
+            order.items.add(OrderItem.objects.create(
+                user=self.user, item=item, ordered=True, quantity=quantity, **prices))
+        Payment.objects.filter(pk=payment.pk).update(timestamp=paid, amount=amount)
+        return order
+
+    def rollups(self):
+        return {(r.day, r.item.slug): (r.orders, r.units, r.revenue, r.discount)
+                for r in SalesRollup.objects.select_related('item')}
+
+    def test_rolls_up_new_payments_once(self):
+        self.pay(400, pawn=2, rook=1)
+        call_command('archive_orders', days=180, stdout=StringIO())
+        self.pay(1, pawn=1)
+        self.pay(1, pawn=3)
+        self.pay(0, rook=5)  # not settled yet
+        call_command('rollup_sales', batch_size=1, stdout=StringIO())
+        call_command('rollup_sales', stdout=StringIO())
+
+        old, yesterday = [timezone.localdate() - timedelta(days=n) for n in (400, 1)]
+        self.assertEqual(self.rollups(), {
+            (old, 'pawn'): (1, 2, 30, 10),
+            (old, 'rook'): (1, 1, 30, 0),
+            (yesterday, 'pawn'): (2, 4, 60, 20),
+        })
+
+        out = StringIO()
+        call_command('export_sales', 'categories', '--format', 'jsonl', '--from', str(yesterday),
+                     stdout=out, stderr=StringIO())
+        self.assertEqual([json.loads(line) for line in out.getvalue().splitlines()], [
+            {'day': str(yesterday), 'category': 'GP', 'units': 4, 'revenue': 60.0, 'discount': 20.0}])
+
+    def test_lines_are_priced_at_the_paid_price(self):
+        self.pay(2, pawn=2)
+        self.pay(2, pinned=False, pawn=1, rook=1)
+        Item.objects.filter(pk=self.pawn.pk).update(price=40, discount_price=None)
+        call_command('archive_orders', days=1, stdout=StringIO())
+        self.pay(1, pinned=False, pawn=1)
+        call_command('rollup_sales', stdout=StringIO())
+
+        two_days_ago, yesterday = [timezone.localdate() - timedelta(days=n) for n in (2, 1)]
+        # the unpinned order paid 15 + 30, priced today at 40 + 30
+        rollups = {key: (orders, units, round(revenue, 2), round(discount, 2))
+                   for key, (orders, units, revenue, discount) in self.rollups().items()}
+        self.assertEqual(rollups, {
+            (two_days_ago, 'pawn'): (2, 3, 30 + 25.71, 10 + 14.29),
+            (two_days_ago, 'rook'): (1, 1, 19.29, 10.71),
+            (yesterday, 'pawn'): (1, 1, 40, 0),
+        })
+
+    def test_exports_paid_lines_as_csv(self):
+        self.pay(400, pawn=2)
+        call_command('archive_orders', days=180, stdout=StringIO())
+        self.pay(1, rook=1)
+        Item.objects.update(price=50, discount_price=None)
+        out = StringIO()
+        call_command('export_sales', 'lines', stdout=out, stderr=StringIO())
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'paid,payment_id,order_id,item_id,slug,category,quantity,price,'
+                                   'discount_price,archived')
+        self.assertEqual([line.split(',')[4:] for line in lines[1:]],
+                         [['pawn', 'GP', '2', '20.0', '15.0', 'True'], ['rook', 'KP', '1', '30.0', '', 'False']])
+
+
+class CleanupCartsTest(TestCase):
+    def setUp(self):
+        self.item = create_item('pawn', price=10, image=False)
+        Item.objects.filter(pk=self.item.pk).update(stock=6)
+
+    def cart(self, username, days_idle, quantity=2):
+        user = get_user_model().objects.create_user(username)
+        self.client.force_login(user)
+        for _ in range(quantity):
+            self.client.get('/add-to-cart/pawn/')
+        order = Order.objects.get(user=user, ordered=False)
+        Order.objects.filter(pk=order.pk).update(updated=timezone.now() - timedelta(days=days_idle))
+        return order
+
+    def test_expires_idle_carts_and_deletes_orphans(self):
+        idle = self.cart('idle', 40)
+        paying = self.cart('paying', 40)
+        PaymentJob.objects.create(order=paying, user=paying.user, amount=2000, idempotency_key='k')
+        active = self.cart('active', 1)
+        orphan = OrderItem.objects.create(user=active.user, item=create_item('rook', image=False), ordered=True)
+        self.assertEqual(Item.objects.get(pk=self.item.pk).stock, 0)
+
+        out = StringIO()
+        call_command('cleanup_carts', days=30, batch_size=1, sleep=0, stdout=out)
+
+        self.assertEqual(set(Order.objects.values_list('pk', flat=True)), {paying.pk, active.pk})
+        self.assertFalse(OrderItem.objects.filter(user=idle.user).exists())
+        self.assertFalse(OrderItem.objects.filter(pk=orphan.pk).exists())
+        self.assertEqual(OrderItem.objects.count(), 2)
+        self.assertEqual(Item.objects.get(pk=self.item.pk).stock, 2)
+        self.assertIn('Expired 1 carts', out.getvalue())
+        self.assertIn('deleted 1 orphaned order items: 4 rows', out.getvalue())
+
+
+class DedupeCartsTest(TestCase):
+    def test_one_open_order_per_user(self):
+        user = get_user_model().objects.create_user('shopper')
+        Order.objects.create(user=user, ordered_date=timezone.now())
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Order.objects.create(user=user, ordered_date=timezone.now())
+
+    def test_merges_duplicates(self):
+        with connection.cursor() as cursor:
+            # rolled back with the test
+            cursor.execute('DROP INDEX one_open_order_per_user')
+            cursor.execute('DROP INDEX one_open_order_item_per_user_item')
+        user = get_user_model().objects.create_user('shopper')
+        pawn = create_item('pawn', price=20, discount_price=15)
+        rook = create_item('rook', price=30)
+        paid = Order.objects.create(user=user, ordered=True, ordered_date=timezone.now())
+        paid.items.add(OrderItem.objects.create(user=user, item=rook))
+        first = Order.objects.create(user=user, ordered_date=timezone.now())
+        second = Order.objects.create(user=user, ordered_date=timezone.now())
+        first.items.add(OrderItem.objects.create(user=user, item=pawn, quantity=2))
+        second.items.add(OrderItem.objects.create(user=user, item=pawn, quantity=3),
+                         OrderItem.objects.create(user=user, item=rook))
+        # removed from the cart earlier
+        OrderItem.objects.create(user=user, item=pawn, quantity=1)
+
+        out = StringIO()
+        call_command('dedupe_carts', stdout=out)
+        self.assertIn('Merged 1 open orders and 2 order lines of 1 users, marked 1 paid lines', out.getvalue())
+        order = Order.objects.get(user=user, ordered=False)
+        self.assertEqual(order.pk, first.pk)
+        self.assertEqual(dict(order.items.values_list('item__slug', 'quantity')), {'pawn': 5, 'rook': 1})
+        self.assertEqual((order.total, order.item_count), (105, 2))
+        self.assertEqual(OrderItem.objects.filter(ordered=False).count(), 2)
+        self.assertTrue(paid.items.get().ordered)
+
+
+@override_settings(KEYSET_PAGINATION=True)
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        for i in range(20):
+            create_item(f'item-{i}', category='S' if i % 2 else 'GP')
+
+    def slugs(self, response):
+        return [i.slug for i in response.context['object_list']]
+
+    def test_walks_forward_and_back(self):
+        first = self.client.get('/')
+        self.assertEqual(self.slugs(first), [f'item-{i}' for i in range(8)])
+        self.assertFalse(first.context['page_obj'].has_previous())
+
+        cursor = first.context['page_obj'].next_cursor
+        second = self.client.get('/', {'cursor': cursor})
+        self.assertEqual(self.slugs(second), [f'item-{i}' for i in range(8, 16)])
+
+        back = self.client.get('/', {'cursor': second.context['page_obj'].previous_cursor})
+        self.assertEqual(self.slugs(back), self.slugs(first))
+        self.assertFalse(back.context['page_obj'].has_previous())
+
+        last = self.client.get('/', {'cursor': second.context['page_obj'].next_cursor})
+        self.assertEqual(self.slugs(last), [f'item-{i}' for i in range(16, 20)])
+        self.assertFalse(last.context['page_obj'].has_next())
+
+    def test_deep_page_has_no_count_or_offset(self):
+        cursor = self.client.get('/', {'category': 'S'}).context['page_obj'].next_cursor
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/', {'category': 'S', 'cursor': cursor})
+        self.assertEqual(self.slugs(response), ['item-17', 'item-19'])
+        self.assertFalse(any('COUNT' in q['sql'] or 'OFFSET' in q['sql'] for q in queries))
+
+    def test_keys_are_built_once_per_snapshot(self):
+        self.client.get('/', {'category': 'S'})
+        catalog = get_catalog()
+        keys = catalog.keys('id', category='S')
+        self.assertEqual(keys, [entry.id for entry in catalog.filter(category='S')])
+        with mock.patch.object(type(catalog), 'keys', return_value=keys) as cached_keys:
+            cursor = self.client.get('/', {'category': 'S'}).context['page_obj'].next_cursor
+            self.client.get('/', {'category': 'S', 'cursor': cursor})
+        cached_keys.assert_called_with('id', category='S')
+        self.assertIs(catalog.keys('id', category='S'), keys)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/', {'cursor': 'garbage!'}).status_code, 404)
+
+
+class CartViewsTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.client.force_login(self.user)
+        self.item = create_item('pawn', price=20, discount_price=15)
+
+    def add(self, slug='pawn'):
+        return self.client.get(f'/add-to-cart/{slug}/')
+
+    def test_add_creates_single_open_order(self):
+        self.add()
+        self.add()
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.items.get().quantity, 2)
+        self.assertEqual((order.total, order.discount, order.item_count), (30, 10, 1))
+
+    def test_remove_single_item_removes_line_at_one(self):
+        self.add()
+        self.add()
+        self.client.get('/remove-item-from-cart/pawn/')
+        self.assertEqual(OrderItem.objects.get().quantity, 1)
+        self.client.get('/remove-item-from-cart/pawn/')
+        order = Order.objects.get()
+        self.assertFalse(order.items.exists())
+        self.assertEqual((order.total, order.item_count), (0, 0))
+
+    def test_remove_from_cart_and_add_again(self):
+        self.add()
+        self.add()
+        self.client.get('/remove-from-cart/pawn/')
+        order = Order.objects.get()
+        self.assertEqual((order.total, order.item_count), (0, 0))
+        self.assertFalse(OrderItem.objects.exists())
+        self.add()
+        order.refresh_from_db()
+        self.assertEqual(order.items.get().quantity, 1)
+        self.assertEqual((order.total, order.item_count), (15, 1))
+
+    def test_price_change_reprices_open_carts(self):
+        self.add()
+        self.add()
+        self.item.price = 30
+        self.item.discount_price = None
+        self.item.save()
+        order = Order.objects.get()
+        self.assertEqual((order.subtotal, order.total, order.discount), (60, 60, 0))
+        self.client.get('/remove-from-cart/pawn/')
+        order.refresh_from_db()
+        self.assertEqual((order.subtotal, order.total, order.item_count), (0, 0, 0))
+
+    def test_rebuild_order_totals(self):
+        self.add()
+        Order.objects.update(total=1, item_count=5)
+        out = StringIO()
+        call_command('rebuild_order_totals', '--verify', stdout=out)
+        self.assertIn('1 of 1 orders have stale totals', out.getvalue())
+        self.assertEqual(Order.objects.get().total, 1)
+        call_command('rebuild_order_totals', stdout=StringIO())
+        order = Order.objects.get()
+        self.assertEqual((order.subtotal, order.discount, order.total, order.item_count), (20, 5, 15, 1))
+
+    def test_remove_without_order(self):
+        response = self.client.get('/remove-from-cart/pawn/')
+        self.assertRedirects(response, '/product/pawn/', fetch_redirect_response=False)
+
+    def test_cart_operations_query_budget(self):
+        self.add()
+        # session, user, item, conditional update, order totals update, messages
+        for url in ('/add-to-cart/pawn/', '/remove-item-from-cart/pawn/'):
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(url)
+            self.assertLessEqual(len(queries), 8, url)
+
+
+
+# on_commit callbacks only run outside TestCase's transaction
+class CartBadgeTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.client.force_login(self.user)
+        # no images, or the commits would start derivative workers
+        create_item('pawn', image=False)
+        create_item('rook', image=False)
+
+    def test_warm_badge_costs_no_queries(self):
+        self.client.get('/add-to-cart/pawn/')
+        self.assertEqual(get_cart_item_count(self.user), 1)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(get_cart_item_count(self.user), 1)
+        self.assertEqual(len(queries), 0)
+
+    def test_cart_changes_invalidate_the_badge(self):
+        self.client.get('/add-to-cart/pawn/')
+        self.assertEqual(get_cart_item_count(self.user), 1)
+        self.client.get('/add-to-cart/rook/')
+        self.assertIsNone(cache.get(CART_ITEM_COUNT_VERSION_KEY.format(self.user.pk)))
+        self.assertEqual(get_cart_item_count(self.user), 2)
+        self.client.get('/remove-from-cart/pawn/')
+        self.assertEqual(get_cart_item_count(self.user), 1)
+        self.client.post('/api/cart/', json.dumps({'changes': [{'slug': 'rook', 'quantity': 0}]}),
+                         content_type='application/json')
+        self.assertEqual(get_cart_item_count(self.user), 0)
+
+    def test_stale_refill_is_not_read(self):
+        self.client.get('/add-to-cart/pawn/')
+        real_first = QuerySet.first
+
+        def add_rook_meanwhile(queryset):
+            # the count is read, then a cart change commits before it is cached
+            patcher.stop()
+            count = real_first(queryset)
+            self.client.get('/add-to-cart/rook/')
+            return count
+
+        patcher = mock.patch.object(QuerySet, 'first', add_rook_meanwhile)
+        patcher.start()
+        self.assertEqual(get_cart_item_count(self.user), 1)
+        self.assertEqual(get_cart_item_count(self.user), 2)
+
+
+class GuestCartTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.item = create_item('pawn', price=20, discount_price=15)
+        self.other = create_item('rook', price=30)
+
+    def test_guest_add_writes_nothing_to_database(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/add-to-cart/pawn/')
+        self.assertRedirects(response, '/order-summary/', fetch_redirect_response=False)
+        self.assertFalse([q for q in queries if not q['sql'].startswith('SELECT')])
+        self.assertFalse(Order.objects.exists())
+        self.client.get('/add-to-cart/pawn/')
+        response = self.client.get('/order-summary/')
+        self.assertEqual(response.context['order_total'], 30)
+        self.assertEqual(response.context['cart_item_count'], 1)
+
+    def test_merge_on_login(self):
+        user = get_user_model().objects.create_user('shopper', password='secret')
+        self.client.force_login(user)
+        self.client.get('/add-to-cart/pawn/')
+        self.client.logout()
+        self.client.get('/add-to-cart/pawn/')
+        self.client.get('/add-to-cart/rook/')
+        self.client.post('/accounts/login/', {'login': 'shopper', 'password': 'secret'})
+
+        order = Order.objects.get(user=user, ordered=False)
+        self.assertEqual(dict(order.items.values_list('item__slug', 'quantity')), {'pawn': 2, 'rook': 1})
+        self.assertEqual((order.total, order.item_count), (60, 2))
+        # the guest cart is emptied after merging
+        self.client.logout()
+        self.assertEqual(self.client.get('/').context['cart_item_count'], 0)
+
+
+@override_settings(PAYMENT_BACKEND='fake', PAYMENT_JOBS_IN_PROCESS=False)
+class PaymentJobTest(TestCase):
+    def setUp(self):
+        FakeStripeBackend.reset()
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.client.force_login(self.user)
+        create_item('pawn', price=20, discount_price=15)
+        self.client.get('/add-to-cart/pawn/')
+        self.order = Order.objects.get()
+
+    def pay(self, token='tok_visa'):
+        response = self.client.post('/payment/stripe/', {'stripeToken': token})
+        return PaymentJob.objects.get(pk=response.url.split('/')[-2])
+
+    def test_charge_runs_in_worker(self):
+        job = self.pay()
+        self.assertEqual((job.status, job.amount), ('P', 1500))
+        self.assertEqual(self.client.get(f'/payment/status/{job.pk}/?format=json').json()['finished'], False)
+
+        self.assertEqual(run_pending(), 1)
+        job.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(job.status, 'S')
+        self.assertTrue(self.order.ordered)
+        self.assertEqual(self.order.payment.amount, 15)
+        line = self.order.items.get()
+        self.assertEqual((line.ordered, line.price, line.discount_price), (True, 20, 15))
+        self.assertRedirects(self.client.get(f'/payment/status/{job.pk}/'), '/', fetch_redirect_response=False)
+
+    def test_cart_is_locked_during_payment(self):
+        job = self.pay()
+        self.assertRedirects(self.client.get('/add-to-cart/pawn/'), '/order-summary/',
+                             fetch_redirect_response=False)
+        self.client.get('/remove-from-cart/pawn/')
+        response = self.client.post('/api/cart/', json.dumps({'changes': [{'slug': 'pawn', 'quantity': 3}]}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.order.items.get().quantity, 1)
+
+        run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.amount), ('S', 1500))
+        self.assertEqual(Order.objects.get(pk=self.order.pk).items.get().quantity, 1)
+
+    def test_price_change_replaces_pending_job(self):
+        job = self.pay()
+        item = Item.objects.get()
+        item.discount_price = 12
+        item.save()
+        new_job = self.pay()
+        self.assertNotEqual(new_job, job)
+        self.assertEqual(new_job.amount, 1200)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'F')
+
+    def test_price_change_before_charge_fails_job(self):
+        job = self.pay()
+        # e.g. changed by another process after the job was queued
+        Item.objects.update(discount_price=12)
+        run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), ('F', CART_CHANGED_MESSAGE))
+        self.assertEqual(FakeStripeBackend.charge_count(), 0)
+        self.assertIsNone(self.order.items.get().price)
+        self.assertEqual(self.pay().amount, 1200)
+
+    def test_charges_recalculated_total(self):
+        # stored totals that drifted from the line prices
+        Order.objects.update(total=1)
+        job = self.pay()
+        self.assertEqual(job.amount, 1500)
+        self.assertEqual(Order.objects.get().total, 15)
+
+    def test_double_submit_and_rerun_charge_once(self):
+        job = self.pay()
+        self.assertEqual(self.pay(), job)
+        process_job(claim_job())
+        # a worker that died after charging re-runs the job with the same key
+        PaymentJob.objects.filter(pk=job.pk).update(status='P')
+        process_job(claim_job())
+        self.assertEqual(FakeStripeBackend.charge_count(), 1)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_declined_card(self):
+        job = self.pay('tok_chargeDeclined')
+        run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), ('F', 'Twoja karta została odrzucona.'))
+        self.assertFalse(Order.objects.get().ordered)
+        self.assertNotEqual(self.pay(), job)
+
+
+class MetricsTest(TestCase):
+    def test_metrics_per_view(self):
+        create_item('pawn')
+        self.client.get('/product/pawn/')
+        staff = get_user_model().objects.create_user('staff', is_staff=True)
+        self.client.force_login(staff)
+        body = self.client.get('/metrics/').content.decode()
+        self.assertIn('storefront_request_latency_seconds_count{method="GET",view="core:product"}', body)
+        self.assertIn('storefront_request_db_queries_bucket{le="0.0",view="core:product"}', body)
+        self.assertIn('storefront_cache_total{outcome="miss",view="core:product"}', body)
+
+    @override_settings(METRICS_TOKEN='scrape')
+    def test_metrics_access(self):
+        # local requests are no exception, they may come through a proxy
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='127.0.0.1').status_code, 403)
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer scrape').status_code, 200)
+
+    def test_query_count_is_not_capped(self):
+        stats = metrics.start_request()
+        recorder = metrics.QueryRecorder()
+        try:
+            with connection.execute_wrapper(recorder):
+                for _ in range(recorder.max_recorded + 5):
+                    Item.objects.exists()
+        finally:
+            metrics.end_request()
+        self.assertEqual(stats.query_count, recorder.max_recorded + 5)
+        self.assertEqual(len(stats.queries), recorder.max_recorded)
+
+    @override_settings(SLOW_REQUEST_THRESHOLD_MS=0)
+    def test_slow_request_log_has_sql(self):
+        create_item('pawn')
+        with self.assertLogs('core.slow_requests', 'WARNING') as logs:
+            self.client.get('/product/pawn/')
+        self.assertIn('core_item', logs.output[0])
+
+
+class DatabaseConnectionTest(TestCase):
+    def sample(self, name):
+        return REGISTRY.get_sample_value(name, {'alias': 'default'}) or 0
+
+    def test_broken_connection_is_closed(self):
+        connection.ensure_connection()
+        failures = self.sample('storefront_db_health_check_failures_total')
+        with mock.patch.dict(connection.settings_dict, CONN_HEALTH_CHECKS=True), \
+                mock.patch.object(connection, 'is_usable', return_value=False), \
+                mock.patch.object(connection, 'close') as close:
+            check_connections()
+        close.assert_called_once_with()
+        self.assertEqual(self.sample('storefront_db_health_check_failures_total'), failures + 1)
+
+    def test_recently_used_connection_is_not_checked(self):
+        connection.ensure_connection()
+        with mock.patch.dict(connection.settings_dict, CONN_HEALTH_CHECKS=True, CONN_HEALTH_CHECK_IDLE=60), \
+                mock.patch.object(connection, 'is_usable', return_value=True) as is_usable:
+            release_connections()
+            check_connections()
+            is_usable.assert_not_called()
+            connection.errors_occurred = True
+            try:
+                check_connections()
+            finally:
+                connection.errors_occurred = False
+            is_usable.assert_called_once_with()
+
+    @override_settings(DB_POOL_SIZE=0)
+    def test_connections_over_pool_size_are_closed(self):
+        connection.ensure_connection()
+        with mock.patch.object(connection, 'close') as close:
+            release_connections()
+        close.assert_called_once_with()
+
+    def test_pool_stats(self):
+        reused = self.sample('storefront_db_connections_reused_total')
+        self.client.get('/')
+        self.assertEqual(self.sample('storefront_db_connections_reused_total'), reused + 1)
+        self.assertGreaterEqual(self.sample('storefront_db_connections_open'), 1)
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2'], REPLICA_MODELS=['core.item'], REPLICA_MAX_LAG=5)
+class ReplicaRouterTest(SimpleTestCase):
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.lag = {'replica1': 0, 'replica2': 0}
+        patcher = mock.patch('core.routers.current_lag', side_effect=self.lag.get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_catalog_reads_go_to_one_replica(self):
+        self.assertEqual(self.router.db_for_read(Item), 'default')
+        with replica_reads():
+            replica = self.router.db_for_read(Item)
+            self.assertIn(replica, ['replica1', 'replica2'])
+            self.assertEqual(self.router.db_for_read(Item), replica)
+            self.assertEqual(self.router.db_for_read(Order), 'default')
+
+    def test_reads_after_write_stay_on_primary(self):
+        with replica_reads():
+            self.assertEqual(self.router.db_for_write(Item), 'default')
+            self.assertEqual(self.router.db_for_read(Item), 'default')
+        with replica_reads(), mock.patch.object(connections['default'], 'in_atomic_block', True):
+            self.assertEqual(self.router.db_for_read(Item), 'default')
+
+    def test_lagging_replicas_are_skipped(self):
+        self.lag['replica1'] = 60
+        with replica_reads():
+            self.assertEqual(self.router.db_for_read(Item), 'replica2')
+        self.lag['replica2'] = float('inf')
+        with replica_reads():
+            self.assertEqual(self.router.db_for_read(Item), 'default')
+
+
+class LoadTest(LiveServerTestCase):
+    def test_run_load(self):
+        create_item('pawn', image=False)
+        result = run_load(self.live_server_url, ['/', '/product/pawn/'], concurrency=2, duration=0.5)
+        self.assertGreater(result['requests'], 0)
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(list(result['statuses']), ['200'])
+
+
+class AsgiTest(SimpleTestCase):
+    @override_settings(METRICS_TOKEN='scrape')
+    def test_asgi_application(self):
+        from asgiref.testing import ApplicationCommunicator
+        from onlineStore.asgi import application
+
+        async def request():
+            communicator = ApplicationCommunicator(application, {
+                'type': 'http', 'method': 'GET', 'path': '/metrics/', 'query_string': b'',
+                'headers': [(b'authorization', b'Bearer scrape')],
+                'client': ('127.0.0.1', 1234), 'server': ('testserver', 80),
+            })
+            await communicator.send_input({'type': 'http.request'})
+            return await communicator.receive_output(5)
+
+        self.assertEqual(async_to_sync(request)()['status'], 200)
+
+
+class QueryBudgetTest(TestCase):
+    def test_views_stay_within_query_budgets(self):
+        cache.clear()
+        user = generate_data(items=200, users=1, past_orders=2, cart_lines=20)[0]
+        results = run_benchmark(user, repeat=2)
+        self.assertEqual(set(results), set(QUERY_BUDGETS))
+        for name, result in results.items():
+            with self.subTest(view=name):
+                self.assertLess(result['status'], 400)
+                self.assertLessEqual(result['queries'], result['query_budget'])
+        renders = run_render_benchmark(user, repeat=2)
+        self.assertIn('checkout.html', renders)
+        self.assertEqual(set(renders['base.html']), {'development', 'production', 'speedup'})
+
+
+# lock waits make these requests slow on purpose
+@override_settings(SLOW_REQUEST_THRESHOLD_MS=60000)
+class ConcurrentCartTest(TransactionTestCase):
+    threads = 8
+    clicks = 10
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('shopper', password='secret')
+        self.item = create_item('pawn', price=10, image=False)
+
+    def hammer(self, url, errors):
+        client = Client()
+        client.force_login(self.user)
+        try:
+            for _ in range(self.clicks):
+                response = client.get(url)
+                if response.status_code != 302:
+                    errors.append(response.status_code)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connections.close_all()
+
+    def run_threads(self, url):
+        errors = []
+        workers = [threading.Thread(target=self.hammer, args=(url, errors))
+                   for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+
+    def test_concurrent_adds_are_not_lost(self):
+        self.run_threads('/add-to-cart/pawn/')
+        order = Order.objects.get(user=self.user, ordered=False)
+        expected = self.threads * self.clicks
+        self.assertEqual(order.items.get().quantity, expected)
+        self.assertEqual(order.total, expected * 10)
+        self.assertEqual(order.item_count, 1)
+
+        self.run_threads('/remove-item-from-cart/pawn/')
+        order.refresh_from_db()
+        self.assertFalse(order.items.exists())
+        self.assertEqual((order.total, order.item_count), (0, 0))
+
+
+@override_settings(SLOW_REQUEST_THRESHOLD_MS=60000)
+class StockContentionTest(TransactionTestCase):
+    # Many buyers, one hot item: nobody gets more than is in stock
+    buyers = 120
+    threads = 12
+    stock = 40
+
+    def setUp(self):
+        self.item = create_item('pawn', price=10, image=False)
+        Item.objects.filter(pk=self.item.pk).update(stock=self.stock)
+        User = get_user_model()
+        User.objects.bulk_create([User(username=f'buyer-{i}') for i in range(self.buyers)])
+        self.users = list(User.objects.all())
+
+    def buy(self, users, url, results):
+        try:
+            for user in users:
+                client = Client()
+                client.force_login(user)
+                results.append(client.get(url)['Location'])
+        except Exception as e:
+            results.append(e)
+        finally:
+            connections.close_all()
+
+    def run_buyers(self, url, threads=None):
+        threads = threads or self.threads
+        results = []
+        workers = [threading.Thread(target=self.buy, args=(self.users[n::threads], url, results))
+                   for n in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results
+
+    def test_no_oversell(self):
+        results = self.run_buyers('/add-to-cart/pawn/')
+        self.assertEqual(results.count('/order-summary/'), self.stock)
+        self.assertEqual(results.count('/product/pawn/'), self.buyers - self.stock)
+        self.assertEqual(Item.objects.get().stock, 0)
+        self.assertEqual(sum(OrderItem.objects.values_list('quantity', flat=True)), self.stock)
+        self.assertEqual(sum(StockReservation.objects.values_list('quantity', flat=True)), self.stock)
+
+        # SQLite can't lock rows, so concurrent read-then-write cart changes
+        # fail there with "database is locked"; release from one thread
+        self.run_buyers('/remove-from-cart/pawn/', threads=1)
+        self.assertEqual(Item.objects.get().stock, self.stock)
+        self.assertEqual(sum(StockReservation.objects.values_list('quantity', flat=True)), 0)
@@ -8,18 +8,28 @@ from .views import \
     add_to_cart,
     remove_from_cart,
     remove_single_item_from_cart,
-    PaymentView
+    PaymentView,
+    PaymentStatusView,
+    SearchView,
+    search_suggestions,
+    cart_api,
+    metrics
 )
 
 app_name = 'core'
 
 urlpatterns = [
     path('', HomeView.as_view(), name='home'),
+    path('search/', SearchView.as_view(), name='search'),
     path('checkout/', CheckoutView.as_view(), name='checkout'),
     path('product/<slug>/', ItemDetailView.as_view(), name='product'),
     path('add-to-cart/<slug>/', add_to_cart, name='add-to-cart'),
     path('remove-from-cart/<slug>/', remove_from_cart, name='remove-from-cart'),
     path('order-summary/', OrderSummaryView.as_view(), name='order-summary'),
     path('remove-item-from-cart/<slug>/', remove_single_item_from_cart, name='remove-single-item-from-cart'),
-    path('payment/<payment_option>/', PaymentView.as_view(), name='payment')
+    path('payment/status/<int:pk>/', PaymentStatusView.as_view(), name='payment-status'),
+    path('payment/<payment_option>/', PaymentView.as_view(), name='payment'),
+    path('api/cart/', cart_api, name='cart-api'),
+    path('api/search/', search_suggestions, name='search-api'),
+    path('metrics/', metrics, name='metrics')
 ]
@@ -1,45 +1,156 @@
+import json
+import mimetypes
+from functools import wraps
+
 from django.shortcuts import render, get_object_or_404, redirect
-from django.core.exceptions import ObjectDoesNotExist
-from django.contrib.auth.decorators import login_required
+from django.http import Http404, HttpResponse, JsonResponse
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db import transaction
+from django.db.models import F
 from django.views.generic import ListView, DetailView, View
 from django.utils import timezone
-from .models import Item, OrderItem, Order, BillingAddress, Payment
+from django.utils.crypto import constant_time_compare
+from django.utils.http import urlencode
+from django.views.static import serve
+from .models import Item, OrderItem, Order, BillingAddress, PaymentJob, CATEGORY_CHOICES, LABEL_CHOICES
+from .catalog import cart_lines, get_catalog, get_categories, get_entries, get_entry_by_slug
+from .pagination import KeysetPaginationMixin
+from .routers import ReplicaReadMixin, replica_reads
+from .storage import HASHED_NAME, IMMUTABLE, compressed_variant
+from .fragments import render_cached_fragment
 from .forms import CheckoutForm
+from .cart import (
+    GuestCart, OutOfStock, PaymentInProgress, apply_cart_changes, apply_guest_cart_changes,
+    check_no_payment_in_progress, invalidate_cart_item_count, lock_cart, valid_change
+)
+from .payments import enqueue_payment
+from .search import search_items
+from .stock import release, reserve, reserve_order
+from .metrics import render_metrics
+from prometheus_client import CONTENT_TYPE_LATEST
 from django.contrib import messages
 
-from django.conf import settings
-import stripe
-stripe.api_key = settings.STRIPE_SECRET_KEY
-
 # Create your views here.
 
 
-class HomeView(ListView):
+class HomeView(ReplicaReadMixin, KeysetPaginationMixin, ListView):
     model = Item
     paginate_by = 8
+    ordering = 'id'
     template_name = "home.html"
 
-
-class OrderSummaryView(LoginRequiredMixin, View):
+    def get_filters(self):
+        # ?category=GP&label=P, unknown values are ignored
+        filters = {}
+        category = self.request.GET.get('category')
+        if category in dict(CATEGORY_CHOICES):
+            filters['category'] = category
+        label = self.request.GET.get('label')
+        if label in dict(LABEL_CHOICES):
+            filters['label'] = label
+        return filters
+
+    def get_queryset(self):
+        # Entries of the in-memory catalog snapshot, in id order
+        self.catalog = get_catalog()
+        return self.catalog.filter(**self.get_filters())
+
+    def keyset_keys(self, rows):
+        # Built once per snapshot, not per request
+        return self.catalog.keys(self.keyset_field, **self.get_filters())
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        filters = self.get_filters()
+        context['categories'] = get_categories()
+        context['current_category'] = filters.get('category')
+        context['filter_query'] = urlencode(filters)
+        items = list(context['object_list'])
+        context['item_cards'] = render_cached_fragment(
+            'item-cards', 'item_cards.html', items, {'object_list': items})
+        return context
+
+
+class SearchView(HomeView):
+    # Ranked full-text results for ?q=, see core/search.py
+    keyset_pagination = False
+    max_results = 200
+
+    def get_query(self):
+        return self.request.GET.get('q', '').strip()[:100]
+
+    def get_queryset(self):
+        pks = search_items(self.get_query(), limit=self.max_results)
+        entries = get_entries(pks)
+        return [entries[pk] for pk in pks if pk in entries]
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['query'] = self.get_query()
+        context['filter_query'] = urlencode({'q': context['query']})
+        return context
+
+
+@replica_reads()
+def search_suggestions(request):
+    # Typeahead for the search box in home.html
+    pks = search_items(request.GET.get('q', '')[:100], limit=8)
+    entries = get_entries(pks)
+    return JsonResponse({'results': [{
+        'title': entries[pk].title,
+        'url': entries[pk].get_absolute_url,
+        'price': entries[pk].effective_price,
+    } for pk in pks if pk in entries]})
+
+
+class OrderSummaryView(View):
     def get(self, *args, **kwargs):
+        if not self.request.user.is_authenticated:
+            return self.get_guest()
         try:
             order = Order.objects.get(user=self.request.user, ordered=False)
             context = {
-                'object': order
+                'order_items': cart_lines(order.items.values_list('item_id', 'quantity')),
+                'order_total': order.get_total()
             }
             return render(self.request, 'order_summary.html', context)
         except ObjectDoesNotExist:
             messages.error(self.request, "Nie masz aktywnego zamówienia")
             return redirect("/")
 
+    def get_guest(self):
+        cart = GuestCart.from_request(self.request)
+        if not cart.lines:
+            messages.error(self.request, "Nie masz aktywnego zamówienia")
+            return redirect("/")
+        order_items = cart.order_items()
+        context = {
+            'order_items': order_items,
+            'order_total': round(sum(order_item.get_final_price() for order_item in order_items), 2)
+        }
+        return render(self.request, 'order_summary.html', context)
+
 
-class ItemDetailView(DetailView):
+class ItemDetailView(ReplicaReadMixin, DetailView):
     model = Item
     template_name = "product.html"
 
+    def get_object(self, queryset=None):
+        entry = get_entry_by_slug(self.kwargs['slug'])
+        if entry is None:
+            raise Http404("Nie znaleziono produktu.")
+        return entry
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['product_html'] = render_cached_fragment(
+            'product', 'product_detail.html', [self.object], {'object': self.object})
+        return context
+
 
-class CheckoutView(View):
+class CheckoutView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
         # form
         form = CheckoutForm()
@@ -69,6 +180,8 @@ class CheckoutView(View):
                 )
                 billing_address.save()
                 order.billing_address = billing_address
+                # Totals as the payment will charge them
+                order.recalculate_totals(commit=False)
                 order.save()
 
                 if payment_option == 'S':
@@ -86,9 +199,11 @@ class CheckoutView(View):
             return redirect("core:order-summary")
 
 
-class PaymentView(View):
+class PaymentView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
         order = Order.objects.get(user=self.request.user, ordered=False)
+        # The amount shown is the amount enqueue_payment will charge
+        order.recalculate_totals(commit=False)
         context = {
             'order': order
         }
@@ -96,160 +211,305 @@ class PaymentView(View):
 
     def post(self, *args, **kwargs):
         order = Order.objects.get(user=self.request.user, ordered=False)
+        missing = reserve_order(order)
+        if missing:
+            messages.warning(self.request, "Niektóre produkty są niedostępne w tej ilości: {}".format(
+                ", ".join(item.title for item in missing)))
+            return redirect("core:order-summary")
         token = self.request.POST.get('stripeToken')
-        amount = int(order.get_total() * 100)
+        # The charge itself runs in the payment worker, see core/payments.py
+        job = enqueue_payment(order, token)
+        return redirect('core:payment-status', pk=job.pk)
 
-        try:
-            charge = stripe.Charge.create(
-                amount=amount,
-                currency='pln',
-                source=token,
-                description = "Charge for jenny.rosen@example.com"
-            )
-            payment = Payment()
-            payment.stripe_charge_id = charge['id']
-            payment.user = self.request.user
-            payment.amount = order.get_total()
-            payment.save()
-
-            order.ordered = True
-            order.payment = payment
-            order.save()
 
+class PaymentStatusView(LoginRequiredMixin, View):
+    def get(self, *args, **kwargs):
+        job = get_object_or_404(PaymentJob, pk=kwargs['pk'], user=self.request.user)
+        if self.request.GET.get('format') == 'json':
+            return JsonResponse({
+                'status': job.get_status_display(),
+                'finished': job.is_finished(),
+                'error': job.error
+            })
+        if job.status == 'S':
             messages.success(self.request, "Proces składania zamówienia przebiegł pomyślnie.")
             return redirect("/")
-
-        except stripe.error.CardError as e:
-            body = e.json_body
-            err = body.get('error', {})
-            # Since it's a decline, stripe.error.CardError will be caught
-            messages.error(self.request, f"{err.get('message')}")
+        if job.status == 'F':
+            messages.error(self.request, job.error)
             return redirect("/")
+        return render(self.request, "payment_status.html", {'job': job})
+
+
+def metrics(request):
+    # Prometheus scrape endpoint, for staff and scrapers sending
+    # "Authorization: Bearer <METRICS_TOKEN>". Not by client address: behind
+    # a local reverse proxy every request comes from 127.0.0.1.
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not (request.user.is_staff or
+            token and constant_time_compare(authorization, f'Bearer {token}')):
+        raise PermissionDenied
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE_LATEST)
+
+
+def _cart_json(order_items, item_count):
+    lines = [{
+        'slug': order_item.item.slug,
+        'title': order_item.item.title,
+        'quantity': order_item.quantity,
+        'price': order_item.item.discount_price or order_item.item.price,
+        'total': round(order_item.get_final_price(), 2),
+        'saved': round(order_item.get_amount_saved(), 2) if order_item.item.discount_price else 0,
+    } for order_item in order_items]
+    return {
+        'lines': lines,
+        'subtotal': round(sum(order_item.get_total_item_price() for order_item in order_items), 2),
+        'total': round(sum(line['total'] for line in lines), 2),
+        'cart_item_count': item_count,
+    }
 
-        except stripe.error.RateLimitError as e:
-            # Too many requests made to the API too quickly
-            messages.error(self.request, "Osiągnięto limit zamówień")
-            return redirect("/")
 
-        except stripe.error.InvalidRequestError as e:
-            # Invalid parameters were supplied to Stripe's API
-            messages.error(self.request, "Nieprawidłowe dane")
-            return redirect("/")
+def _parse_cart_changes(body):
+    # {"changes": [{"slug": "...", "quantity": 3}, {"slug": "...", "delta": -1}, ...]}
+    try:
+        changes = json.loads(body)['changes']
+        if not isinstance(changes, list) or not changes or len(changes) > 100:
+            raise ValueError
+        for change in changes:
+            if not isinstance(change.get('slug'), str) or not valid_change(change):
+                raise ValueError
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    items = {item.slug: item for item in Item.objects.filter(slug__in={change['slug'] for change in changes})}
+    if len(items) < len({change['slug'] for change in changes}):
+        return None
+    return [(items[change['slug']], change) for change in changes]
+
+
+def cart_api(request):
+    """
+    GET returns the cart, POST applies a batch of line changes in one
+    transaction and returns the updated cart, for order_summary.html.
+    """
+    if request.method not in ('GET', 'POST'):
+        return JsonResponse({'error': 'Niedozwolona metoda.'}, status=405)
+    if request.method == 'POST':
+        changes = _parse_cart_changes(request.body)
+        if changes is None:
+            return JsonResponse({'error': 'Nieprawidłowe dane.'}, status=400)
+
+    if not request.user.is_authenticated:
+        cart = GuestCart.from_request(request)
+        if request.method == 'POST':
+            try:
+                apply_guest_cart_changes(cart, changes)
+            except OutOfStock as e:
+                return JsonResponse({'error': f"Produkty niedostępne w tej ilości: {e}"}, status=409)
+        response = JsonResponse(_cart_json(cart.order_items(), len(cart)))
+        if request.method == 'POST':
+            cart.save(response)
+        return response
+
+    if request.method == 'POST':
+        try:
+            order = apply_cart_changes(request.user, changes)
+        except OutOfStock as e:
+            return JsonResponse({'error': f"Produkty niedostępne w tej ilości: {e}"}, status=409)
+        except PaymentInProgress:
+            return JsonResponse({'error': "Trwa płatność za ten koszyk."}, status=409)
+    else:
+        order = Order.objects.filter(user=request.user, ordered=False).first()
+    if order is None:
+        return JsonResponse(_cart_json([], 0))
+    order_items = cart_lines(order.items.values_list('item_id', 'quantity'))
+    return JsonResponse(_cart_json(order_items, order.item_count))
+
+
+def static_file(request, path):
+    # Serves STATIC_ROOT without a front web server: pre-compressed variants
+    # when the client accepts them, hashed names cached for good
+    encoding, name = compressed_variant(path, request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    response = serve(request, name, document_root=settings.STATIC_ROOT)
+    if encoding:
+        response['Content-Encoding'] = encoding
+        response['Content-Type'] = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    response['Vary'] = 'Accept-Encoding'
+    if HASHED_NAME.search(path):
+        response['Cache-Control'] = IMMUTABLE
+    return response
+
+
+@replica_reads()
+def product(request):
+    context = {
+        'items': get_catalog().items
+    }
 
-        except stripe.error.AuthenticationError as e:
-            # Authentication with Stripe's API failed
-            # (maybe you changed API keys recently)
-            messages.error(self.request, "Błąd podczas uwierzytelniania")
-            return redirect("/")
+    return render(request, "product.html", context)
 
-        except stripe.error.APIConnectionError as e:
-            # Network communication with Stripe failed
-            messages.error(self.request, "Błąd połączenia z siecią")
-            return redirect("/")
 
-        except stripe.error.StripeError as e:
-            # Display a very generic error to the user, and maybe send
-            # yourself an email
-            messages.error(self.request, "Coś poszło nie tak. Spróbuj jeszcze raz")
-            return redirect("/")
+def _open_orders(user):
+    return Order.objects.filter(user=user, ordered=False)
 
-        except Exception as e:
-            # Something else happened, completely unrelated to Stripe
-            messages.error(self.request, "Niespodziewany błąd. Proszę skontaktuj się z administratorem")
-            return redirect("/")
+
+def _open_order_items(user, item):
+    # Lines of `item` that belong to the user's open order
+    return OrderItem.objects.filter(
+        user=user,
+        item=item,
+        ordered=False,
+        order__user=user,
+        order__ordered=False)
 
 
+def _increment_quantity(user, item):
+    updated = _open_order_items(user, item).update(quantity=F('quantity') + 1)
+    if updated:
+        _open_orders(user).update(**Order.totals_delta(item, quantity=updated))
+    return updated
 
 
-def product(request):
-    context = {
-        'items': Item.objects.all()
-    }
+def _guest_cart_response(request, cart, message):
+    messages.info(request, message)
+    response = redirect("core:order-summary")
+    cart.save(response)
+    return response
 
-    return render(request, "product.html", context)
+
+def refuse_during_payment(view):
+    # Cart changes raising PaymentInProgress are rolled back
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except PaymentInProgress:
+            messages.warning(request, "Trwa płatność za ten koszyk. Poczekaj na jej zakończenie.")
+            return redirect("core:order-summary")
+    return wrapper
 
 
-@login_required
+@refuse_during_payment
 def add_to_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_item, created = OrderItem.objects.get_or_create(
+    if not request.user.is_authenticated:
+        if item.stock == 0:
+            messages.warning(request, "Produkt jest niedostępny.")
+            return redirect("core:product", slug=slug)
+        cart = GuestCart.from_request(request)
+        message = "Liczba produktów została zaktualizowana." if item.pk in cart \
+            else "Produkt został dodany do twojego koszyka."
+        cart.add(item.pk)
+        return _guest_cart_response(request, cart, message)
+    with transaction.atomic():
+        message = _add_to_cart(request.user, item)
+        check_no_payment_in_progress(request.user)
+        # Reserved last, after the cart rows, see core/stock.py
+        if not reserve(request.user, item):
+            transaction.set_rollback(True)
+            message = None
+    if message is None:
+        messages.warning(request, "Produkt jest niedostępny.")
+        return redirect("core:product", slug=slug)
+    messages.info(request, message)
+    return redirect("core:order-summary")
+
+
+def _add_to_cart(user, item):
+    # Fast path: the item is already in the cart, bump it in place
+    updated = _increment_quantity(user, item)
+    if not updated:
+        lock_cart(user)
+        # another request may have added the item while we were waiting
+        updated = _increment_quantity(user, item)
+    if updated:
+        return "Liczba produktów została zaktualizowana."
+
+    order = _open_orders(user).first()
+    if order is None:
+        order = Order.objects.create(user=user, ordered_date=timezone.now())
+    order_item, created = OrderItem.objects.update_or_create(
         item=item,
-        user=request.user,
-        ordered=False)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(request, "Liczba produktów została zaktualizowana.")
-            return redirect("core:order-summary")
-        else:
-            order.items.add(order_item)
-            messages.info(request, "Produkt został dodany do twojego koszyka.")
-            return redirect("core:order-summary")
-    else:
-        ordered_date = timezone.now()
-        order = Order.objects.create(user=request.user, ordered_date=ordered_date)
-        order.items.add(order_item)
-        messages.info(request, "Produkt został dodany do twojego koszyka.")
-        return redirect("core:order-summary")
+        user=user,
+        ordered=False,
+        defaults={'quantity': 1})
+    order.items.add(order_item)
+    order.update_totals(item, quantity=1, lines=1)
+    invalidate_cart_item_count(user)
+    return "Produkt został dodany do twojego koszyka."
 
 
-@login_required
+@refuse_during_payment
 def remove_from_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(
-        user=request.user,
-        ordered=False
-    )
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.get_or_create(
-                item=item,
-                user=request.user,
-                ordered=False)[0]
-            order_item.quantity = 1
-            order_item.save()
-            order.items.remove(order_item)
-            messages.info(request, "Produkt został usunięty z twojego koszyka.")
-            return redirect("core:order-summary")
-        else:
+    if not request.user.is_authenticated:
+        cart = GuestCart.from_request(request)
+        if item.pk not in cart:
             messages.info(request, "Produkt nie był w twoim koszyku.")
             return redirect("core:product", slug=slug)
-    else:
-        messages.info(request, "Nie masz aktywnego zamówenia.")
-        return redirect("core:product", slug=slug)
+        cart.remove(item.pk)
+        return _guest_cart_response(request, cart, "Produkt został usunięty z twojego koszyka.")
+    with transaction.atomic():
+        lock_cart(request.user)
+        order = _open_orders(request.user).first()
+        if order is None:
+            messages.info(request, "Nie masz aktywnego zamówenia.")
+            return redirect("core:product", slug=slug)
+        # check if item is in the order; locked, an increment on the fast
+        # path doesn't take lock_cart and would change the quantity we undo
+        order_item = order.items.select_for_update().filter(item=item).first()
+        if order_item is None:
+            messages.info(request, "Produkt nie był w twoim koszyku.")
+            return redirect("core:product", slug=slug)
+        # Deleting the line also unlinks it, no orphan row is left behind
+        OrderItem.objects.filter(pk=order_item.pk).delete()
+        order.update_totals(item, quantity=-order_item.quantity, lines=-1)
+        invalidate_cart_item_count(request.user)
+        check_no_payment_in_progress(request.user)
+        release(request.user, item, order_item.quantity)
+    messages.info(request, "Produkt został usunięty z twojego koszyka.")
+    return redirect("core:order-summary")
 
 
-@login_required
+@refuse_during_payment
 def remove_single_item_from_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(
-        user=request.user,
-        ordered=False
-    )
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.get_or_create(
-                item=item,
-                user=request.user,
-                ordered=False)[0]
-            if order_item.quantity > 1:
-                order_item.quantity -= 1
-                order_item.save()
-            else:
-                order.items.remove(order_item)
+    if not request.user.is_authenticated:
+        cart = GuestCart.from_request(request)
+        if item.pk not in cart:
+            messages.info(request, "Produkt nie był w twoim koszyku.")
+            return redirect("core:product", slug=slug)
+        cart.remove_single(item.pk)
+        return _guest_cart_response(request, cart, "Liczba produktów została zaktualizowana.")
+    with transaction.atomic():
+        # Fast path: more than one unit in the cart, decrement in place
+        updated = _open_order_items(request.user, item) \
+            .filter(quantity__gt=1) \
+            .update(quantity=F('quantity') - 1)
+        if updated:
+            _open_orders(request.user).update(**Order.totals_delta(item, quantity=-updated))
+            check_no_payment_in_progress(request.user)
+            release(request.user, item, updated)
             messages.info(request, "Liczba produktów została zaktualizowana.")
             return redirect("core:order-summary")
-        else:
+
+        lock_cart(request.user)
+        order = _open_orders(request.user).first()
+        if order is None:
+            messages.info(request, "Nie masz aktywnego zamówenia.")
+            return redirect("core:product", slug=slug)
+        # check if item is in the order; locked like in remove_from_cart
+        order_item = order.items.select_for_update().filter(item=item).first()
+        if order_item is None:
             messages.info(request, "Produkt nie był w twoim koszyku.")
             return redirect("core:product", slug=slug)
-    else:
-        messages.info(request, "Nie masz aktywnego zamówenia.")
-        return redirect("core:product", slug=slug)
+        if order_item.quantity > 1:
+            OrderItem.objects.filter(pk=order_item.pk).update(quantity=F('quantity') - 1)
+            order.update_totals(item, quantity=-1)
+        else:
+            OrderItem.objects.filter(pk=order_item.pk).delete()
+            order.update_totals(item, quantity=-1, lines=-1)
+            invalidate_cart_item_count(request.user)
+        check_no_payment_in_progress(request.user)
+        release(request.user, item, 1)
+    messages.info(request, "Liczba produktów została zaktualizowana.")
+    return redirect("core:order-summary")
@@ -0,0 +1,18 @@
+"""
+ASGI entry point, e.g. for
+
+    gunicorn -k uvicorn.workers.UvicornWorker onlineStore.asgi:application
+
+This is only the entry point, there are no async views: they need Django
+3.1+. Django 3.0 runs the synchronous views in a thread pool under ASGI, so
+a request still holds a thread for the whole view, database and Stripe calls
+included. `python manage.py loadtest` compares this server with the WSGI one,
+not async code with sync code.
+"""
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'onlineStore.settings')
+
+application = get_asgi_application()
@@ -3,7 +3,13 @@ from .settings import *
 
 DEBUG = True
 ALLOWED_HOSTS += ['*']
-WSGI_APPLICATION = 'market.wsgi.application'
+WSGI_APPLICATION = 'onlineStore.wsgi.application'
+
+# Production template mode, see settings.py
+TEMPLATE_CACHE = os.getenv('TEMPLATE_CACHE', 'true') == 'true'
+if TEMPLATE_CACHE:
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = CACHED_TEMPLATE_LOADERS
 
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
@@ -12,19 +18,71 @@ AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.NumericPasswordValidator'},
 ]
 
+# Connections are persistent (one per worker thread, reused for
+# DB_CONN_MAX_AGE seconds) so requests don't pay the TLS handshake and login
+# to Azure each time. CONN_HEALTH_CHECKS is checked by core.db before reusing
+# a connection idle for CONN_HEALTH_CHECK_IDLE seconds; DB_POOL_SIZE caps the
+# connections kept open per process and alias.
+# Pool stats are on /metrics/ (storefront_db_connections_*). Against a local
+# Postgres leave POSTGRES_SERVER_NAME unset and set POSTGRES_SSLMODE=disable.
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql_psycopg2',
         'NAME': os.getenv('APP_DB_NAME'),
-        'USER': '{}@{}'.format(os.getenv('POSTGRES_ADMIN_USER'), os.getenv('POSTGRES_SERVER_NAME')),
+        'USER': '@'.join(filter(None, [os.getenv('POSTGRES_ADMIN_USER'), os.getenv('POSTGRES_SERVER_NAME')])),
         'PASSWORD': os.getenv('POSTGRES_ADMIN_PASSWORD'),
         'HOST': os.getenv('POSTGRES_HOST'),
-        'PORT': '5432',
-        'OPTIONS': {'sslmode': 'require'},
+        'PORT': os.getenv('POSTGRES_PORT', '5432'),
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': os.getenv('DB_CONN_HEALTH_CHECKS', 'true') == 'true',
+        'CONN_HEALTH_CHECK_IDLE': int(os.getenv('DB_CONN_HEALTH_CHECK_IDLE', 30)),
+        'OPTIONS': {
+            'sslmode': os.getenv('POSTGRES_SSLMODE', 'require'),
+            'connect_timeout': 5,
+            # Azure's load balancer drops connections idle for about 4 minutes
+            'keepalives': 1,
+            'keepalives_idle': 60,
+            'keepalives_interval': 10,
+            'keepalives_count': 3,
+        },
     }
 }
 
-STATICFILES_STORAGE = 'storages.backends.azure_storage.AzureStorage'
+# Read replicas, e.g. POSTGRES_REPLICA_HOSTS=replica-1.postgres.database.azure.com.
+# Azure logins name the server, which is the first part of the replica's host.
+for n, host in enumerate(filter(None, os.getenv('POSTGRES_REPLICA_HOSTS', '').replace(' ', '').split(',')), 1):
+    DATABASES[f'replica{n}'] = dict(
+        DATABASES['default'],
+        HOST=host,
+        USER='@'.join(filter(None, [os.getenv('POSTGRES_ADMIN_USER'),
+                                    os.getenv('POSTGRES_SERVER_NAME') and host.split('.')[0]])),
+        TEST={'MIRROR': 'default'}
+    )
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+
+# Cache shared by all app service instances: memcached when configured,
+# otherwise a table in the app database (python manage.py createcachetable)
+if os.getenv('MEMCACHED_LOCATION'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': os.getenv('MEMCACHED_LOCATION'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'django_cache',
+        }
+    }
+
+# Content-hashed names, so blobs can be cached by browsers and CDNs for good.
+# AzureManifestStorage links them even with DEBUG on and sends
+# AZURE_CACHE_CONTROL only for them.
+STATICFILES_STORAGE = 'core.storage.AzureManifestStorage'
+AZURE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
 AZURE_ACCOUNT_NAME = os.getenv('AZ_STORAGE_ACCOUNT_NAME')
 AZURE_CONTAINER = os.getenv('AZ_STORAGE_CONTAINER')
 AZURE_ACCOUNT_KEY = os.getenv('AZ_STORAGE_KEY')
@@ -9,6 +9,15 @@ SECRET_KEY = '-05sgp9!deq=q1nltm@^^2cc+v29i(tyybv3v2t77qi66czazj'
 ALLOWED_HOSTS = []
 STRIPE_PUBLIC_KEY = 'pk_test_51Gu3LxF4Yj6onjd3k6AqB465OFjwq9bDlmTotG7AD2t1uMYXcdK04GPmu5mTXFEKUcIz6tlYbadZBgwBJK22OcuO00mHxN9qJD'
 STRIPE_SECRET_KEY = 'sk_test_51Gu3LxF4Yj6onjd3soxW5HykjCv72ESAlZgVJoTg7wvqo2ysq1RwdvaIBJJgVoSg4kUFH3V6mZ0EGcWLmQpfqpL30012uZfS5w'
+# Payment jobs (see core/payments.py): 'stripe' or the offline 'fake' backend
+PAYMENT_BACKEND = os.getenv('PAYMENT_BACKEND', 'stripe')
+PAYMENT_FAKE_LATENCY = float(os.getenv('PAYMENT_FAKE_LATENCY', '0'))
+PAYMENT_JOBS_IN_PROCESS = True
+PAYMENT_WORKER_THREADS = 2
+# Cart stock reservations are returned after this long (see core/stock.py)
+STOCK_RESERVATION_MINUTES = 15
+# Open carts idle for this long are deleted by `python manage.py cleanup_carts`
+CART_TTL_DAYS = int(os.getenv('CART_TTL_DAYS', '30'))
 
 INSTALLED_APPS = [
     'django.contrib.admin',
@@ -30,6 +39,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -41,6 +51,11 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'onlineStore.urls'
 
+# Request metrics (see core/middleware.py), scraped from /metrics/
+SLOW_REQUEST_THRESHOLD_MS = 500
+# Bearer token of the Prometheus scraper, /metrics/ is staff-only without it
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -52,11 +67,28 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'core.context_processors.cart',
             ],
         },
     },
 ]
 
+# Production template mode: compiled templates stay in memory (cached
+# loaders) and the page chrome and the checkout country select are served
+# from the cache (see core/fragments.py). Off in development, so template
+# edits show up without a restart.
+TEMPLATE_CACHE = os.getenv('TEMPLATE_CACHE', 'true' if ENVIRONMENT == 'production' else 'false') == 'true'
+CACHED_TEMPLATE_LOADERS = [
+    ('django.template.loaders.cached.Loader', [
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+    ]),
+]
+# Django only caches templates on its own with DEBUG off, which is never the case here
+if TEMPLATE_CACHE:
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = CACHED_TEMPLATE_LOADERS
+
 LANGUAGE_CODE = 'en-us'
 TIME_ZONE = 'UTC'
 USE_I18N = True
@@ -66,15 +98,72 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static_files')]
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
+# See core/storage.py: collectstatic bundles, content-hashes and
+# pre-compresses the assets
+STATICFILES_STORAGE = 'core.storage.CompressedManifestStaticFilesStorage'
+STATIC_BUNDLES = {
+    'css/bundle.css': ['css/bootstrap.min.css', 'css/mdb.min.css', 'css/style.min.css'],
+    'js/bundle.js': ['js/jquery-3.3.1.min.js', 'js/popper.min.js', 'js/bootstrap.min.js', 'js/mdb.min.js'],
+}
+# BundleFinder builds the bundles for runserver, which has no collectstatic step
+STATICFILES_FINDERS = [
+    'django.contrib.staticfiles.finders.FileSystemFinder',
+    'django.contrib.staticfiles.finders.AppDirectoriesFinder',
+    'core.finders.BundleFinder',
+]
+# Serve STATIC_ROOT from Django when DEBUG is off and there is no front server
+SERVE_STATIC = os.getenv('SERVE_STATIC') == 'true'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Default catalog file of `python manage.py prepopulate`
+CATALOG_IMPORT_FILE = os.getenv('CATALOG_IMPORT_FILE')
+# Resized variants of uploaded item images (see core/images.py)
+IMAGE_DERIVATIVES_ASYNC = True
+IMAGE_DERIVATIVE_WORKERS = 2
 
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": os.path.join(BASE_DIR, 'db.sqlite3')
+        "NAME": os.path.join(BASE_DIR, 'db.sqlite3'),
+        # A file (not in-memory) test database, so tests running requests
+        # from several threads wait for SQLite's write lock instead of failing
+        "TEST": {
+            "NAME": os.path.join(BASE_DIR, 'test_db.sqlite3')
+        }
+    }
+}
+
+# Local read replicas for trying out core.routers: SQLITE_REPLICAS=2 adds
+# replica1 and replica2, copies of db.sqlite3 refreshed with
+# `python manage.py sync_sqlite_replicas`
+for n in range(1, int(os.getenv('SQLITE_REPLICAS', 0)) + 1):
+    DATABASES[f'replica{n}'] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(BASE_DIR, f'db-replica{n}.sqlite3'),
+        "TEST": {"MIRROR": "default"}
+    }
+
+# Catalog reads of the views using core.routers.replica_reads go to one of
+# DATABASE_REPLICAS unless it lags more than REPLICA_MAX_LAG seconds
+DATABASE_ROUTERS = ['core.routers.ReplicaRouter']
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+REPLICA_MODELS = ['core.item']
+REPLICA_MAX_LAG = 5
+REPLICA_LAG_CHECK_INTERVAL = 5
+
+# Local memory cache per process in development, or a file cache shared by
+# all local processes when CACHE_DIR is set
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'onlineStore',
     }
 }
+if os.getenv('CACHE_DIR'):
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('CACHE_DIR'),
+    }
 
 if ENVIRONMENT == 'production':
     DEBUG = True
@@ -92,6 +181,13 @@ STATICFILES_DIRS = (
     os.path.join(BASE_DIR, 'static_in_env'),
 )
 
+# Cursor pagination for catalog listings, for large catalogs (see core/pagination.py)
+KEYSET_PAGINATION = os.getenv('KEYSET_PAGINATION') == 'true'
+
+# Seconds a worker serves its in-memory catalog snapshot before checking the
+# catalog version again, i.e. the staleness bound after an Item change
+CATALOG_SNAPSHOT_MAX_AGE = float(os.getenv('CATALOG_SNAPSHOT_MAX_AGE', 2))
+
 AUTHENTICATION_BACKENDS = [
     # Needed to login by username in Django admin, regardless of `allauth`
     'django.contrib.auth.backends.ModelBackend',
@@ -108,4 +204,4 @@ SOCIALACCOUNT_ENABLED = 'allauth.socialaccount'
 ACCOUNT_EMAIL_VERIFICATION = 'none'
 USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 #CRISPY FORMS
-CRISPY_TEMPLATE_PACK = 'bootstrap4'
\ No newline at end of file
+CRISPY_TEMPLATE_PACK = 'bootstrap4'